@@ -0,0 +1,86 @@
+"""
+Per call cost of checkIfBlackListed on the candidate titles.
+
+Run from the src folder:
+    python -m benchmarks.blacklist --billboard ../data/datasets/billboard/billboard-the-hot-100-songs.zip \
+        --store ../data/datasets/spotify/hit_song_info.json ../data/datasets/spotify/not_hit_song_info.json
+Without data files a synthetic set of titles is used.
+"""
+from argparse import ArgumentParser
+import re
+from random import Random
+from time import perf_counter
+
+from data.query.matching import TitleFilter, getTitleFilter
+from data.query.util import loadJson
+
+def legacyCheck(name: str, blackList: list[str], whiteList: list[str]) -> bool:
+    # The nested loop the compiled filter replaced
+    for blackListed in blackList:
+        if blackListed.lower() in name.lower():
+            for whiteListed in whiteList:
+                if whiteListed.lower() in name.lower():
+                    return False
+            return True
+    return False
+
+def regexCheck(blackList: list[str], whiteList: list[str]):
+    # Both lists as one case insensitive regex each, for comparison
+    black = re.compile('|'.join(re.escape(name) for name in blackList), re.IGNORECASE)
+    white = re.compile('|'.join(re.escape(name) for name in whiteList), re.IGNORECASE)
+    return lambda name: black.search(name) is not None and white.search(name) is None
+
+def loadTitles(billboardPath: str, storePaths: list[str]) -> list[str]:
+    titles: list[str] = []
+    if billboardPath:
+        from data.query.billboard import iterBillboardData
+        titles.extend(row['song'] for row in iterBillboardData(billboardPath, columns=['song']))
+    for storePath in storePaths:
+        stored = loadJson(storePath)
+        for entry in (stored.values() if isinstance(stored, dict) else stored):
+            info = entry.get('info', entry)
+            titles.append(info['spotifyData']['name'])
+    return titles
+
+def syntheticTitles(count: int, seed: int = 0) -> list[str]:
+    rnd = Random(seed)
+    words = ['Love', 'Night', 'Baby', 'Heart', 'Dance', 'Fire', 'Girl', 'Home', 'Tonight', 'Rain']
+    suffixes = ['', '', '', '', ' - Remix', ' (Instrumental Version)', " (Taylor's Version)", ' - Radio Edit', ' - Live']
+    return [' '.join(rnd.choices(words, k=rnd.randint(1, 5))) + rnd.choice(suffixes) for _ in range(count)]
+
+def timeCalls(check, titles: list[str], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        for title in titles:
+            check(title)
+        best = min(best, perf_counter() - start)
+    return best / len(titles) * 1e9
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--billboard', default='', help='Billboard zip, the song column is used')
+    parser.add_argument('--store', nargs='*', default=[], help='Stored query results or features json files')
+    parser.add_argument('--synthetic', type=int, default=300000, help='Number of synthetic titles without data files')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    titles = loadTitles(args.billboard, args.store)
+    if not titles:
+        titles = syntheticTitles(args.synthetic)
+
+    titleFilter: TitleFilter = getTitleFilter()
+    legacy = [legacyCheck(title, titleFilter.blackList, titleFilter.whiteList) for title in titles]
+    compiled = [titleFilter.isBlackListed(title) for title in titles]
+    mismatches = sum(1 for a, b in zip(legacy, compiled) if a != b)
+
+    legacyNs = timeCalls(lambda title: legacyCheck(title, titleFilter.blackList, titleFilter.whiteList), titles, args.repeat)
+    regexNs = timeCalls(regexCheck(titleFilter.blackList, titleFilter.whiteList), titles, args.repeat)
+    filterNs = timeCalls(titleFilter.isBlackListed, titles, args.repeat)
+    print(f"Titles: {len(titles)} blacklisted: {sum(compiled)} mismatches: {mismatches}")
+    print(f"Nested loop:  {legacyNs:.0f} ns/call")
+    print(f"Single regex: {regexNs:.0f} ns/call ({legacyNs / regexNs:.1f}x)")
+    print(f"TitleFilter:  {filterNs:.0f} ns/call ({legacyNs / filterNs:.1f}x)")
+
+if __name__ == '__main__':
+    main()
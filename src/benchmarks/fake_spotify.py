@@ -0,0 +1,400 @@
+"""
+Local stand-in for the parts of the Spotify Web API used in data.query.
+
+Serves search, audio-features, albums and album tracks from a synthetic catalog made from
+charts.csv shaped rows, with injected latency and simulated 429 responses.
+connectLatency is waited once for every new connection, in place of the TLS handshake of the real api,
+and with compress the responses are gzipped for the clients that accept it.
+A spotipy client is pointed to it by setting api.prefix = server.prefix on a Spotify(auth='fake').
+
+Run from the src folder to serve it for other processes:
+    python -m benchmarks.fake_spotify --songs 5000 --port 8765 --latency 0.05
+"""
+from typing import Optional
+from argparse import ArgumentParser
+from collections import Counter
+from gzip import compress as gzipCompress
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as jsondumps
+from random import Random
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+import re
+
+from data.types.billboard import BillboardSong
+
+base62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+artistSeparators = re.compile(r'\s+(?:Featuring|Feat\.|&|x|With|And)\s+|,\s*')
+tokenPattern = re.compile(r'\w+')
+
+def fakeID(*parts: str) -> str:
+    # 22 character base 62 ids like the real ones, spotipy checks the format
+    number = int(sha1('\x00'.join(parts).encode('utf-8')).hexdigest(), 16)
+    digits = []
+    for _ in range(22):
+        number, digit = divmod(number, 62)
+        digits.append(base62[digit])
+    return ''.join(digits)
+
+def syntheticChartRows(
+        songs: int = 2000,
+        weeksOnChart: int = 8,
+        seed: int = 0
+        ) -> list[BillboardSong]:
+    """
+    Chart rows shaped like the rows of the Kaggle charts.csv.
+    Every song is on the chart for up to weeksOnChart weeks and a part of the artists have features.
+    """
+    rnd = Random(seed)
+    words = ['Love', 'Night', 'Baby', 'Heart', 'Dance', 'Fire', 'Girl', 'Home', 'Tonight', 'Rain',
+             'Summer', 'Dream', 'Money', 'Wild', 'Blue', 'Time', 'Light', 'Gold', 'Forever', 'Crazy']
+    names = ['Sam', 'Alex', 'Taylor', 'Jordan', 'Casey', 'Riley', 'Morgan', 'Jamie', 'Drew', 'Quinn']
+    artists = [f"{rnd.choice(names)} {rnd.choice(words)}{i}" for i in range(max(1, songs // 4))]
+    rows: list = []
+    for i in range(songs):
+        song = ' '.join(rnd.choices(words, k=rnd.randint(1, 4))) + f" {i}"
+        artist = rnd.choice(artists)
+        if rnd.random() < 0.2:
+            artist += rnd.choice([' Featuring ', ' & ', ' x ']) + rnd.choice(artists)
+        firstWeek = rnd.randint(0, 3000)
+        for week in range(rnd.randint(1, weeksOnChart)):
+            day = firstWeek + week
+            rows.append({
+                'date': f"{1960 + day // 52}-{(day % 52) // 4 + 1:02d}-{(day % 4) * 7 + 1:02d}",
+                'rank': str(rnd.randint(1, 100)),
+                'song': song,
+                'artist': artist,
+                'last-week': '' if week == 0 else str(rnd.randint(1, 100)),
+                'peak-rank': str(rnd.randint(1, 100)),
+                'weeks-on-board': str(week + 1)
+                })
+    return rows
+
+class FakeCatalog:
+    """
+    Tracks, albums and artists made from the chart rows.
+    Every chart song is a track on an album of its first artist, the albums are filled with non hit tracks.
+    Some tracks get a differing name (feat. suffix, case) so they only match in the relaxed pass,
+    some songs are missing and some have a blacklisted remix next to them.
+    """
+
+    def __init__(
+            self,
+            chartRows: list[BillboardSong],
+            albumSize: int = 12,
+            missingShare: float = 0.05,
+            seed: int = 0
+            ) -> None:
+        rnd = Random(seed)
+        self.tracks: dict[str, dict] = {}
+        self.albums: dict[str, dict] = {}
+        self.albumTracks: dict[str, list[str]] = {}
+        self.tokenIndex: dict[str, set[str]] = {}
+        openAlbums: dict[str, str] = {}
+
+        seen = set()
+        for row in chartRows:
+            key = (row['song'], row['artist'])
+            if key in seen:
+                continue
+            seen.add(key)
+            if rnd.random() < missingShare:
+                continue
+
+            artistNames = [name for name in artistSeparators.split(row['artist']) if name]
+            artists = [{'name': name, 'id': fakeID('artist', name)} for name in artistNames]
+            mainArtist = artistNames[0]
+            albumID = openAlbums.get(mainArtist)
+            if albumID is None or len(self.albumTracks[albumID]) >= albumSize:
+                albumID = self._addAlbum(mainArtist, artists[0], row['date'][:4], rnd)
+                openAlbums[mainArtist] = albumID
+
+            name = row['song']
+            variant = rnd.random()
+            if variant < 0.1 and len(artists) > 1:
+                name = f"{name} (feat. {artists[1]['name']})"
+            elif variant < 0.15:
+                name = name.upper()
+            self._addTrack(name, artists, albumID)
+            if rnd.random() < 0.05:
+                self._addTrack(f"{row['song']} - Remix", artists, albumID)
+
+        # Fill the albums with non hits
+        for albumID, trackIDs in self.albumTracks.items():
+            album = self.albums[albumID]
+            for n in range(rnd.randint(2, albumSize)):
+                self._addTrack(f"{album['name']} Track {n}", album['artists'], albumID)
+            album['total_tracks'] = len(trackIDs)
+
+    def _addAlbum(self, artistName: str, artist: dict, year: str, rnd: Random) -> str:
+        albumID = fakeID('album', artistName, str(len(self.albums)))
+        precision = rnd.random()
+        releaseDate = year if precision < 0.1 else f"{year}-{rnd.randint(1, 12):02d}" if precision < 0.2 else f"{year}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+        self.albums[albumID] = {
+                'id': albumID,
+                'name': f"{artistName} Album {len(self.albums)}",
+                'artists': [artist],
+                'release_date': releaseDate,
+                'total_tracks': 0
+                }
+        self.albumTracks[albumID] = []
+        return albumID
+
+    def _addTrack(self, name: str, artists: list[dict], albumID: str) -> None:
+        trackID = fakeID('track', name, albumID, str(len(self.tracks)))
+        self.tracks[trackID] = {'id': trackID, 'name': name, 'artists': artists, 'albumID': albumID}
+        self.albumTracks[albumID].append(trackID)
+        for token in tokenPattern.findall((name + ' ' + ' '.join(a['name'] for a in artists)).lower()):
+            self.tokenIndex.setdefault(token, set()).add(trackID)
+
+    def simplifiedAlbum(self, albumID: str) -> dict:
+        album = self.albums[albumID]
+        return {key: album[key] for key in ('id', 'name', 'artists', 'release_date', 'total_tracks')}
+
+    def simplifiedTrack(self, trackID: str, withAlbum: bool = True) -> dict:
+        track = self.tracks[trackID]
+        simplified = {'id': track['id'], 'name': track['name'], 'artists': track['artists']}
+        if withAlbum:
+            simplified['album'] = self.simplifiedAlbum(track['albumID'])
+        return simplified
+
+    def search(self, query: str, limit: int) -> list[dict]:
+        # Tracks ranked by the number of query tokens they have
+        scores: Counter = Counter()
+        for token in tokenPattern.findall(query.lower()):
+            for trackID in self.tokenIndex.get(token, ()):
+                scores[trackID] += 1
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [self.simplifiedTrack(trackID) for trackID, _ in best]
+
+    def audioFeatures(self, trackID: str) -> Optional[dict]:
+        if trackID not in self.tracks:
+            return None
+        rnd = Random(trackID)
+        return {
+                'id': trackID,
+                'time_signature': rnd.choice([3, 4, 4, 4, 5]),
+                'duration_ms': rnd.randint(90000, 420000),
+                'key': rnd.randint(0, 11),
+                'mode': rnd.randint(0, 1),
+                'acousticness': rnd.random(),
+                'danceability': rnd.random(),
+                'energy': rnd.random(),
+                'instrumentalness': rnd.random() * 0.1,
+                'liveness': rnd.random(),
+                'loudness': -rnd.random() * 30,
+                'speechiness': rnd.random() * 0.5,
+                'valence': rnd.random(),
+                'tempo': 60 + rnd.random() * 140
+                }
+
+    def albumTrackPage(self, albumID: str, limit: int, offset: int) -> dict:
+        trackIDs = self.albumTracks[albumID]
+        return {
+                'items': [self.simplifiedTrack(trackID, False) for trackID in trackIDs[offset:offset + limit]],
+                'total': len(trackIDs),
+                'limit': limit,
+                'offset': offset,
+                'next': None
+                }
+
+class FakeSpotifyServer:
+    """
+    Threaded HTTP server for a FakeCatalog.
+    latency seconds (+ random jitter up to latencyJitter) are waited before every response
+    and rateLimitShare of the requests get a 429 with a Retry-After of retryAfter seconds.
+    connectLatency seconds are waited before the first response of a connection.
+    calls counts the requests per endpoint, rateLimited the 429 responses, connections the accepted connections
+    and bytesSent the response bodies as sent.
+    """
+
+    def __init__(
+            self,
+            catalog: FakeCatalog,
+            port: int = 0,
+            latency: float = 0.0,
+            latencyJitter: float = 0.0,
+            rateLimitShare: float = 0.0,
+            retryAfter: int = 1,
+            seed: int = 0,
+            connectLatency: float = 0.0,
+            compress: bool = False
+            ) -> None:
+        self.catalog = catalog
+        self.connectLatency = connectLatency
+        self.compress = compress
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.rateLimitShare = rateLimitShare
+        self.retryAfter = retryAfter
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.calls: Counter = Counter()
+        self.rateLimited = 0
+        self.connections = 0
+        self.bytesSent = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handlerClass())
+        self.server.daemon_threads = True
+        self.thread: Optional[Thread] = None
+
+    @property
+    def prefix(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1/"
+
+    def start(self) -> 'FakeSpotifyServer':
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'FakeSpotifyServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def resetCounters(self) -> None:
+        with self.lock:
+            self.calls.clear()
+            self.rateLimited = 0
+            self.connections = 0
+            self.bytesSent = 0
+
+    def _route(self, path: str, params: dict) -> tuple[int, dict]:
+        catalog = self.catalog
+        parts = [part for part in path.split('/') if part]
+        if parts[:1] != ['v1']:
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+        parts = parts[1:]
+
+        def param(name: str, default: str) -> str:
+            return params.get(name, [default])[0]
+
+        if parts == ['search']:
+            items = catalog.search(param('q', ''), int(param('limit', '10')))
+            return 200, {'tracks': {'items': items, 'total': len(items)}}
+        if parts == ['audio-features']:
+            ids = [sid for sid in param('ids', '').split(',') if sid]
+            return 200, {'audio_features': [catalog.audioFeatures(sid) for sid in ids]}
+        if parts == ['albums']:
+            albums: list[Optional[dict]] = []
+            for albumID in [aid for aid in param('ids', '').split(',') if aid]:
+                if albumID not in catalog.albums:
+                    albums.append(None)
+                    continue
+                album = catalog.simplifiedAlbum(albumID)
+                album['tracks'] = catalog.albumTrackPage(albumID, 50, 0)
+                albums.append(album)
+            return 200, {'albums': albums}
+        if len(parts) == 3 and parts[0] == 'albums' and parts[2] == 'tracks':
+            if parts[1] not in catalog.albums:
+                return 404, {'error': {'status': 404, 'message': 'Album not found'}}
+            return 200, catalog.albumTrackPage(parts[1], int(param('limit', '50')), int(param('offset', '0')))
+        return 404, {'error': {'status': 404, 'message': 'Not found'}}
+
+    def _handlerClass(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep alive so the clients can reuse the connections
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, with Nagle every response would wait for a delayed ack
+            disable_nagle_algorithm = True
+
+            def setup(self) -> None:
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+                if server.connectLatency > 0:
+                    sleep(server.connectLatency)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+            def _send(self, status: int, body: dict, headers: dict = {}) -> None:
+                encoded = jsondumps(body).encode('utf-8')
+                compressed = server.compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+                if compressed:
+                    encoded = gzipCompress(encoded, 6)
+                with server.lock:
+                    server.bytesSent += len(encoded)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if compressed:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(encoded)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                endpoint = '/'.join(part for part in url.path.split('/')[2:] if part)
+                if endpoint.startswith('albums/'):
+                    endpoint = 'albums/tracks'
+                with server.lock:
+                    server.calls[endpoint] += 1
+                    limited = server.random.random() < server.rateLimitShare
+                    delay = server.latency + server.random.random() * server.latencyJitter
+                if delay > 0:
+                    sleep(delay)
+                if limited:
+                    with server.lock:
+                        server.rateLimited += 1
+                    self._send(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                               {'Retry-After': str(server.retryAfter)})
+                    return
+                status, body = server._route(url.path, parse_qs(url.query))
+                self._send(status, body)
+
+            def do_POST(self) -> None:
+                # Client credentials token, the body is not checked
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                with server.lock:
+                    server.calls['token'] += 1
+                self._send(200, {'access_token': 'fake', 'token_type': 'Bearer', 'expires_in': 3600})
+
+        return Handler
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--charts', default='', help='Billboard zip to make the catalog from')
+    parser.add_argument('--songs', type=int, default=5000, help='Synthetic chart songs without --charts')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rate-limit-share', type=float, default=0.0)
+    parser.add_argument('--connect-latency', type=float, default=0.0, help='Seconds waited for every new connection')
+    parser.add_argument('--compress', action='store_true', help='Gzip the responses when the client accepts it')
+    args = parser.parse_args()
+
+    if args.charts:
+        from data.query.billboard import getBillboardData
+        rows = getBillboardData(args.charts, columns=['date', 'song', 'artist'])
+    else:
+        rows = syntheticChartRows(args.songs)
+
+    server = FakeSpotifyServer(
+            FakeCatalog(rows),
+            args.port,
+            args.latency,
+            args.jitter,
+            args.rate_limit_share,
+            connectLatency=args.connect_latency,
+            compress=args.compress
+            )
+    print(f"Serving {len(server.catalog.tracks)} tracks at {server.prefix}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.server.server_close()
+
+if __name__ == '__main__':
+    main()
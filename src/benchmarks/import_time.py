@@ -0,0 +1,82 @@
+"""
+Import time of the data modules and the heavy packages they pull in, against a budget.
+
+Run from the src folder:
+    python -m benchmarks.import_time --repeat 5
+Every module is imported in a fresh interpreter with -X importtime, the best of the runs is reported.
+Exits with 1 when a module is over its budget or imports a package it shouldn't.
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+import subprocess
+import sys
+
+# Packages that are only imported by the functions that need them
+heavyPackages = ['spotipy', 'requests', 'fuzzywuzzy', 'pandas', 'matplotlib', 'numpy']
+# Module: (budget in ms, heavy packages it is allowed to import)
+budgets: dict[str, tuple[float, list[str]]] = {
+        'data.query.util': (40, []),
+        'data.query.store': (40, []),
+        'data.query.keys': (50, []),
+        'data.query.billboard': (50, []),
+        'data.query.spotify_api': (80, []),
+        'data.query.update': (80, []),
+        'data.process.features': (250, ['numpy']),
+        'data.process.dataset': (250, ['numpy']),
+        'data.process.balance': (250, ['numpy']),
+        'data.process.statistics': (300, ['numpy']),
+        'data.orchestrate': (80, []),
+        'data.plotting.util': (10, [])
+        }
+
+def parseImportTime(stderr: str) -> dict[str, int]:
+    """
+    Cumulative microseconds of every imported module from the -X importtime lines
+    "import time: self [us] | cumulative | imported package".
+    """
+    cumulative: dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, total, name = line[len('import time:'):].split('|')
+        if total.strip().isdigit():
+            cumulative[name.strip()] = int(total)
+    return cumulative
+
+def measureImport(module: str) -> dict[str, int]:
+    result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+            cwd=Path(__file__).resolve().parents[1],
+            capture_output=True,
+            text=True
+            )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return parseImportTime(result.stderr)
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('modules', nargs='*', help='Modules to measure, all in the budget by default')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    failed = False
+    for module in (args.modules or list(budgets.keys())):
+        budget, allowed = budgets.get(module, (float('inf'), heavyPackages))
+        runs = [measureImport(module) for _ in range(args.repeat)]
+        # The best run, the others are noise from the disk cache and the machine
+        ms = min(run.get(module, 0) for run in runs) / 1000
+        heavy = [package for package in heavyPackages if package in runs[0]]
+        unexpected = [package for package in heavy if package not in allowed]
+        status = 'ok'
+        if ms > budget or len(unexpected) > 0:
+            status = 'OVER BUDGET' if ms > budget else 'UNEXPECTED IMPORTS'
+            failed = True
+        print(f"{module:28} {ms:8.1f} ms (budget {budget:g}) heavy: {', '.join(heavy) or '-':20} {status}")
+        if len(unexpected) > 0:
+            print(f"    imports {', '.join(unexpected)}")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+End to end throughput of the query path against the local fake Spotify api.
+
+Runs getSpotifyDataFromBillboardSongsV2, getSpotifyAudioFeaturesV2 and fetchAlbumTracksV2
+on a fresh store and reports songs/sec, api calls per matched song and the peak RSS of every stage.
+
+Run from the src folder:
+    python -m benchmarks.pipeline --songs 2000 --latency 0.02 --workers 8
+    python -m benchmarks.pipeline --charts ../data/datasets/billboard/billboard-the-hot-100-songs.zip --limit 20000
+"""
+from typing import Callable
+from collections.abc import Mapping
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import resource
+
+from spotipy import Spotify
+
+from data.types.billboard import BillboardSong
+from data.query.metrics import MetricsExporter, getMetrics
+from data.query.ratelimit import RateLimiter
+from data.query.retry import RetryPolicy
+from data.query.spotify_api import (
+        SpotifyDataHandler,
+        getSpotifyDataFromBillboardSongsV2,
+        getSpotifyAudioFeaturesV2,
+        fetchAlbumTracksV2
+        )
+from .fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+
+def peakRSS() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def runStage(
+        name: str,
+        server: FakeSpotifyServer,
+        stage: Callable[[], Mapping],
+        results: list[dict]
+        ) -> Mapping:
+    server.resetCounters()
+    start = perf_counter()
+    data = stage()
+    elapsed = perf_counter() - start
+    calls = sum(server.calls.values())
+    results.append({
+            'stage': name,
+            'songs': len(data),
+            'seconds': elapsed,
+            'songsPerSecond': len(data) / elapsed if elapsed > 0 else 0.0,
+            'calls': calls,
+            'callsPerSong': calls / len(data) if len(data) > 0 else 0.0,
+            'rateLimited': server.rateLimited,
+            'connections': server.connections,
+            'peakRSS': peakRSS()
+            })
+    return data
+
+def printResults(results: list[dict]) -> None:
+    print(f"{'stage':<10}{'songs':>8}{'seconds':>10}{'songs/s':>10}{'calls':>8}{'calls/song':>12}{'429s':>6}{'conns':>7}{'peak MB':>9}")
+    for r in results:
+        print(
+                f"{r['stage']:<10}{r['songs']:>8}{r['seconds']:>10.2f}{r['songsPerSecond']:>10.1f}"
+                f"{r['calls']:>8}{r['callsPerSong']:>12.3f}{r['rateLimited']:>6}{r['connections']:>7}{r['peakRSS']:>9.1f}"
+                )
+
+def printLatencies() -> None:
+    # Latencies of the api calls as seen by the query functions, from the metrics
+    print(f"{'endpoint':<16}{'calls':>8}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for labels, histogram in getMetrics().toDict()['histograms'].get('api_latency_seconds', {}).items():
+        endpoint = labels.split('=', 1)[1]
+        quantiles = [f"{histogram[q] * 1000:>9.0f}" for q in ('p50', 'p95', 'p99')]
+        print(f"{endpoint:<16}{histogram['count']:>8}{histogram['mean'] * 1000:>10.1f}{''.join(quantiles)}")
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--charts', default='', help='Billboard zip to use instead of synthetic chart rows')
+    parser.add_argument('--limit', type=int, default=0, help='Use only the first rows of --charts')
+    parser.add_argument('--songs', type=int, default=2000, help='Synthetic chart songs without --charts')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency up to this many seconds')
+    parser.add_argument('--rate-limit-share', type=float, default=0.0, help='Share of the requests that get a 429')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0.0, help='Limiter calls per second, 0 for no pacing')
+    parser.add_argument('--match-processes', type=int, default=0, help='Processes matching the search results')
+    parser.add_argument('--backend', default=None, choices=['json', 'log'])
+    parser.add_argument('--records', default=None, choices=['dict', 'compact'], help='In memory representation of the stores')
+    parser.add_argument('--local-catalog', action='store_true', help='Look the chart songs up from the stored songs before searching, see catalog.LocalCatalog')
+    parser.add_argument('--metrics', default=None, help='Save the metrics here every second, .prom for Prometheus text')
+    args = parser.parse_args()
+
+    chartRows: list[BillboardSong]
+    if args.charts:
+        from data.query.billboard import getBillboardData
+        chartRows = getBillboardData(args.charts, columns=['date', 'song', 'artist'])
+        if args.limit > 0:
+            chartRows = chartRows[:args.limit]
+    else:
+        chartRows = syntheticChartRows(args.songs)
+
+    start = perf_counter()
+    catalog = FakeCatalog(chartRows)
+    print(f"Catalog of {len(catalog.tracks)} tracks and {len(catalog.albums)} albums from {len(chartRows)} chart rows in {perf_counter() - start:.1f}s")
+
+    # Without a limiter the concurrent V2 search paces itself to the default 10 calls/s,
+    # with no pacing only the number of calls in flight is limited
+    rate = args.rate if args.rate > 0 else 1e9
+    limiter = RateLimiter(rate, burst=max(1, min(int(rate), 1000)), maxInFlight=args.workers)
+    # Short delays so the 429 simulation doesn't dominate the run
+    retryPolicy = RetryPolicy(baseDelay=0.05, maxDelay=1.0)
+    results: list[dict] = []
+    exporter = MetricsExporter(args.metrics, interval=1.0).start() if args.metrics else None
+    with FakeSpotifyServer(catalog, latency=args.latency, latencyJitter=args.jitter, rateLimitShare=args.rate_limit_share) as server, \
+            TemporaryDirectory() as folder:
+        # 429 is left to the limiter and the retry policy like with initializeSpotifyAPI(rateLimited=True)
+        api = Spotify(auth='fake', status_forcelist=(500, 502, 503, 504), retries=0)
+        api.prefix = server.prefix
+        storeFolder = Path(folder)
+
+        hits = runStage('songs', server, lambda: getSpotifyDataFromBillboardSongsV2(
+                api,
+                chartRows,
+                str(storeFolder / 'hits.json'),
+                args.backend,
+                workers=args.workers,
+                limiter=limiter,
+                retryPolicy=retryPolicy,
+                matchProcesses=args.match_processes,
+                records=args.records,
+                useCatalog=args.local_catalog
+                ), results)
+        runStage('features', server, lambda: getSpotifyAudioFeaturesV2(
+                api,
+                hits,
+                str(storeFolder / 'hitFeatures.json'),
+                args.backend,
+                workers=args.workers,
+                limiter=limiter,
+                records=args.records
+                ), results)
+
+        def albumStage() -> Mapping:
+            handler = SpotifyDataHandler(str(storeFolder / 'albumTracks.json'), args.backend, args.records)
+            data = fetchAlbumTracksV2(api, handler, hits, limiter=limiter)
+            handler.compact()
+            handler.close()
+            return data
+        runStage('albums', server, albumStage, results)
+
+    uniqueSongs = len({(row['song'], row['artist']) for row in chartRows})
+    print(f"Matched {len(hits)} of {uniqueSongs} unique chart songs")
+    printResults(results)
+    printLatencies()
+    if exporter is not None:
+        exporter.stop()
+
+if __name__ == '__main__':
+    main()
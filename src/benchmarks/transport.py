@@ -0,0 +1,112 @@
+"""
+Connection reuse and compression of the Spotify client sessions against the local fake Spotify api.
+
+Makes the same concurrent album tracks calls with a client without a session (a connection per call),
+with spotipy's own session (10 kept connections) and with transport.HttpTransport sessions,
+and reports calls/sec, the connections the server accepted and the response bytes sent.
+The server waits --connect-latency for every new connection in place of the TLS handshake of the real api.
+
+Run from the src folder:
+    python -m benchmarks.transport --calls 3000 --workers 32 --latency 0.05 --connect-latency 0.05
+
+The album listings are used instead of searches as the fake search costs milliseconds of cpu,
+with server and client on one machine that would be measured instead of the connections.
+"""
+from typing import Callable
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+from time import perf_counter
+
+from spotipy import Spotify
+
+from data.query.transport import HttpTransport
+from .fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+
+# 429 is not retried like with initializeSpotifyAPI(rateLimited=True)
+statusForcelist = (500, 502, 503, 504)
+
+def spotipyClient(session: bool) -> Spotify:
+    return Spotify(auth='fake', requests_session=session, status_forcelist=statusForcelist, retries=0)
+
+def transportClient(transport: HttpTransport) -> Spotify:
+    return transport.client(auth='fake', status_forcelist=statusForcelist, retries=0)
+
+def runClient(
+        name: str,
+        api: Spotify,
+        server: FakeSpotifyServer,
+        albumIDs: list[str],
+        workers: int
+        ) -> dict:
+    api.prefix = server.prefix
+    server.resetCounters()
+    latencies: list[float] = []
+
+    def albumTracks(albumID: str) -> None:
+        start = perf_counter()
+        api.album_tracks(albumID, limit=50)
+        latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        for _ in pool.map(albumTracks, albumIDs):
+            pass
+    elapsed = perf_counter() - start
+    latencies.sort()
+    return {
+            'client': name,
+            'calls': len(albumIDs),
+            'seconds': elapsed,
+            'callsPerSecond': len(albumIDs) / elapsed if elapsed > 0 else 0.0,
+            'connections': server.connections,
+            'kilobytes': server.bytesSent / 1024,
+            'p50': latencies[len(latencies) // 2],
+            'p95': latencies[int(len(latencies) * 0.95)]
+            }
+
+def printResults(results: list[dict]) -> None:
+    print(f"{'client':<22}{'calls':>7}{'seconds':>9}{'calls/s':>9}{'conns':>7}{'KB sent':>10}{'p50 ms':>8}{'p95 ms':>8}")
+    for r in results:
+        print(
+                f"{r['client']:<22}{r['calls']:>7}{r['seconds']:>9.2f}{r['callsPerSecond']:>9.1f}{r['connections']:>7}"
+                f"{r['kilobytes']:>10.0f}{r['p50'] * 1000:>8.1f}{r['p95'] * 1000:>8.1f}"
+                )
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--songs', type=int, default=2000, help='Synthetic chart songs of the catalog')
+    parser.add_argument('--calls', type=int, default=3000, help='Album tracks calls made with every client')
+    parser.add_argument('--workers', type=int, default=32, help='Threads making the calls')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every response')
+    parser.add_argument('--connect-latency', type=float, default=0.05, help='Seconds waited for every new connection')
+    parser.add_argument('--no-compress', action='store_true', help='The server never gzips the responses')
+    args = parser.parse_args()
+
+    catalog = FakeCatalog(syntheticChartRows(args.songs))
+    albumIDs = Random(0).choices(list(catalog.albums.keys()), k=args.calls)
+
+    clients: list[tuple[str, Callable[[], Spotify]]] = [
+            ('no session', lambda: spotipyClient(False)),
+            ('spotipy session', lambda: spotipyClient(True)),
+            ('transport', lambda: transportClient(HttpTransport(poolSize=args.workers, retries=0, statusForcelist=statusForcelist))),
+            ('transport identity', lambda: transportClient(HttpTransport(
+                    poolSize=args.workers,
+                    compress=False,
+                    retries=0,
+                    statusForcelist=statusForcelist
+                    )))
+            ]
+    results: list[dict] = []
+    with FakeSpotifyServer(
+            catalog,
+            latency=args.latency,
+            connectLatency=args.connect_latency,
+            compress=not args.no_compress
+            ) as server:
+        for name, makeClient in clients:
+            results.append(runClient(name, makeClient(), server, albumIDs, args.workers))
+    printResults(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,455 @@
+"""
+Runs the data flow from the chart download to the train/validation/test dataset as a graph of stages.
+
+Every stage writes to its own folder keyed by a hash of its parameters and of the outputs of the stages
+it reads, so a stage whose inputs and parameters haven't changed is skipped.
+Stages that don't depend on each other run at the same time, each in its own process,
+and the wall time and peak memory of every run are saved with the output.
+
+Run from the src folder:
+    python -m data.orchestrate run --jobs 2 --param sample.sampleSize=192
+    python -m data.orchestrate status
+"""
+from typing import Any, Callable, Generator, Optional
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from hashlib import sha256
+from json import dumps as jsondumps, loads as jsonloads
+from multiprocessing import get_context
+from pathlib import Path
+from shutil import rmtree
+from time import perf_counter
+import resource
+
+from data.query.planner import defaultMatchRules
+
+defaultWorkFolder = 'data/datasets/pipeline'
+stageRecordName = '_stage.json'
+# Stage function: inputs (stage name -> output folder), output folder, params, settings
+StageFunction = Callable[[dict[str, Path], Path, dict, dict], None]
+
+class Stage:
+    """
+    A step of the pipeline. run reads the output folders of the stages in inputs
+    and writes its results to the output folder it is given.
+    params change the results and are part of the output key, settings (paths, credentials, workers) are not.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            run: StageFunction,
+            inputs: list[str] = [],
+            params: dict = {},
+            version: int = 1
+            ) -> None:
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.params = dict(params)
+        # Bump when the code of the stage changes what it writes
+        self.version = version
+
+def hashFolder(folder: Path) -> str:
+    """
+    Hash of the names and contents of the files in the folder, the stage record is left out.
+    """
+    digest = sha256()
+    for path in sorted(folder.rglob('*')):
+        if not path.is_file() or path.name == stageRecordName:
+            continue
+        digest.update(str(path.relative_to(folder)).encode('utf-8') + b'\x00')
+        with path.open('rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def runStage(
+        stage: Stage,
+        inputs: dict[str, Path],
+        output: Path,
+        settings: dict
+        ) -> dict:
+    # Run in a process of its own, the peak RSS of the process is the peak of the stage
+    start = perf_counter()
+    exporter = None
+    if settings.get('metricsFolder'):
+        # Outside the output folder so the metrics don't change the output hash
+        from data.query.metrics import MetricsExporter
+        exporter = MetricsExporter(str(Path(settings['metricsFolder']) / f"{stage.name}.prom")).start()
+    try:
+        stage.run(inputs, output, stage.params, settings)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+    return {
+            'seconds': perf_counter() - start,
+            # ru_maxrss is in kilobytes on linux
+            'peakRSSMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'outputHash': hashFolder(output)
+            }
+
+class Pipeline:
+    """
+    Stages by name, run in the order of their inputs.
+    The output of a stage is in workFolder/<stage>/<key> where key hashes the stage name, version,
+    params and the output hashes of the input stages. A folder with a stage record is a finished run.
+    """
+
+    def __init__(self, stages: list[Stage], workFolder: str = defaultWorkFolder) -> None:
+        self.stages = {stage.name: stage for stage in stages}
+        self.workFolder = Path(workFolder)
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError(f"Stage {stage.name} reads {name} which is not a stage")
+        self.order = self._sortStages()
+
+    def _sortStages(self) -> list[str]:
+        order: list[str] = []
+        visiting: set[str] = set()
+
+        def visit(name: str) -> None:
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} depends on itself")
+            visiting.add(name)
+            for inputName in self.stages[name].inputs:
+                visit(inputName)
+            visiting.remove(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def stageKey(self, stage: Stage, inputHashes: dict[str, str]) -> str:
+        keyed = {
+                'stage': stage.name,
+                'version': stage.version,
+                'params': stage.params,
+                'inputs': {name: inputHashes[name] for name in stage.inputs}
+                }
+        return sha256(jsondumps(keyed, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def outputFolder(self, stage: Stage, key: str) -> Path:
+        return self.workFolder / stage.name / key
+
+    def loadRecord(self, stage: Stage, key: str) -> Optional[dict]:
+        path = self.outputFolder(stage, key) / stageRecordName
+        if not path.exists():
+            return None
+        return jsonloads(path.read_text(encoding='utf8'))
+
+    def run(
+            self,
+            settings: dict = {},
+            jobs: int = 1,
+            force: set[str] = set(),
+            until: Optional[str] = None
+            ) -> dict[str, dict]:
+        """
+        Runs the stages that have no finished output for their key, up to jobs at a time.
+        Stages in force are run even if they have. With until only that stage and the stages it reads are run.
+        Returns the records of the stages, skipped ones have skipped set.
+        """
+        wanted = set(self.order)
+        if until is not None:
+            wanted = set()
+            pendingNames = [until]
+            while pendingNames:
+                name = pendingNames.pop()
+                if name not in wanted:
+                    wanted.add(name)
+                    pendingNames.extend(self.stages[name].inputs)
+
+        outputHashes: dict[str, str] = {}
+        records: dict[str, dict] = {}
+        waiting = [name for name in self.order if name in wanted]
+        running: dict[Future, tuple[Stage, str, ProcessPoolExecutor]] = {}
+        try:
+            while waiting or running:
+                for name in list(waiting):
+                    if len(running) >= max(1, jobs):
+                        break
+                    stage = self.stages[name]
+                    if any(inputName not in outputHashes for inputName in stage.inputs):
+                        continue
+                    waiting.remove(name)
+                    key = self.stageKey(stage, outputHashes)
+                    record = self.loadRecord(stage, key)
+                    if record is not None and name not in force:
+                        print(f"{name}: unchanged ({key})")
+                        outputHashes[name] = record['outputHash']
+                        records[name] = {**record, 'skipped': True}
+                        continue
+
+                    output = self.outputFolder(stage, key)
+                    if output.exists():
+                        # Left over from a failed or forced run
+                        rmtree(output)
+                    output.mkdir(parents=True)
+                    inputs = {inputName: self.outputFolder(self.stages[inputName], records[inputName]['key']) for inputName in stage.inputs}
+                    print(f"{name}: running ({key})")
+                    # A fresh process per stage so the memory of one stage doesn't show in the next,
+                    # a single use executor instead of max_tasks_per_child which needs Python 3.11
+                    executor = ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn'))
+                    running[executor.submit(runStage, stage, inputs, output, settings)] = (stage, key, executor)
+
+                if not running:
+                    if waiting:
+                        # Only possible when a stage reads a stage that was not wanted
+                        raise ValueError(f"Stages {waiting} can't be run")
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, key, executor = running.pop(future)
+                    executor.shutdown()
+                    result = future.result()
+                    record = {
+                            'stage': stage.name,
+                            'key': key,
+                            'params': stage.params,
+                            'inputs': {name: records[name]['key'] for name in stage.inputs},
+                            'finished': datetime.now(timezone.utc).isoformat(),
+                            **result
+                            }
+                    (self.outputFolder(stage, key) / stageRecordName).write_text(jsondumps(record, indent=2), encoding='utf8')
+                    outputHashes[stage.name] = result['outputHash']
+                    records[stage.name] = {**record, 'skipped': False}
+                    print(f"{stage.name}: done in {result['seconds']:.1f}s, peak {result['peakRSSMB']:.0f} MB")
+        finally:
+            # The stages still running when one fails are waited for like the pool did before
+            for _, _, executor in running.values():
+                executor.shutdown()
+        return records
+
+    def status(self) -> list[dict]:
+        """
+        Latest finished run of every stage.
+        """
+        latest: list[dict] = []
+        for name in self.order:
+            folder = self.workFolder / name
+            stageRecords = [jsonloads(path.read_text(encoding='utf8')) for path in folder.glob(f"*/{stageRecordName}")]
+            if stageRecords:
+                latest.append(max(stageRecords, key=lambda record: record['finished']))
+        return latest
+
+# The stages of the data flow, module level so the spawned processes can import them
+
+def downloadStage(inputs: dict[str, Path], output: Path, params: dict, settings: dict) -> None:
+    from data.query.billboard import downloadBillboardData
+
+    downloadBillboardData(params['datasetName'], str(output) + '/', settings['credentialsPath'])
+
+@contextmanager
+def spotifyAPI(settings: dict) -> Generator:
+    """
+    The api of a stage, the response cache is closed (and its last writes committed) when the stage is done.
+    """
+    from data.query.cache import CachedSpotify
+    from data.query.util import initializeSpotifyAPI
+    from data.query.transport import HttpTransport
+
+    # A kept connection for every worker so none of the calls in flight has to connect again
+    transport = HttpTransport(
+            poolSize=max(16, settings.get('workers', 4)),
+            readTimeout=settings.get('readTimeout', 10.0),
+            statusForcelist=(500, 502, 503, 504)
+            )
+    api = initializeSpotifyAPI(
+            settings['credentialsPath'],
+            rateLimited=True,
+            cachePath=settings.get('cachePath'),
+            pooled=settings.get('pooled', False),
+            transport=transport
+            )
+    try:
+        yield api
+    finally:
+        if isinstance(api, CachedSpotify):
+            api.close()
+
+def matchStage(inputs: dict[str, Path], output: Path, params: dict, settings: dict) -> None:
+    from data.query.billboard import getBillboardData
+    from data.query.spotify_api import getSpotifyDataFromBillboardSongsV2
+
+    chartsZip = next(inputs['download'].glob('*.zip'))
+    with spotifyAPI(settings) as api:
+        getSpotifyDataFromBillboardSongsV2(
+                api,
+                getBillboardData(str(chartsZip)),
+                str(output / 'hit_song_info.json'),
+                workers=settings.get('workers', 1),
+                matchRules=[(name, useArtistInQuery, ratio) for name, useArtistInQuery, ratio in params['matchRules']]
+                )
+
+def hitFeaturesStage(inputs: dict[str, Path], output: Path, params: dict, settings: dict) -> None:
+    from data.query.util import loadJson
+    from data.query.spotify_api import getSpotifyAudioFeaturesV2
+
+    with spotifyAPI(settings) as api:
+        getSpotifyAudioFeaturesV2(
+                api,
+                loadJson(str(inputs['match'] / 'hit_song_info.json')),
+                str(output / 'hit_song_features.json'),
+                workers=settings.get('workers', 4)
+                )
+
+def notHitsStage(inputs: dict[str, Path], output: Path, params: dict, settings: dict) -> None:
+    from data.query.util import loadJson
+    from data.query.spotify_api import getSongsWithAlbumsV2
+
+    with spotifyAPI(settings) as api:
+        getSongsWithAlbumsV2(
+                api,
+                loadJson(str(inputs['match'] / 'hit_song_info.json')),
+                str(output / 'not_hit_song_info.json'),
+                str(output / 'not_hit_song_features.json'),
+                params['albumSampleSize'],
+                seed=params['seed']
+                )
+
+def cleanStage(inputs: dict[str, Path], output: Path, params: dict, settings: dict) -> None:
+    from data.query.util import loadJson, saveJson
+
+    def hasFeatures(song: dict) -> bool:
+        # Songs without features or with only zeros are left out
+        return bool(song['features']) and not all(value == 0 for value in song['features'].values())
+
+    hits = [hit for hit in loadJson(str(inputs['hitFeatures'] / 'hit_song_features.json')).values() if hasFeatures(hit)]
+    hitIDs = {hit['info']['spotifyData']['songID'] for hit in hits}
+    notHits = [
+            notHit for notHit in loadJson(str(inputs['notHits'] / 'not_hit_song_features.json')).values()
+            if hasFeatures(notHit) and notHit['info']['spotifyData']['songID'] not in hitIDs
+            ]
+    print(f"Hit songs: {len(hits)} Not hit songs: {len(notHits)}")
+    saveJson(hits, str(output / 'hit_song.json'))
+    saveJson(notHits, str(output / 'not_hit_song.json'))
+
+def sampleStage(inputs: dict[str, Path], output: Path, params: dict, settings: dict) -> None:
+    import numpy
+    from pandas import DataFrame
+    from data.process.features import loadFeatureMatrix, modelFeatureNames
+    from data.process.balance import sampleByYears
+
+    x, y, ids = loadFeatureMatrix(str(inputs['clean'] / 'hit_song.json'), str(inputs['clean'] / 'not_hit_song.json'))
+    frame = DataFrame({'year': x[:, modelFeatureNames.index('releaseYear')].astype(int)})
+    isHit = y == 1
+    hitRows, notHitRows = numpy.flatnonzero(isHit), numpy.flatnonzero(~isHit)
+    hitSample, notHitSample = sampleByYears(
+            frame.iloc[hitRows],
+            frame.iloc[notHitRows],
+            params['sampleSize'],
+            params['earliest'],
+            params['latest'],
+            params['strata'],
+            params['seed'],
+            indexOnly=True
+            )
+    rows = numpy.concatenate([hitRows[hitSample], notHitRows[notHitSample]])
+    with open(output / 'sample.npz', 'wb') as f:
+        numpy.savez(f, x=x[rows], y=y[rows], ids=numpy.array(ids, dtype=str)[rows])
+
+def splitStage(inputs: dict[str, Path], output: Path, params: dict, settings: dict) -> None:
+    import numpy
+    from data.process.dataset import ShardedDataset
+    from data.process.statistics import datasetStatistics
+
+    with numpy.load(inputs['sample'] / 'sample.npz') as sample:
+        ShardedDataset.create(
+                str(output / 'dataset'),
+                sample['x'],
+                sample['y'],
+                sample['ids'].tolist(),
+                params['shardBy'],
+                params['splits'],
+                params['seed']
+                )
+    datasetStatistics(str(output / 'dataset'))
+
+def createDataPipeline(workFolder: str = defaultWorkFolder, params: dict[str, dict] = {}) -> Pipeline:
+    """
+    The flow of the notebooks: download, match, features, not hits from albums, clean, sample and split.
+    params override the default params of the stages by stage name.
+    """
+    defaults: dict[str, dict] = {
+            'download': {'datasetName': 'dhruvildave/billboard-the-hot-100-songs'},
+            # The rules as json lists so they can be given with --param match.matchRules=[["exact", false, 100], ...]
+            'match': {'matchRules': [list(rule) for rule in defaultMatchRules]},
+            'hitFeatures': {},
+            'notHits': {'albumSampleSize': 5, 'seed': 0},
+            'clean': {},
+            'sample': {'sampleSize': 192, 'earliest': 1965, 'latest': 2021, 'strata': 'year', 'seed': 0},
+            'split': {'shardBy': 'decade', 'splits': {'train': 0.8, 'validation': 0.1, 'test': 0.1}, 'seed': 0}
+            }
+
+    def stageParams(name: str) -> dict:
+        return {**defaults[name], **params.get(name, {})}
+
+    return Pipeline([
+        Stage('download', downloadStage, [], stageParams('download')),
+        Stage('match', matchStage, ['download'], stageParams('match')),
+        Stage('hitFeatures', hitFeaturesStage, ['match'], stageParams('hitFeatures')),
+        Stage('notHits', notHitsStage, ['match'], stageParams('notHits')),
+        Stage('clean', cleanStage, ['hitFeatures', 'notHits'], stageParams('clean')),
+        Stage('sample', sampleStage, ['clean'], stageParams('sample')),
+        Stage('split', splitStage, ['sample'], stageParams('split'))
+        ], workFolder)
+
+def parseParams(assignments: list[str]) -> dict[str, dict]:
+    # stage.name=value, the value is read as json when it can be (numbers, lists, objects)
+    params: dict[str, dict] = {}
+    for assignment in assignments:
+        target, value = assignment.split('=', 1)
+        stageName, paramName = target.split('.', 1)
+        parsed: Any
+        try:
+            parsed = jsonloads(value)
+        except ValueError:
+            parsed = value
+        params.setdefault(stageName, {})[paramName] = parsed
+    return params
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('command', choices=['run', 'status'])
+    parser.add_argument('--work', default=defaultWorkFolder, help='Folder of the stage outputs')
+    parser.add_argument('--credentials', default='config/env.ini')
+    parser.add_argument('--cache', default=None, help='Api response cache file')
+    parser.add_argument('--pooled', action='store_true', help='Spread the api calls over every SPOTIFY credential section')
+    parser.add_argument('--metrics', default=None, help='Folder the metrics of the running stages are saved to as <stage>.prom')
+    parser.add_argument('--workers', type=int, default=4, help='Api calls in flight in a stage')
+    parser.add_argument('--read-timeout', type=float, default=10.0, help='Seconds to wait for an api response')
+    parser.add_argument('--jobs', type=int, default=2, help='Stages run at the same time')
+    parser.add_argument('--param', action='append', default=[], help='stage.name=value, for example sample.sampleSize=192')
+    parser.add_argument('--force', action='append', default=[], help='Run the stage even if it is unchanged')
+    parser.add_argument('--until', default=None, help='Run only this stage and the stages before it')
+    args = parser.parse_args()
+
+    pipeline = createDataPipeline(args.work, parseParams(args.param))
+    if args.command == 'status':
+        for record in pipeline.status():
+            print(f"{record['stage']:<12} {record['key']} {record['finished']} {record['seconds']:.1f}s {record['peakRSSMB']:.0f} MB")
+        return
+
+    settings = {
+            'credentialsPath': args.credentials,
+            'cachePath': args.cache,
+            'workers': args.workers,
+            'readTimeout': args.read_timeout,
+            'pooled': args.pooled,
+            'metricsFolder': args.metrics
+            }
+    records = pipeline.run(settings, args.jobs, set(args.force), args.until)
+    for name, record in records.items():
+        state = 'skipped' if record['skipped'] else f"{record['seconds']:.1f}s {record['peakRSSMB']:.0f} MB"
+        print(f"{name:<12} {record['key']} {state}")
+
+if __name__ == '__main__':
+    main()
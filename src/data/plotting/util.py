@@ -1,6 +1,6 @@
-from matplotlib import pyplot as plt
-
 def makeHistogram(labels, data):
+    from matplotlib import pyplot as plt
+
     plt.bar(labels, data)
     plt.xticks(range(1, len(labels)))
     plt.show()
@@ -1,36 +1,75 @@
-from typing import Tuple
-from pandas import concat, DataFrame
+from typing import TYPE_CHECKING, Literal, Optional, Union
+
+import numpy
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+def yearsInRange(years: numpy.ndarray, earliest: int, latest: int) -> numpy.ndarray:
+    """
+    Mask of the years between earliest and latest.
+    With two digit years the range can go over the century, 65 to 21 is 1965 - 2021.
+    """
+    if earliest <= latest:
+        return (years >= earliest) & (years <= latest)
+    return (years >= earliest) | (years <= latest)
+
+def groupRowsByStrata(
+        frame: 'DataFrame',
+        earliest: int,
+        latest: int,
+        strata: Literal['year', 'decade'],
+        yearColumn: str
+        ) -> dict[int, numpy.ndarray]:
+    """
+    Positions of the rows of every year or decade in the range, the strata in order.
+    """
+    years = frame[yearColumn].to_numpy().astype(int)
+    positions = numpy.flatnonzero(yearsInRange(years, earliest, latest))
+    keys = years[positions]
+    if strata == 'decade':
+        keys = keys // 10 * 10
+    # One stable sort groups the rows, no mask per stratum
+    order = numpy.argsort(keys, kind='stable')
+    uniqueKeys, starts = numpy.unique(keys[order], return_index=True)
+    return dict(zip(uniqueKeys.tolist(), numpy.split(positions[order], starts[1:])))
 
 def sampleByYears(
-    hits: DataFrame,
-    nonHits: DataFrame,
+    hits: 'DataFrame',
+    nonHits: 'DataFrame',
     sampleSize: int,
     earliest: int,
-    latest: int
-    ) -> List[Optional[Any]]:
-
-    hitSamples = None
-    nonHitSamples = None
-    count = 0
-    # Loop all years that the dataset has
-    for year in hits['year'].unique():
-        
-        # Check the processed year is outside the range of wanted years skip it
-        if int(year) < earliest and int(year) > latest:
-            continue
-        
-        # Take all songs by year
-        allHitsInYear = hits[hits['year'] == year]
-        allNotHitsInYear = nonHits[nonHits['year'] == year]
-    
-        # Take the samples
-        hitSample = allHitsInYear.sample(sampleSize)
-        notHitSample = allNotHitsInYear.sample(sampleSize)
-    
-        def addToDataset(samples: pandasSample, dataset: pandasSample) -> DataFrame:
-            return concat([samples, dataset], ignore_index=True)
-        
-        hitSamples = hitSample if hitSamples is None else addToDataset(hitSamples, hitSample)
-        notHitSamples = notHitSample if notHitSamples is None else addToDataset(notHitSamples, notHitSample)
-    
-    return [hitSamples, notHitSamples]
+    latest: int,
+    strata: Literal['year', 'decade'] = 'year',
+    seed: Optional[int] = None,
+    indexOnly: bool = False,
+    yearColumn: str = 'year'
+    ) -> list[Union['DataFrame', numpy.ndarray]]:
+    """
+    Takes sampleSize random hits and not hits from every year (or decade) of the hits
+    that is between earliest and latest, the strata in order.
+    Returns the sampled hits and not hits, with indexOnly the positions of the sampled rows
+    in hits and nonHits instead of the rows.
+    """
+    rng = numpy.random.default_rng(seed)
+    hitGroups = groupRowsByStrata(hits, earliest, latest, strata, yearColumn)
+    nonHitGroups = groupRowsByStrata(nonHits, earliest, latest, strata, yearColumn)
+
+    hitSamples: list[numpy.ndarray] = []
+    nonHitSamples: list[numpy.ndarray] = []
+    for key, hitRows in hitGroups.items():
+        nonHitRows = nonHitGroups.get(key, numpy.empty(0, dtype=int))
+        if len(hitRows) < sampleSize or len(nonHitRows) < sampleSize:
+            raise ValueError(
+                    f"Not enough songs in {key} for a sample of {sampleSize}: "
+                    f"{len(hitRows)} hits and {len(nonHitRows)} not hits"
+                    )
+        hitSamples.append(rng.choice(hitRows, sampleSize, replace=False))
+        nonHitSamples.append(rng.choice(nonHitRows, sampleSize, replace=False))
+
+    hitIndexes = numpy.concatenate(hitSamples) if len(hitSamples) > 0 else numpy.empty(0, dtype=int)
+    nonHitIndexes = numpy.concatenate(nonHitSamples) if len(nonHitSamples) > 0 else numpy.empty(0, dtype=int)
+    if indexOnly:
+        return [hitIndexes, nonHitIndexes]
+
+    return [hits.iloc[hitIndexes].reset_index(drop=True), nonHits.iloc[nonHitIndexes].reset_index(drop=True)]
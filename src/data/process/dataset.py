@@ -0,0 +1,226 @@
+from typing import Generator, Iterable, Literal, Optional
+from hashlib import sha256
+from pathlib import Path
+
+import numpy
+
+from data.types.process import DatasetManifest, DatasetShard
+from data.query.util import loadJson, saveJsonAtomic
+from .features import modelFeatureNames
+from .statistics import statisticsName
+
+manifestName = 'manifest.json'
+defaultSplits: dict[str, float] = {'train': 0.8, 'validation': 0.1, 'test': 0.1}
+# Features, labels and song ids of the rows in a part
+DatasetArrays = tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+
+def shardKeys(
+        years: numpy.ndarray,
+        shardBy: Literal['decade', 'year']
+        ) -> numpy.ndarray:
+    """
+    Shard of every row from its release year, 1994 is '1990' by decade and '1994' by year.
+    """
+    keys = numpy.full(len(years), 'unknown', dtype=object)
+    known = ~numpy.isnan(years)
+    years = years[known].astype('int32')
+    if shardBy == 'decade':
+        years = years // 10 * 10
+    keys[known] = years.astype(str)
+    return keys
+
+def splitOfRows(ids: numpy.ndarray, splits: dict[str, float], seed: int) -> numpy.ndarray:
+    """
+    Index of the split of every row in the order of splits, from a hash of the seed and the song id
+    against the cumulative fractions of the splits. The rows past the fractions get len(splits).
+    """
+    positions = numpy.array(
+            [int.from_bytes(sha256(f"{seed}:{sid}".encode('utf-8')).digest()[:8], 'big') for sid in ids.tolist()],
+            dtype=numpy.float64
+            ) / 2.0**64
+    return numpy.searchsorted(numpy.cumsum(list(splits.values())), positions, side='right')
+
+def splitRanges(rows: int, splits: dict[str, float]) -> dict[str, tuple[int, int]]:
+    """
+    Row range of every split in a part written before the ranges were recorded in the manifest,
+    the splits take contiguous rows in the order of splits.
+    """
+    ranges: dict[str, tuple[int, int]] = {}
+    start = 0
+    total = 0.0
+    for name, fraction in splits.items():
+        total += fraction
+        end = rows if total >= 1.0 else min(rows, int(round(total * rows)))
+        ranges[name] = (start, end)
+        start = end
+    return ranges
+
+class ShardedDataset:
+    """
+    Feature matrix, labels and song ids on disk, sharded by release decade or year.
+    Every shard is made of parts written as .npy files that are opened memory mapped,
+    so opening reads only the manifest and slicing a split out of a part doesn't copy.
+    Every row gets its split from a hash of its song id (splitOfRows), so the fractions of the splits hold
+    also over many small appended parts. The rows of a part are shuffled and ordered by split when written,
+    every split is a contiguous range of rows in every part.
+    Appending writes new parts, the existing parts and the splits of their rows don't change.
+    """
+
+    def __init__(self, path: str, manifest: DatasetManifest) -> None:
+        self.path = Path(path)
+        self.manifest = manifest
+        self.opened: dict[str, DatasetArrays] = {}
+
+    @classmethod
+    def create(
+            cls,
+            path: str,
+            x: numpy.ndarray,
+            y: numpy.ndarray,
+            ids: list[str],
+            shardBy: Literal['decade', 'year'] = 'decade',
+            splits: dict[str, float] = defaultSplits,
+            seed: int = 0
+            ) -> 'ShardedDataset':
+        """
+        Writes a new dataset to the path folder, a dataset already in the folder is replaced.
+        x has the columns of modelFeatureNames, see features.buildFeatureMatrix.
+        """
+        folder = Path(path)
+        folder.mkdir(parents=True, exist_ok=True)
+        manifestPath = folder / manifestName
+        if manifestPath.exists():
+            # Remove the parts of the old dataset so they don't get mixed with the new ones
+            for shard in loadJson(str(manifestPath))['shards'].values():
+                for part in shard['parts']:
+                    for suffix in ('x', 'y', 'ids'):
+                        (folder / f"{part['name']}.{suffix}.npy").unlink(missing_ok=True)
+            # The new parts get the same names, the statistics of the old ones must not be used for them
+            (folder / statisticsName).unlink(missing_ok=True)
+
+        manifest: DatasetManifest = {
+                'version': 1,
+                'columns': modelFeatureNames,
+                'dtype': 'float32',
+                'shardBy': shardBy,
+                'splits': dict(splits),
+                'seed': seed,
+                'rows': 0,
+                'shards': {}
+                }
+        dataset = cls(path, manifest)
+        dataset.append(x, y, ids)
+        return dataset
+
+    @classmethod
+    def open(cls, path: str) -> 'ShardedDataset':
+        return cls(path, loadJson(str(Path(path) / manifestName)))
+
+    def __len__(self) -> int:
+        return self.manifest['rows']
+
+    @property
+    def shards(self) -> list[str]:
+        return sorted(self.manifest['shards'].keys())
+
+    def append(
+            self,
+            x: numpy.ndarray,
+            y: numpy.ndarray,
+            ids: list[str]
+            ) -> None:
+        """
+        Adds the rows as a new part to each of their shards and saves the manifest.
+        """
+        if x.shape[1:] != (len(self.manifest['columns']),):
+            raise ValueError(f"Expected {len(self.manifest['columns'])} columns, got {x.shape[1:]}")
+        if not len(x) == len(y) == len(ids):
+            raise ValueError(f"Different number of rows in x ({len(x)}), y ({len(y)}) and ids ({len(ids)})")
+
+        idArray = numpy.array(ids, dtype=str)
+        keys = shardKeys(x[:, self.manifest['columns'].index('releaseYear')], self.manifest['shardBy'])
+        # Every part is shuffled with a generator from the seed and the part name
+        for key in sorted(set(keys.tolist())):
+            rows = numpy.flatnonzero(keys == key)
+            shard: DatasetShard = self.manifest['shards'].setdefault(key, {'rows': 0, 'parts': []})
+            name = f"{key}-{len(shard['parts']):04d}"
+            rng = numpy.random.default_rng([self.manifest['seed'], *name.encode('utf-8')])
+            rows = rows[rng.permutation(len(rows))]
+            # Stable sort so the rows of every split stay shuffled
+            splitIndex = splitOfRows(idArray[rows], self.manifest['splits'], self.manifest['seed'])
+            order = numpy.argsort(splitIndex, kind='stable')
+            rows = rows[order]
+            ends = numpy.cumsum(numpy.bincount(splitIndex, minlength=len(self.manifest['splits']) + 1)).tolist()
+            starts = [0] + ends[:-1]
+            splits = {splitName: [starts[i], ends[i]] for i, splitName in enumerate(self.manifest['splits'].keys())}
+            partArrays = {
+                    'x': numpy.ascontiguousarray(x[rows], dtype=self.manifest['dtype']),
+                    'y': numpy.ascontiguousarray(y[rows], dtype=self.manifest['dtype']),
+                    'ids': idArray[rows]
+                    }
+            # The content hash tells the cached statistics of the part (statistics.datasetStatistics) are still right
+            digest = sha256()
+            for suffix, array in partArrays.items():
+                numpy.save(self.path / f"{name}.{suffix}.npy", array)
+                digest.update(array.tobytes())
+            shard['parts'].append({'name': name, 'rows': len(rows), 'sha256': digest.hexdigest(), 'splits': splits})
+            shard['rows'] += len(rows)
+            self.manifest['rows'] += len(rows)
+
+        # The manifest is written last, a failed append leaves only unlisted part files behind
+        saveJsonAtomic(self.manifest, str(self.path / manifestName))
+
+    def part(self, name: str) -> DatasetArrays:
+        """
+        Memory mapped arrays of a part, opened on the first use.
+        """
+        arrays = self.opened.get(name)
+        if arrays is None:
+            arrays = tuple(
+                    numpy.load(self.path / f"{name}.{suffix}.npy", mmap_mode='r')
+                    for suffix in ('x', 'y', 'ids')
+                    )
+            self.opened[name] = arrays
+        return arrays
+
+    def parts(self, shards: Optional[Iterable[str]] = None) -> Generator[tuple[str, DatasetArrays], None, None]:
+        for key in (self.shards if shards is None else shards):
+            for part in self.manifest['shards'][key]['parts']:
+                yield part['name'], self.part(part['name'])
+
+    def split(
+            self,
+            name: str,
+            shards: Optional[Iterable[str]] = None
+            ) -> list[DatasetArrays]:
+        """
+        The rows of the split in every part as views to the memory mapped arrays, nothing is read yet.
+        """
+        views: list[DatasetArrays] = []
+        for key in (self.shards if shards is None else shards):
+            for part in self.manifest['shards'][key]['parts']:
+                x, y, ids = self.part(part['name'])
+                ranges = part['splits'] if 'splits' in part else splitRanges(len(x), self.manifest['splits'])
+                start, end = ranges[name]
+                if end > start:
+                    views.append((x[start:end], y[start:end], ids[start:end]))
+        return views
+
+    def load(
+            self,
+            name: Optional[str] = None,
+            shards: Optional[Iterable[str]] = None
+            ) -> DatasetArrays:
+        """
+        A split (or all rows without name) read into memory as single arrays.
+        """
+        columns = len(self.manifest['columns'])
+        views = self.split(name, shards) if name is not None else [arrays for _, arrays in self.parts(shards)]
+        if len(views) == 0:
+            return (
+                    numpy.empty((0, columns), dtype=self.manifest['dtype']),
+                    numpy.empty(0, dtype=self.manifest['dtype']),
+                    numpy.empty(0, dtype=str)
+                    )
+        x, y, ids = (numpy.concatenate([view[i] for view in views]) for i in range(3))
+        return x, y, ids
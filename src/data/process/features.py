@@ -0,0 +1,78 @@
+from typing import Optional, Union
+from collections.abc import Mapping
+from itertools import chain
+from operator import itemgetter
+
+import numpy
+
+from data.types.process import ModelFeatures
+from data.types.spotify import SpotifySongData
+
+# Columns of the feature matrix, the audio features and releaseYear as the last one
+modelFeatureNames: list[str] = list(ModelFeatures.__annotations__)
+audioFeatureNames: list[str] = modelFeatureNames[:-1]
+
+def parseReleaseYears(releaseDates: list[str]) -> numpy.ndarray:
+    """
+    Release years of the dates (YYYY, YYYY-MM or YYYY-MM-DD) as float32, NaN where the date has no year.
+    Same as parseYearFromDate for the whole column at once.
+    """
+    dates = numpy.array(releaseDates, dtype=str)
+    if len(dates) == 0:
+        return numpy.empty(0, dtype='float32')
+    # The first 5 characters as unicode code points, the year has to be 4 digits followed by '-' or nothing
+    codes = dates.astype('U5').view('uint32').reshape(-1, 5)
+    digits = codes[:, :4].astype('int32') - ord('0')
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1) & ((codes[:, 4] == 0) | (codes[:, 4] == ord('-')))
+    parsed = numpy.full(len(dates), numpy.nan, dtype='float32')
+    parsed[valid] = digits[valid] @ numpy.array([1000, 100, 10, 1], dtype='int32')
+    return parsed
+
+def buildFeatureMatrix(
+        songs: Union[list[SpotifySongData], Mapping[str, SpotifySongData]],
+        label: Optional[int] = None
+        ) -> tuple[numpy.ndarray, numpy.ndarray, list[str]]:
+    """
+    Turns stored songs to a float32 matrix with the columns of modelFeatureNames,
+    a float32 label vector and the song ids of the rows.
+    label is used for every song, without it the label is taken from the labels of the song.
+    Songs without all the audio features or without a release year are left out.
+    """
+    if isinstance(songs, Mapping):
+        songs = list(songs.values())
+
+    complete = [song for song in songs if len(song['features']) == len(audioFeatureNames)]
+    # All the audio features in one flat run, no matrix is made per song
+    getFeatures = itemgetter(*audioFeatureNames)
+    values = numpy.fromiter(
+            chain.from_iterable(getFeatures(song['features']) for song in complete),
+            dtype='float32',
+            count=len(complete) * len(audioFeatureNames)
+            )
+    years = parseReleaseYears([song['info']['spotifyData']['album']['releaseDate'] for song in complete])
+    hasYear = ~numpy.isnan(years)
+    rows = int(hasYear.sum())
+
+    x = numpy.empty((rows, len(modelFeatureNames)), dtype='float32')
+    x[:, :-1] = values.reshape(len(complete), len(audioFeatureNames))[hasYear]
+    x[:, -1] = years[hasYear]
+    keep = numpy.flatnonzero(hasYear).tolist()
+    if label is not None:
+        y = numpy.full(rows, label, dtype='float32')
+    else:
+        y = numpy.array([complete[i]['labels']['hit'] for i in keep], dtype='float32')
+    ids = [complete[i]['info']['spotifyData']['songID'] for i in keep]
+    return x, y, ids
+
+def loadFeatureMatrix(
+        hitsPath: str,
+        notHitsPath: str
+        ) -> tuple[numpy.ndarray, numpy.ndarray, list[str]]:
+    """
+    Features of the stored hits (label 1) and not hits (label 0) files as one matrix, hits first.
+    """
+    from data.query.util import loadJson
+
+    hitX, hitY, hitIDs = buildFeatureMatrix(loadJson(hitsPath), 1)
+    notHitX, notHitY, notHitIDs = buildFeatureMatrix(loadJson(notHitsPath), 0)
+    return numpy.concatenate([hitX, notHitX]), numpy.concatenate([hitY, notHitY]), hitIDs + notHitIDs
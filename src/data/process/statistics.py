@@ -0,0 +1,291 @@
+from typing import Iterable, Optional
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+import numpy
+
+from data.types.spotify import SpotifySongData
+from data.query.util import loadJson, saveJsonAtomic
+from .features import buildFeatureMatrix, modelFeatureNames
+
+statisticsName = 'statistics.json'
+# Histogram ranges of the model features, the values outside are counted as under or overflow
+featureRanges: dict[str, tuple[float, float]] = {
+        'timeSignature': (0, 8),
+        'durationMS': (0, 1200000),
+        'key': (-1, 12),
+        'mode': (0, 2),
+        'acousticness': (0, 1),
+        'danceability': (0, 1),
+        'energy': (0, 1),
+        'instrumentalness': (0, 1),
+        'liveness': (0, 1),
+        'loudness': (-60, 5),
+        'speechiness': (0, 1),
+        'valence': (0, 1),
+        'tempo': (0, 250),
+        'releaseYear': (1900, 2030)
+        }
+
+class RunningStatistics:
+    """
+    Count, min, max and the central moments up to the fourth of every column,
+    updated a batch of rows at a time and merged with the formulas of Pébay
+    so the statistics of separate parts (or processes) combine to the statistics of all the rows.
+    Every column also has a histogram of bins fixed bins over its range in featureRanges.
+    NaN values are not counted.
+    """
+
+    def __init__(
+            self,
+            columns: list[str] = modelFeatureNames,
+            bins: int = 32,
+            ranges: dict[str, tuple[float, float]] = featureRanges
+            ) -> None:
+        self.columns = list(columns)
+        self.bins = bins
+        self.ranges = {column: tuple(ranges[column]) for column in self.columns}
+        size = len(self.columns)
+        self.count = numpy.zeros(size, dtype='int64')
+        self.min = numpy.full(size, numpy.inf)
+        self.max = numpy.full(size, -numpy.inf)
+        self.mean = numpy.zeros(size)
+        self.m2 = numpy.zeros(size)
+        self.m3 = numpy.zeros(size)
+        self.m4 = numpy.zeros(size)
+        self.histograms = numpy.zeros((size, bins), dtype='int64')
+        # Values under and over the histogram range
+        self.outside = numpy.zeros((size, 2), dtype='int64')
+
+    def _combine(
+            self,
+            count: numpy.ndarray,
+            mean: numpy.ndarray,
+            m2: numpy.ndarray,
+            m3: numpy.ndarray,
+            m4: numpy.ndarray
+            ) -> None:
+        nA = self.count.astype('float64')
+        nB = count.astype('float64')
+        n = nA + nB
+        safeN = numpy.where(n > 0, n, 1.0)
+        delta = mean - self.mean
+        deltaN = delta / safeN
+        self.m4 = (
+                self.m4 + m4
+                + delta * deltaN ** 3 * nA * nB * (nA * nA - nA * nB + nB * nB)
+                + 6 * deltaN ** 2 * (nA * nA * m2 + nB * nB * self.m2)
+                + 4 * deltaN * (nA * m3 - nB * self.m3)
+                )
+        self.m3 = (
+                self.m3 + m3
+                + delta * deltaN ** 2 * nA * nB * (nA - nB)
+                + 3 * deltaN * (nA * m2 - nB * self.m2)
+                )
+        self.m2 = self.m2 + m2 + delta * deltaN * nA * nB
+        self.mean = self.mean + nB * deltaN
+        self.count = self.count + count
+
+    def update(self, rows: numpy.ndarray) -> None:
+        """
+        Adds a batch of rows, the moments of the batch are computed with numpy and merged in.
+        """
+        rows = numpy.asarray(rows, dtype='float64')
+        if len(rows) == 0:
+            return
+        known = ~numpy.isnan(rows)
+        count = known.sum(axis=0)
+        safeCount = numpy.where(count > 0, count, 1)
+        mean = numpy.where(known, rows, 0.0).sum(axis=0) / safeCount
+        centered = numpy.where(known, rows - mean, 0.0)
+        squared = centered * centered
+        self._combine(
+                count,
+                mean,
+                squared.sum(axis=0),
+                (squared * centered).sum(axis=0),
+                (squared * squared).sum(axis=0)
+                )
+        self.min = numpy.fmin(self.min, numpy.nanmin(numpy.where(known, rows, numpy.inf), axis=0))
+        self.max = numpy.fmax(self.max, numpy.nanmax(numpy.where(known, rows, -numpy.inf), axis=0))
+
+        for i, column in enumerate(self.columns):
+            low, high = self.ranges[column]
+            values = rows[known[:, i], i]
+            self.histograms[i] += numpy.histogram(values, self.bins, (low, high))[0]
+            self.outside[i, 0] += int((values < low).sum())
+            self.outside[i, 1] += int((values > high).sum())
+
+    def merge(self, other: 'RunningStatistics') -> 'RunningStatistics':
+        """
+        Adds the statistics of other to these, the columns and histogram bins have to be the same.
+        """
+        if other.columns != self.columns or other.bins != self.bins or other.ranges != self.ranges:
+            raise ValueError("Statistics with different columns or histograms can't be merged")
+        self._combine(other.count, other.mean, other.m2, other.m3, other.m4)
+        self.min = numpy.fmin(self.min, other.min)
+        self.max = numpy.fmax(self.max, other.max)
+        self.histograms += other.histograms
+        self.outside += other.outside
+        return self
+
+    def describe(self) -> dict[str, dict]:
+        """
+        Same numbers as scipy.stats.describe for every column:
+        nobs, minmax, mean, variance (ddof 1), skewness and kurtosis (Fisher, biased).
+        """
+        described: dict[str, dict] = {}
+        for i, column in enumerate(self.columns):
+            n = int(self.count[i])
+            m2 = self.m2[i] / n if n > 0 else numpy.nan
+            described[column] = {
+                    'nobs': n,
+                    'minmax': (float(self.min[i]), float(self.max[i])) if n > 0 else (numpy.nan, numpy.nan),
+                    'mean': float(self.mean[i]) if n > 0 else numpy.nan,
+                    'variance': float(self.m2[i] / (n - 1)) if n > 1 else numpy.nan,
+                    'skewness': float(self.m3[i] / n / m2 ** 1.5) if n > 0 and m2 > 0 else numpy.nan,
+                    'kurtosis': float(self.m4[i] / n / m2 ** 2 - 3) if n > 0 and m2 > 0 else numpy.nan
+                    }
+        return described
+
+    def scalingParameters(self) -> dict[str, dict]:
+        """
+        Parameters of a MinMaxScaler (data_min_, data_max_, scale_, min_) and a StandardScaler (mean_, scale_)
+        fitted to the rows, per column. Constant columns get a scale of 1 like in sklearn.
+        """
+        dataRange = self.max - self.min
+        minMaxScale = 1.0 / numpy.where(dataRange > 0, dataRange, 1.0)
+        std = numpy.sqrt(self.m2 / numpy.where(self.count > 0, self.count, 1))
+        standardScale = numpy.where(std > 0, std, 1.0)
+        return {
+                column: {
+                    'dataMin': float(self.min[i]),
+                    'dataMax': float(self.max[i]),
+                    'minMaxScale': float(minMaxScale[i]),
+                    'minMaxMin': float(-self.min[i] * minMaxScale[i]),
+                    'mean': float(self.mean[i]),
+                    'standardScale': float(standardScale[i])
+                    }
+                for i, column in enumerate(self.columns)
+                }
+
+    def toDict(self) -> dict:
+        return {
+                'columns': self.columns,
+                'bins': self.bins,
+                'ranges': self.ranges,
+                'count': self.count.tolist(),
+                'min': self.min.tolist(),
+                'max': self.max.tolist(),
+                'mean': self.mean.tolist(),
+                'm2': self.m2.tolist(),
+                'm3': self.m3.tolist(),
+                'm4': self.m4.tolist(),
+                'histograms': self.histograms.tolist(),
+                'outside': self.outside.tolist()
+                }
+
+    @classmethod
+    def fromDict(cls, stored: dict) -> 'RunningStatistics':
+        statistics = cls(stored['columns'], stored['bins'], stored['ranges'])
+        statistics.count = numpy.array(stored['count'], dtype='int64')
+        for name in ('min', 'max', 'mean', 'm2', 'm3', 'm4'):
+            setattr(statistics, name, numpy.array(stored[name], dtype='float64'))
+        statistics.histograms = numpy.array(stored['histograms'], dtype='int64')
+        statistics.outside = numpy.array(stored['outside'], dtype='int64')
+        return statistics
+
+def arrayStatistics(
+        arrays: Iterable[numpy.ndarray],
+        columns: list[str] = modelFeatureNames,
+        chunkRows: int = 65536
+        ) -> RunningStatistics:
+    """
+    Statistics of the rows of all the arrays, read chunkRows rows at a time
+    so memory mapped arrays are never read in whole.
+    """
+    statistics = RunningStatistics(columns)
+    for array in arrays:
+        for start in range(0, len(array), chunkRows):
+            statistics.update(array[start:start + chunkRows])
+    return statistics
+
+def storeStatistics(
+        songs: Iterable[SpotifySongData],
+        batchSize: int = 10000
+        ) -> RunningStatistics:
+    """
+    Statistics of the model features of stored songs, batchSize songs are turned to a matrix at a time.
+    """
+    statistics = RunningStatistics()
+    songs = iter(songs)
+    while True:
+        songBatch = list(islice(songs, batchSize))
+        if len(songBatch) == 0:
+            return statistics
+        statistics.update(buildFeatureMatrix(songBatch, 0)[0])
+
+def partStatistics(datasetPath: str, partName: str) -> dict:
+    # Run in the worker processes, only the path and the name are sent and the statistics returned as a dict
+    from .dataset import ShardedDataset
+
+    x, _, _ = ShardedDataset.open(datasetPath).part(partName)
+    return arrayStatistics([x]).toDict()
+
+def datasetStatistics(
+        datasetPath: str,
+        processes: int = 0,
+        save: bool = True
+        ) -> RunningStatistics:
+    """
+    Statistics of all the rows of a ShardedDataset.
+    The statistics of every part are saved to statistics.json next to the manifest with the merged
+    describe and scaling parameters, on the next call only the parts appended since are read.
+    A saved part is read again when its rows or content hash in the manifest are not the ones it was saved with.
+    With processes the parts are read in that many processes.
+    """
+    from .dataset import ShardedDataset
+
+    dataset = ShardedDataset.open(datasetPath)
+    statisticsPath = Path(datasetPath) / statisticsName
+    saved: dict[str, dict] = loadJson(str(statisticsPath))['parts'] if statisticsPath.exists() else {}
+    parts = {
+            part['name']: (part['rows'], part.get('sha256'))
+            for key in dataset.shards
+            for part in dataset.manifest['shards'][key]['parts']
+            }
+    partNames = list(parts.keys())
+    # Statistics saved without the rows and the hash (by an older version) are read again too
+    stored: dict[str, dict] = {
+            name: part['statistics'] for name, part in saved.items()
+            if name in parts and (part.get('rows'), part.get('sha256')) == parts[name] and 'statistics' in part
+            }
+    missing = [name for name in partNames if name not in stored]
+
+    if processes > 0 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for name, partResult in zip(missing, pool.map(partStatistics, [datasetPath] * len(missing), missing)):
+                stored[name] = partResult
+    else:
+        for name in missing:
+            stored[name] = partStatistics(datasetPath, name)
+
+    statistics = RunningStatistics(dataset.manifest['columns'])
+    for name in partNames:
+        statistics.merge(RunningStatistics.fromDict(stored[name]))
+
+    if save and len(missing) > 0:
+        saveJsonAtomic({
+            'rows': int(len(dataset)),
+            'describe': statistics.describe(),
+            'scaling': statistics.scalingParameters(),
+            'parts': {
+                name: {'rows': parts[name][0], 'sha256': parts[name][1], 'statistics': stored[name]}
+                for name in partNames
+                }
+            }, str(statisticsPath))
+    return statistics
+
+def loadScalingParameters(datasetPath: str) -> dict[str, dict]:
+    return loadJson(str(Path(datasetPath) / statisticsName))['scaling']
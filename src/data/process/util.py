@@ -1,5 +1,3 @@
-from pandas import DataFrame
-
 def parseYearFromDate(date: str) -> str:
     if '-' in date:
         split = date.split('-')
@@ -1,30 +1,136 @@
+from typing import Generator, Optional
 from pathlib import Path
 from csv import reader as CSVReader
 from io import TextIOWrapper
+from itertools import islice
+from sys import intern
 from zipfile import ZipFile
 
 from data.types.util import Credentials
 from data.types.billboard import BillboardSong
 from .util import getCredentials, setKaggleCredentialsToEnv, downloadKaggleDataset
 
+# Types of the columns in the columnar mode, the names are the header names in camel case
+billboardColumnTypes: dict[str, str] = {
+        'date': 'datetime64[D]',
+        'rank': 'int16',
+        'song': 'object',
+        'artist': 'object',
+        'lastWeek': 'int16',
+        'peakRank': 'int16',
+        'weeksOnBoard': 'int16'
+        }
+
+def toColumnName(headerName: str) -> str:
+    # The csv header has names like last-week, the types use lastWeek
+    first, *rest = headerName.split('-')
+    return first + ''.join(part.capitalize() for part in rest)
+
+def selectColumns(
+        headerNames: list[str], 
+        columns: Optional[list[str]]
+        ) -> list[tuple[int, str]]:
+    """
+    Indexes of the wanted columns in the header, columns can be header names or the camel case names.
+    """
+    if columns is None:
+        return list(enumerate(headerNames))
+
+    wanted = {toColumnName(column) for column in columns}
+    selected = [(j, name) for j, name in enumerate(headerNames) if toColumnName(name) in wanted]
+    if len(selected) != len(wanted):
+        found = {toColumnName(name) for _, name in selected}
+        raise ValueError(f"Columns {wanted - found} not found in {headerNames}")
+    return selected
+
+def iterBillboardData(
+        pathToData: str, 
+        dataFilename: str = 'charts.csv',
+        columns: Optional[list[str]] = None,
+        since: Optional[str] = None,
+        newestFirst: bool = False
+        ) -> Generator[BillboardSong, None, None]:
+    """
+    Yields the chart rows one by one straight from the zip without extracting it.
+    The rows are dicts keyed by the csv header like in getBillboardData,
+    with columns only the listed columns are kept (for example ['song', 'artist']).
+    With since (a YYYY-MM-DD date) only the rows of the chart weeks after it are yielded,
+    newestFirst tells the file has the newest weeks first (the Kaggle charts.csv has)
+    so the reading stops at the first week that is not newer.
+    """
+    with ZipFile(pathToData) as z:
+        with z.open(dataFilename, 'r') as f:
+            rows = CSVReader(TextIOWrapper(f, 'utf-8', newline=''))
+            header = next(rows)
+            selected = selectColumns(header, columns)
+            # Only the weeks after since need the date, the files without a date column can still be read without it
+            dateIndex = header.index('date') if since is not None else -1
+            for row in rows:
+                # ISO dates compare right as strings
+                if since is not None and row[dateIndex] <= since:
+                    if newestFirst:
+                        return
+                    continue
+                yield { name: row[j] for j, name in selected }
+
 def getBillboardData(
         pathToData: str, 
-        dataFilename: str = 'charts.csv'
+        dataFilename: str = 'charts.csv',
+        columns: Optional[list[str]] = None,
+        since: Optional[str] = None,
+        newestFirst: bool = False
         ) -> list[BillboardSong]:
     
     # Read the data file
-    all_tracks: list[BillboardSong] = []
+    return list(iterBillboardData(pathToData, dataFilename, columns, since, newestFirst))
+
+def getBillboardColumns(
+        pathToData: str, 
+        dataFilename: str = 'charts.csv',
+        columns: Optional[list[str]] = None,
+        chunkSize: int = 8192
+        ) -> dict:
+    """
+    Reads the chart data into one numpy array per column, keyed by the camel case column name.
+    rank, lastWeek, peakRank and weeksOnBoard are int16 (a missing last week is 0),
+    date is datetime64[D] and song and artist are object arrays of interned strings
+    so the names repeating every week are stored once.
+    The rows are converted in chunks of chunkSize rows so only one chunk of strings is in memory at a time.
+    """
+    import numpy
+
     with ZipFile(pathToData) as z:
         with z.open(dataFilename, 'r') as f:
-            for i, row in enumerate(CSVReader(TextIOWrapper(f, 'utf-8'))):
-                if i == 0:
-                    column_names: list = row
-                    continue
-                    
-                track: BillboardSong = { column_names[j]: value for j, value in enumerate(row)}
-                all_tracks.append(track)
+            rows = CSVReader(TextIOWrapper(f, 'utf-8', newline=''))
+            selected = [(j, toColumnName(name)) for j, name in selectColumns(next(rows), columns)]
+            chunks: dict[str, list] = {name: [] for _, name in selected}
+
+            def convert(name: str, values: list):
+                columnType = billboardColumnTypes.get(name, 'object')
+                if columnType == 'object':
+                    return numpy.array([intern(value) for value in values], dtype=object)
+                # The values repeat a lot (ranks, weeks) so every distinct value is parsed once
+                if columnType.startswith('int'):
+                    parsed = {value: int(value) if value else 0 for value in set(values)}
+                else:
+                    distinct = list(set(values))
+                    parsed = dict(zip(distinct, numpy.array(distinct, dtype=columnType)))
+                return numpy.fromiter(map(parsed.__getitem__, values), dtype=columnType, count=len(values))
+
+            chunk = list(islice(rows, chunkSize))
+            while len(chunk) > 0:
+                for j, name in selected:
+                    chunks[name].append(convert(name, [row[j] for row in chunk]))
+                chunk = list(islice(rows, chunkSize))
+
+            if len(chunks) > 0 and all(len(arrays) == 0 for arrays in chunks.values()):
+                # No rows
+                return {name: numpy.array([], dtype=billboardColumnTypes.get(name, 'object')) for name in chunks}
 
-    return all_tracks
+    return {
+            name: numpy.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+            for name, arrays in chunks.items()
+            }
 
 def downloadBillboardData(
         datasetName: str,
@@ -44,7 +150,7 @@ def downloadBillboardData(
         # Fetch the credentials
         kaggleCredentials = getCredentials('KAGGLE', credentialsPath)
     else:
-        kaggleCredentials = {'user': kaggleUsername, 'key': kaggleKey}
+        kaggleCredentials = {'userId': kaggleUsername, 'userKey': kaggleKey}
 
     # Set the credentials to enc
     setKaggleCredentialsToEnv(kaggleCredentials)
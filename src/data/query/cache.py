@@ -0,0 +1,210 @@
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+from hashlib import sha256
+from json import dumps as jsondumps, loads as jsonloads
+from threading import Lock
+from time import time
+import sqlite3
+import zlib
+
+from .util import createPath
+from .metrics import getMetrics, measureCall
+
+if TYPE_CHECKING:
+    from spotipy import Spotify
+
+class ResponseCache:
+    """
+    Api responses in a sqlite file.
+    A response is found by a hash of the endpoint and its normalized parameters
+    and stored as zlib compressed json.
+    Responses older than ttl seconds are not used, and when the stored responses grow over maxBytes
+    the least recently used ones are removed.
+    """
+
+    def __init__(
+            self,
+            cachePath: str,
+            ttl: Optional[float] = 30 * 24 * 60 * 60,
+            maxBytes: int = 512 * 1024 * 1024,
+            evictEvery: int = 1000
+            ) -> None:
+        createPath(cachePath)
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.evictEvery = evictEvery
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.connection = sqlite3.connect(cachePath, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, endpoint TEXT, created REAL, accessed REAL, size INTEGER, body BLOB)'
+                )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS accessedIndex ON responses (accessed)')
+        self.connection.commit()
+        self.totalBytes: int = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses'
+                ).fetchone()[0]
+        self.putsSinceEviction = 0
+
+    @staticmethod
+    def createKey(endpoint: str, params: dict) -> str:
+        return sha256(jsondumps([endpoint, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, endpoint: str, params: dict) -> Optional[Any]:
+        key = self.createKey(endpoint, params)
+        now = time()
+        with self.lock:
+            row = self.connection.execute(
+                    'SELECT created, body FROM responses WHERE key = ?', (key,)
+                    ).fetchone()
+            if row is None or (self.ttl is not None and now - row[0] > self.ttl):
+                self.misses += 1
+                getMetrics().increment('cache_misses', endpoint=endpoint)
+                return None
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            # Committed right away, an open transaction would keep the write lock from the other processes of the file
+            self.connection.commit()
+            self.hits += 1
+        getMetrics().increment('cache_hits', endpoint=endpoint)
+        return jsonloads(zlib.decompress(row[1]))
+
+    def put(self, endpoint: str, params: dict, response: Any) -> None:
+        key = self.createKey(endpoint, params)
+        body = zlib.compress(jsondumps(response, ensure_ascii=False).encode('utf-8'))
+        now = time()
+        with self.lock:
+            old = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self.totalBytes -= old[0]
+            self.connection.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, endpoint, now, now, len(body), body)
+                    )
+            self.connection.commit()
+            self.totalBytes += len(body)
+            self.putsSinceEviction += 1
+            if self.putsSinceEviction >= self.evictEvery or self.totalBytes > self.maxBytes:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        # Called with the lock held
+        self.putsSinceEviction = 0
+        if self.ttl is not None:
+            self.connection.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+        if self.totalBytes > self.maxBytes:
+            # Remove least recently used until 90% of the limit is left so this doesn't run on every put
+            target = int(self.maxBytes * 0.9)
+            removed = 0
+            rows = self.connection.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+            toRemove = []
+            for key, size in rows:
+                if self.totalBytes - removed <= target:
+                    break
+                toRemove.append((key,))
+                removed += size
+            self.connection.executemany('DELETE FROM responses WHERE key = ?', toRemove)
+        self.connection.commit()
+        self.totalBytes = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses'
+                ).fetchone()[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+def normalizeQuery(query: str) -> str:
+    # Spotify search is not case sensitive and extra whitespace doesn't change the results
+    return ' '.join(query.split()).lower()
+
+class CachedSpotify:
+    """
+    Wraps a Spotify client so that search, audio_features, album_tracks and albums responses
+    come from the ResponseCache when they have been fetched before.
+    Audio features and albums are cached per id so differently batched calls still hit the cache.
+    Everything else is passed to the wrapped client.
+    Only the calls made to the wrapped client on a cache miss are counted in the api metrics (measuresCalls).
+    """
+    measuresCalls = True
+
+    def __init__(self, api: 'Spotify', cache: ResponseCache) -> None:
+        self.api = api
+        self.cache = cache
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.api, name)
+
+    def close(self) -> None:
+        self.cache.close()
+
+    def search(
+            self,
+            q: str,
+            limit: int = 10,
+            offset: int = 0,
+            type: str = 'track',
+            market: Optional[str] = None
+            ) -> dict:
+        params = {'q': normalizeQuery(q), 'limit': limit, 'offset': offset, 'type': type, 'market': market}
+        response = self.cache.get('search', params)
+        if response is None:
+            response = measureCall(self.api.search, q, limit=limit, offset=offset, type=type, market=market)
+            self.cache.put('search', params, response)
+        return response
+
+    def album_tracks(
+            self,
+            album_id: str,
+            limit: int = 50,
+            offset: int = 0,
+            market: Optional[str] = None
+            ) -> dict:
+        params = {'albumID': album_id.strip(), 'limit': limit, 'offset': offset, 'market': market}
+        response = self.cache.get('album_tracks', params)
+        if response is None:
+            response = measureCall(self.api.album_tracks, album_id, limit=limit, offset=offset, market=market)
+            self.cache.put('album_tracks', params, response)
+        return response
+
+    def _cachedByID(
+            self,
+            endpoint: str,
+            ids: list[str],
+            fetch,
+            extraParams: dict = {}
+            ) -> list[Optional[dict]]:
+        results: dict[str, Optional[dict]] = {}
+        missing: list[str] = []
+        for sid in ids:
+            cached = self.cache.get(endpoint, {'id': sid, **extraParams})
+            if cached is None:
+                missing.append(sid)
+            else:
+                results[sid] = cached['response']
+
+        if len(missing) > 0:
+            for sid, response in zip(missing, fetch(missing)):
+                # Store the empty responses too, the ids without data don't get data on a rerun
+                self.cache.put(endpoint, {'id': sid, **extraParams}, {'response': response})
+                results[sid] = response
+
+        return [results[sid] for sid in ids]
+
+    def audio_features(self, tracks: Iterable[str] = []) -> list[Optional[dict]]:
+        if isinstance(tracks, str):
+            tracks = [tracks]
+        ids = [track.strip() for track in tracks]
+        return self._cachedByID('audio_features', ids, lambda missing: measureCall(self.api.audio_features, missing))
+
+    def albums(self, albums: Iterable[str], market: Optional[str] = None) -> dict:
+        ids = [album.strip() for album in albums]
+        fetched = self._cachedByID(
+                'albums',
+                ids,
+                lambda missing: measureCall(self.api.albums, missing, market=market)['albums'],
+                {'market': market}
+                )
+        return {'albums': fetched}
@@ -0,0 +1,181 @@
+from typing import Iterable, Optional
+from collections.abc import Mapping
+from pathlib import Path
+
+from data.types.spotify import SpotifySongInfo
+from .util import loadJson, saveJsonAtomic
+from .keys import normalizeText
+from .matching import getSongMatcher
+from .matchpool import SlimSong, parseSlimSong
+
+def slimSongInfo(info: SpotifySongInfo) -> SlimSong:
+    # SongInfo to the matchpool.SlimSong tuple, parseSlimSong gives the SongInfo back
+    album = info.get('album')
+    return (
+            info['songID'],
+            info['name'],
+            tuple((artist['name'], artist['artistID']) for artist in info['artists']),
+            None if album is None else (album['name'], album['albumID'], album['totalTracks'], album['releaseDate'])
+            )
+
+class LocalCatalog:
+    """
+    Spotify songs already seen, the stored search results and the tracks of the fetched album listings,
+    with an inverted index from the normalized title tokens (keys.normalizeText) to the songs.
+    A chart song is looked up from the songs that share the rarest tokens of its title
+    and an artist name token with it, they are matched with the same rules as the search results
+    (matching.SongMatcher) so a local match is one the search could have given.
+    """
+
+    def __init__(self, maxCandidates: int = 10) -> None:
+        self.maxCandidates = maxCandidates
+        self.songs: list[SlimSong] = []
+        self.ids: dict[str, int] = {}
+        self.titleIndex: dict[str, list[int]] = {}
+        # Artists are shared by many songs, their tokens are kept once
+        self.songArtists: list[tuple[int, ...]] = []
+        self.artistIDs: dict[tuple[str, str], int] = {}
+        self.artistTokens: list[frozenset[str]] = []
+        self.lookups = 0
+        self.found = 0
+
+    def __len__(self) -> int:
+        return len(self.songs)
+
+    def __contains__(self, songID: str) -> bool:
+        return songID in self.ids
+
+    def _artist(self, artist: tuple[str, str]) -> int:
+        i = self.artistIDs.get(artist)
+        if i is None:
+            i = len(self.artistTokens)
+            self.artistIDs[artist] = i
+            self.artistTokens.append(frozenset(normalizeText(artist[0]).split()))
+        return i
+
+    def add(self, song: SlimSong) -> bool:
+        """
+        Adds a song if its id is not in the catalog yet, returns if it was added.
+        """
+        songID = song[0]
+        if songID in self.ids:
+            return False
+        i = len(self.songs)
+        self.ids[songID] = i
+        self.songs.append(song)
+        self.songArtists.append(tuple(self._artist(tuple(artist)) for artist in song[2]))
+        for token in set(normalizeText(song[1]).split()):
+            self.titleIndex.setdefault(token, []).append(i)
+        return True
+
+    def addInfo(self, info: SpotifySongInfo) -> bool:
+        return self.add(slimSongInfo(info))
+
+    def addStore(self, data: Mapping) -> int:
+        """
+        Adds the songs of a SpotifyDataHandler store, query results or features.
+        Returns the number of songs added.
+        """
+        added = 0
+        for stored in data.values():
+            if 'info' in stored:
+                stored = stored['info']
+            if stored.get('spotifyData') is not None:
+                added += self.addInfo(stored['spotifyData'])
+        return added
+
+    def addAlbumTracks(self, albumTracks: Iterable[dict], album: Optional[tuple]) -> int:
+        """
+        Adds the raw tracks of an album listing, they have no album so album (as in SlimSong) is used.
+        """
+        added = 0
+        for track in albumTracks:
+            added += self.add((
+                    track['id'],
+                    track['name'],
+                    tuple((artist['name'], artist['id']) for artist in track['artists']),
+                    album
+                    ))
+        return added
+
+    def candidates(self, songToMatch: str, artistToMatch: str) -> list[SlimSong]:
+        """
+        Songs that have the two rarest tokens of the title (or one of them) and an artist token,
+        the ones with both first, in the order they were added.
+        """
+        titleTokens = set(normalizeText(songToMatch).split())
+        artistTokens = set(normalizeText(artistToMatch).split())
+        postings = sorted((self.titleIndex[token] for token in titleTokens if token in self.titleIndex), key=len)[:2]
+        if len(postings) == 0 or len(artistTokens) == 0:
+            return []
+
+        both: list[int] = []
+        either: list[int] = []
+        second = set(postings[1]) if len(postings) > 1 else set()
+        for i in postings[0]:
+            (both if i in second or len(postings) == 1 else either).append(i)
+            second.discard(i)
+        either.extend(sorted(second))
+
+        matches: list[SlimSong] = []
+        for i in both + either:
+            if any(not artistTokens.isdisjoint(self.artistTokens[artist]) for artist in self.songArtists[i]):
+                matches.append(self.songs[i])
+                if len(matches) >= self.maxCandidates:
+                    break
+        return matches
+
+    def lookup(
+            self,
+            songToMatch: str,
+            artistToMatch: str,
+            allowedRatio: int
+            ) -> Optional[SpotifySongInfo]:
+        """
+        The first candidate that matches like a search result would (see spotify_api.songMatching), None on a miss.
+        """
+        found = self.lookupRatios(songToMatch, artistToMatch, [allowedRatio])
+        return found[0] if found is not None else None
+
+    def lookupRatios(
+            self,
+            songToMatch: str,
+            artistToMatch: str,
+            allowedRatios: list[int]
+            ) -> Optional[tuple[SpotifySongInfo, int]]:
+        """
+        The candidates are matched at every ratio in order, the first match and the ratio it matched at.
+        """
+        self.lookups += 1
+        matcher = getSongMatcher()
+        candidates = [
+                (songID, name, artists, album, [{'name': artistName, 'artistID': artistID} for artistName, artistID in artists])
+                for songID, name, artists, album in self.candidates(songToMatch, artistToMatch)
+                ]
+        for allowedRatio in allowedRatios:
+            for songID, name, artists, album, resultArtists in candidates:
+                if matcher.match(songToMatch, artistToMatch, name, resultArtists, allowedRatio, songID):
+                    self.found += 1
+                    return (parseSlimSong((songID, name, artists, album)), allowedRatio)
+        return None
+
+    def save(self, path: str) -> None:
+        saveJsonAtomic({'version': 1, 'songs': self.songs}, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'LocalCatalog':
+        catalog = cls()
+        for songID, name, artists, album in loadJson(path)['songs']:
+            catalog.add((
+                    songID,
+                    name,
+                    tuple(tuple(artist) for artist in artists),
+                    None if album is None else tuple(album)
+                    ))
+        return catalog
+
+    @classmethod
+    def loadOrCreate(cls, path: Optional[str]) -> 'LocalCatalog':
+        if path and Path(path).exists():
+            return cls.load(path)
+        return cls()
@@ -0,0 +1,129 @@
+from typing import TYPE_CHECKING, Any, Optional
+from threading import Lock
+
+from .util import getCredentialSections
+from .ratelimit import RateLimiter, getRetryAfter
+from .metrics import getMetrics, measureCall
+
+if TYPE_CHECKING:
+    from spotipy import Spotify
+    from .transport import HttpTransport
+
+class PooledClient:
+    """
+    A Spotify client of one credential and its own rate limit state.
+    """
+
+    def __init__(self, name: str, api: 'Spotify', limiter: RateLimiter) -> None:
+        self.name = name
+        self.api = api
+        self.limiter = limiter
+        self.calls = 0
+        self.rateLimited = 0
+
+class SpotifyClientPool:
+    """
+    Clients of several credentials (apps) behind the api methods the data functions call,
+    so a pool can be passed where a Spotify client is.
+    Every call goes to the client with the most calls left in its limiter right now,
+    a 429 response pauses only that client and the call is made again on another one.
+    When every client is paused the call waits for the client that is free first.
+    The pool paces the calls itself (pacesCalls), so no shared limiter is needed with it,
+    and records every call it makes to a client in the api metrics (measuresCalls).
+    """
+    pacesCalls = True
+    measuresCalls = True
+
+    def __init__(self, clients: list[PooledClient], maxRateLimitRetries: int = 10) -> None:
+        if len(clients) == 0:
+            raise ValueError("A client pool needs at least one client")
+        self.clients = clients
+        self.maxRateLimitRetries = maxRateLimitRetries
+        self.lock = Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything that is not routed is taken from the first client
+        return getattr(self.clients[0].api, name)
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def _acquire(self) -> PooledClient:
+        # The clients with the most budget are tried first, a client taken by another thread is skipped
+        byBudget = sorted(self.clients, key=lambda client: client.limiter.available(), reverse=True)
+        for client in byBudget:
+            if client.limiter.tryAcquire():
+                return client
+        # Every client is paused or busy, wait for the one that gets free first
+        client = min(self.clients, key=lambda client: (client.limiter.pausedUntil, client.limiter.inFlight))
+        client.limiter.acquire()
+        return client
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        rateLimited = 0
+        while True:
+            client = self._acquire()
+            try:
+                with self.lock:
+                    client.calls += 1
+                return measureCall(getattr(client.api, method), *args, **kwargs)
+            except Exception as e:
+                retryAfter = getRetryAfter(e)
+                if retryAfter is None or rateLimited >= self.maxRateLimitRetries:
+                    raise
+                rateLimited += 1
+                with self.lock:
+                    client.rateLimited += 1
+                getMetrics().increment('client_rate_limited', client=client.name)
+                print(f"Client {client.name} rate limited for {retryAfter} seconds")
+                client.limiter.throttle(retryAfter)
+            finally:
+                client.limiter.release()
+
+    def search(self, *args, **kwargs) -> dict:
+        return self.call('search', *args, **kwargs)
+
+    def audio_features(self, *args, **kwargs) -> list:
+        return self.call('audio_features', *args, **kwargs)
+
+    def albums(self, *args, **kwargs) -> dict:
+        return self.call('albums', *args, **kwargs)
+
+    def album_tracks(self, *args, **kwargs) -> dict:
+        return self.call('album_tracks', *args, **kwargs)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {client.name: {'calls': client.calls, 'rateLimited': client.rateLimited} for client in self.clients}
+
+def createClientPool(
+        credentialsPath: str = "../config/env.ini",
+        sectionPrefix: str = 'SPOTIFY',
+        rate: float = 10.0,
+        burst: int = 10,
+        maxInFlight: int = 8,
+        transport: Optional['HttpTransport'] = None
+        ) -> SpotifyClientPool:
+    """
+    A client for every section of the credentials file that starts with sectionPrefix
+    ([SPOTIFY], [SPOTIFY2], [SPOTIFY_BACKFILL], ...), each with its own token cache in memory
+    and a limiter of rate calls per second.
+    The clients go to the same host so they share the connections of one transport,
+    by default one with a connection for every call that can be in flight.
+    """
+    from spotipy.cache_handler import MemoryCacheHandler
+    from .transport import HttpTransport
+
+    sections = getCredentialSections(sectionPrefix, credentialsPath)
+    # 429 is not retried by spotipy, the pool moves the call to another client
+    statusForcelist = (500, 502, 503, 504)
+    if transport is None:
+        transport = HttpTransport(poolSize=max(1, len(sections)) * maxInFlight, statusForcelist=statusForcelist)
+    elif transport.retriesRateLimits:
+        raise ValueError("The transport of a client pool must not retry 429 responses, the pool moves the call instead")
+    clients: list[PooledClient] = []
+    for name, credentials in sections.items():
+        cc = transport.credentials(credentials['userId'], credentials['userKey'], cache_handler=MemoryCacheHandler())
+        api = transport.client(client_credentials_manager=cc, status_forcelist=statusForcelist)
+        clients.append(PooledClient(name, api, RateLimiter(rate, burst, maxInFlight)))
+    print(f"Spotify client pool of {len(clients)} credentials")
+    return SpotifyClientPool(clients)
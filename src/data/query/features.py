@@ -0,0 +1,144 @@
+from typing import TYPE_CHECKING, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from data.types.spotify import SpotifyFeatures
+from .util import batch, createPath
+from .ratelimit import RateLimiter, callWithLimiter
+from .retry import DeadLetters, QueryFailed, RetryPolicy
+from .metrics import getMetrics
+
+if TYPE_CHECKING:
+    from spotipy import Spotify
+
+# Stored feature names and the names in the audio features response, in the order of SpotifyFeatures
+featureFields: list[tuple[str, str]] = [
+        ('timeSignature', 'time_signature'),
+        ('durationMS', 'duration_ms'),
+        ('key', 'key'),
+        ('mode', 'mode'),
+        ('acousticness', 'acousticness'),
+        ('danceability', 'danceability'),
+        ('energy', 'energy'),
+        ('instrumentalness', 'instrumentalness'),
+        ('liveness', 'liveness'),
+        ('loudness', 'loudness'),
+        ('speechiness', 'speechiness'),
+        ('valence', 'valence'),
+        ('tempo', 'tempo')
+        ]
+integerFeatures = {'timeSignature', 'durationMS', 'key', 'mode'}
+
+class AudioFeatureMatrix:
+    """
+    Audio features of many songs as a float32 matrix with one row per id in ids
+    and the columns in the order of featureFields.
+    Rows of the songs that have no features are NaN and False in found.
+    """
+
+    def __init__(
+            self,
+            ids: list[str],
+            values: Optional[numpy.ndarray] = None,
+            found: Optional[numpy.ndarray] = None
+            ) -> None:
+        self.ids = numpy.array(ids, dtype=str)
+        self.rows: dict[str, int] = {sid: i for i, sid in enumerate(ids)}
+        self.values = values if values is not None else numpy.full((len(ids), len(featureFields)), numpy.nan, dtype='float32')
+        self.found = found if found is not None else numpy.zeros(len(ids), dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def setFeatures(self, featuresResult: dict, sid: Optional[str] = None) -> None:
+        row = self.rows[sid if sid is not None else featuresResult['id']]
+        self.values[row] = [featuresResult[apiName] for _, apiName in featureFields]
+        self.found[row] = True
+
+    def features(self, sid: str) -> SpotifyFeatures:
+        """
+        Features of a song in the stored dict format, empty if the song has no features.
+        """
+        row = self.rows[sid]
+        if not self.found[row]:
+            return {}
+        # str of a float32 is the shortest string that gives back the same float32
+        return {
+                name: int(value) if name in integerFeatures else float(str(value))
+                for (name, _), value in zip(featureFields, self.values[row])
+                }
+
+    def merge(self, other: 'AudioFeatureMatrix') -> 'AudioFeatureMatrix':
+        """
+        Rows of both, for the ids in both the rows of other are used.
+        """
+        keep = numpy.array([sid not in other.rows for sid in self.ids.tolist()], dtype=bool)
+        return AudioFeatureMatrix(
+                self.ids[keep].tolist() + other.ids.tolist(),
+                numpy.concatenate([self.values[keep], other.values]),
+                numpy.concatenate([self.found[keep], other.found])
+                )
+
+    def save(self, path: str) -> None:
+        createPath(path)
+        with open(path, 'wb') as f:
+            numpy.savez(f, ids=self.ids, values=self.values, found=self.found)
+
+    @classmethod
+    def load(cls, path: str) -> 'AudioFeatureMatrix':
+        with numpy.load(path) as stored:
+            return cls(stored['ids'].tolist(), stored['values'], stored['found'])
+
+def fetchAudioFeatureMatrix(
+        api: 'Spotify',
+        songIDs: list[str],
+        batchSize: int = 100,
+        workers: int = 4,
+        limiter: Optional[RateLimiter] = None,
+        retryPolicy: Optional[RetryPolicy] = None,
+        deadLetters: Optional[DeadLetters] = None
+        ) -> AudioFeatureMatrix:
+    """
+    Fetches the audio features of the songs, 100 ids per call (the most the endpoint takes)
+    with up to workers calls in flight.
+    Every result is put to the row of its id so the order of the responses doesn't matter.
+    A batch that fails after the retries leaves its rows not found, its ids are added to deadLetters
+    (one letter per id with the id as the query) and the other batches are still returned.
+    """
+    if retryPolicy is None:
+        retryPolicy = RetryPolicy()
+
+    # Duplicate ids are fetched once
+    matrix = AudioFeatureMatrix(list(dict.fromkeys(songIDs)))
+
+    def fetchBatch(idBatch: list[str]) -> Union[list[Optional[dict]], QueryFailed]:
+        try:
+            return retryPolicy.call(callWithLimiter, limiter, api.audio_features, idBatch, limiter=limiter)
+        except QueryFailed as e:
+            return e
+
+    batches = list(batch(matrix.ids.tolist(), batchSize))
+    progress = getMetrics().progress('featureBatches', len(batches))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for i, (idBatch, results) in enumerate(zip(batches, pool.map(fetchBatch, batches))):
+            if i % 100 == 0:
+                progress.log()
+            progress.done = i + 1
+            if isinstance(results, QueryFailed):
+                print(f"Features of {len(idBatch)} songs failed: {results}")
+                if deadLetters is not None:
+                    for sid in idBatch:
+                        # The search fields of the letter are not used by the feature calls
+                        deadLetters.add(sid, results, None, 0, 0, False)
+                continue
+            for j, featuresResult in enumerate(results):
+                if featuresResult is None:
+                    continue
+                if featuresResult['id'] in matrix.rows:
+                    matrix.setFeatures(featuresResult)
+                else:
+                    # A relinked track answers with another id, it belongs to the id asked in its position
+                    matrix.setFeatures(featuresResult, idBatch[j])
+
+    return matrix
@@ -0,0 +1,139 @@
+from typing import Optional
+from pathlib import Path
+from hashlib import sha256
+from array import array
+import re
+import unicodedata
+
+from data.types.billboard import BillboardSong
+from .util import loadJson, saveJsonAtomic
+
+# Ways the chart data joins artists, "Drake Featuring Rihanna", "Drake & Rihanna" and "Drake, Rihanna"
+# are all the same two artists. "x" is not one of them, it is a part of names like Lil Nas X
+artistSeparators = re.compile(
+        r'\s+(?:featuring|feat\.?|ft\.?|with|duet with|and|vs\.?)\s+|\s*[&,+/]\s*',
+        re.IGNORECASE
+        )
+# Changed when the keys are made differently, the indexes saved with older keys are built again
+keyVersion = 2
+# Apostrophes and dots are removed (Don't -> dont, St. -> st), other punctuation splits words
+removedCharacters = re.compile(r"['’`.]")
+punctuation = re.compile(r'[^\w\s]|_')
+
+def normalizeText(text: str) -> str:
+    # Drop accents, case and punctuation and collapse the whitespace
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    text = punctuation.sub(' ', removedCharacters.sub('', text))
+    return ' '.join(text.split())
+
+def normalizeTitle(song: str) -> str:
+    return normalizeText(song)
+
+def normalizeArtist(artist: str) -> str:
+    # Order of the artists doesn't matter
+    names = {normalizeText(name) for name in artistSeparators.split(artist)}
+    return '|'.join(sorted(name for name in names if name))
+
+def createCanonicalKey(song: str, artist: str) -> str:
+    return normalizeTitle(song) + '::' + normalizeArtist(artist)
+
+def fingerprintTracks(tracks: list[BillboardSong]) -> str:
+    # Cheap check that an index was built from the same chart data
+    if len(tracks) == 0:
+        return ''
+    first, last = tracks[0], tracks[-1]
+    parts = [f"v{keyVersion}", str(len(tracks))] + [str(track.get(column, '')) for track in (first, last) for column in ('date', 'song', 'artist')]
+    return sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+class BillboardKeyIndex:
+    """
+    Canonical song/artist keys of the chart data.
+    Every chart row is mapped to its canonical key and every key has one canonical track
+    (the first row with the key) that is used in the queries.
+    """
+
+    def __init__(
+            self,
+            keys: list[str],
+            tracks: list[BillboardSong],
+            rowKeys: array,
+            fingerprint: str = ''
+            ) -> None:
+        self.keys = keys
+        self.tracks = tracks
+        self.rowKeys = rowKeys
+        self.fingerprint = fingerprint
+        self.keyIndexes: dict[str, int] = {key: i for i, key in enumerate(keys)}
+
+    @classmethod
+    def build(cls, billboardTracks: list[BillboardSong]) -> 'BillboardKeyIndex':
+        keys: list[str] = []
+        tracks: list[BillboardSong] = []
+        keyIndexes: dict[str, int] = {}
+        rowKeys = array('I')
+        # The raw song and artist repeat every week the song is on the chart, normalize them once
+        rawKeys: dict[tuple[str, str], int] = {}
+        for track in billboardTracks:
+            raw = (track['song'], track['artist'])
+            i = rawKeys.get(raw)
+            if i is None:
+                key = createCanonicalKey(*raw)
+                i = keyIndexes.get(key)
+                if i is None:
+                    i = len(keys)
+                    keyIndexes[key] = i
+                    keys.append(key)
+                    tracks.append(track)
+                rawKeys[raw] = i
+            rowKeys.append(i)
+
+        return cls(keys, tracks, rowKeys, fingerprintTracks(billboardTracks))
+
+    def save(self, path: str) -> None:
+        saveJsonAtomic({
+            'fingerprint': self.fingerprint,
+            'keys': self.keys,
+            'tracks': self.tracks,
+            'rowKeys': self.rowKeys.tolist()
+            }, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'BillboardKeyIndex':
+        stored = loadJson(path)
+        return cls(stored['keys'], stored['tracks'], array('I', stored['rowKeys']), stored['fingerprint'])
+
+    @classmethod
+    def loadOrBuild(
+            cls,
+            billboardTracks: list[BillboardSong],
+            path: Optional[str] = None
+            ) -> 'BillboardKeyIndex':
+        """
+        Loads the index from path if it was built from the same chart data, else builds and saves it.
+        """
+        if path is not None and Path(path).exists():
+            index = cls.load(path)
+            if index.fingerprint == fingerprintTracks(billboardTracks):
+                return index
+            print("Chart data has changed, rebuilding the key index")
+
+        index = cls.build(billboardTracks)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def keyForRow(self, row: int) -> str:
+        return self.keys[self.rowKeys[row]]
+
+    def canonicalTrack(self, key: str) -> BillboardSong:
+        return self.tracks[self.keyIndexes[key]]
+
+    def missingTracks(self, storedKeys: set[str]) -> list[BillboardSong]:
+        """
+        Canonical tracks of the keys that are not in storedKeys, in chart order.
+        """
+        return [track for key, track in zip(self.keys, self.tracks) if key not in storedKeys]
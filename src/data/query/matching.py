@@ -0,0 +1,225 @@
+from typing import Iterable, Optional
+from collections import OrderedDict
+from configparser import ConfigParser
+from functools import lru_cache
+from pathlib import Path
+
+from fuzzywuzzy import fuzz, utils
+
+from data.types.spotify import SpotifySongInfo
+from .metrics import getMetrics
+
+# Default lists, relative to the src folder like the env.ini
+defaultMatchingConfigPath = str(Path(__file__).parents[2] / 'config' / 'matching.ini')
+
+class TitleFilter:
+    """
+    Blacklist and whitelist prepared once for checking many names.
+    A name is blacklisted when it has a blacklisted string and no whitelisted string (case insensitive).
+    The lists are lowercased here and the name once per check,
+    the substring checks are faster in CPython than one regex of the lists (see benchmarks/blacklist.py).
+    """
+
+    def __init__(self, blackList: Iterable[str], whiteList: Iterable[str]) -> None:
+        self.blackList = list(blackList)
+        self.whiteList = list(whiteList)
+        self.lowerBlackList = tuple(blackListed.lower() for blackListed in self.blackList)
+        self.lowerWhiteList = tuple(whiteListed.lower() for whiteListed in self.whiteList)
+
+    def isBlackListed(self, name: str) -> bool:
+        lowerName = name.lower()
+        for blackListed in self.lowerBlackList:
+            if blackListed in lowerName:
+                for whiteListed in self.lowerWhiteList:
+                    if whiteListed in lowerName:
+                        return False
+                return True
+        return False
+
+def loadTitleFilter(configPath: str = defaultMatchingConfigPath) -> TitleFilter:
+    """
+    Reads the lists from the names of the [BLACKLIST] and [WHITELIST] sections, one string per line.
+    Raises FileNotFoundError when the config can't be read, matching without the blacklist would store remixes as hits.
+    """
+    parser = ConfigParser(interpolation=None)
+    if not parser.read(configPath, encoding='utf-8'):
+        raise FileNotFoundError(f"Could not read the matching configurations from {configPath}")
+
+    def names(section: str) -> list[str]:
+        if section not in parser.sections():
+            return []
+        return [name.strip() for name in parser[section].get('names', '').splitlines() if name.strip()]
+
+    return TitleFilter(names('BLACKLIST'), names('WHITELIST'))
+
+@lru_cache(maxsize=None)
+def getTitleFilter(configPath: str = defaultMatchingConfigPath) -> TitleFilter:
+    return loadTitleFilter(configPath)
+
+def checkIfBlackListed(name: str, titleFilter: Optional[TitleFilter] = None) -> bool:
+    if titleFilter is None:
+        titleFilter = getTitleFilter()
+    if titleFilter.isBlackListed(name):
+        # Only the rejections of this process, the ones in a matchpool.MatchingPool process are not counted here
+        getMetrics().increment('blacklisted')
+        return True
+    return False
+
+class ProcessedText:
+    """
+    A string processed the way fuzzywuzzy processes it before scoring, and its tokens.
+    """
+    __slots__ = ('text', 'tokens')
+
+    def __init__(self, text: str) -> None:
+        self.text: str = utils.full_process(text, force_ascii=True)
+        self.tokens: frozenset[str] = frozenset(self.text.split())
+
+def joinedLength(tokens: Iterable[str]) -> int:
+    # Length of the tokens joined with spaces
+    lengths = [len(token) for token in tokens]
+    return sum(lengths) + len(lengths) - 1 if lengths else 0
+
+def tokenSetRatioBound(first: ProcessedText, second: ProcessedText) -> float:
+    """
+    Upper bound of fuzz.token_set_ratio / 100 from the token lengths only.
+    token_set_ratio is the best ratio of the pairs (intersection, intersection + rest of first),
+    (intersection, intersection + rest of second) and (intersection + rest of first, intersection + rest of second),
+    and a ratio can't be more than 2 * shorter length / sum of the lengths.
+    """
+    if not first.tokens or not second.tokens:
+        return 0.0
+    intersectionLength = joinedLength(first.tokens & second.tokens)
+
+    def combinedLength(rest: frozenset) -> int:
+        restLength = joinedLength(rest)
+        if intersectionLength and restLength:
+            return intersectionLength + 1 + restLength
+        return intersectionLength + restLength
+
+    firstLength = combinedLength(first.tokens - second.tokens)
+    secondLength = combinedLength(second.tokens - first.tokens)
+    return max(
+            2 * intersectionLength / (intersectionLength + firstLength),
+            2 * intersectionLength / (intersectionLength + secondLength),
+            2 * min(firstLength, secondLength) / (firstLength + secondLength)
+            )
+
+class SongMatcher:
+    """
+    songMatching with caches for matching many results against the same chart songs.
+    The processed chart side strings are cached (the strict and relaxed passes score the same songs),
+    candidates that can't reach the ratio by their token lengths are rejected before fuzz.token_set_ratio is called
+    and the results are memoized per (chart song, spotify id, ratio) in a bounded LRU cache.
+    """
+
+    def __init__(
+            self,
+            titleFilter: Optional[TitleFilter] = None,
+            cacheSize: int = 200000,
+            processedCacheSize: int = 100000
+            ) -> None:
+        self.titleFilter = titleFilter
+        self.cacheSize = cacheSize
+        self.results: OrderedDict = OrderedDict()
+        self.process = lru_cache(maxsize=processedCacheSize)(ProcessedText)
+        self.rejectedByBound = 0
+        self.scored = 0
+
+    def ratio(self, first: str, second: str, allowedRatio: int) -> bool:
+        """
+        allowedRatio <= fuzz.token_set_ratio(first, second)
+        """
+        if allowedRatio <= 0:
+            return True
+        processedFirst = self.process(first)
+        processedSecond = self.process(second)
+        # round(100 * ratio) is under allowedRatio if 100 * bound is under allowedRatio - 0.5
+        if 100 * tokenSetRatioBound(processedFirst, processedSecond) < allowedRatio - 0.5:
+            self.rejectedByBound += 1
+            return False
+        self.scored += 1
+        return allowedRatio <= fuzz.token_set_ratio(processedFirst.text, processedSecond.text, full_process=False)
+
+    def _match(
+            self,
+            songToMatch: str,
+            artistToMatch: str,
+            resultSong: str,
+            resultArtists: list,
+            allowedRatio: int
+            ) -> bool:
+        if checkIfBlackListed(resultSong, self.titleFilter):
+            return False
+
+        # Exact match search
+        if allowedRatio == 100:
+            if songToMatch.lower() == resultSong.lower():
+                # If song name matches check if the artist is found in artists
+                # and if it is, this will be enough to add the song
+                return self.ratio(artistToMatch, ' '.join(artist['name'] for artist in resultArtists), 95)
+            return False
+
+        # Some tracks do not match exactly for example feature feat. etc
+        # so they can be fetched by matching based on tokens after tokenization of the strings
+        if self.ratio(songToMatch, resultSong, allowedRatio):
+            return self.ratio(artistToMatch, ' '.join(artist['name'] for artist in resultArtists), allowedRatio)
+        return False
+
+    def match(
+            self,
+            songToMatch: str,
+            artistToMatch: str,
+            resultSong: str,
+            resultArtists: list,
+            allowedRatio: int = 80,
+            resultID: Optional[str] = None
+            ) -> bool:
+        if resultID is None:
+            return self._match(songToMatch, artistToMatch, resultSong, resultArtists, allowedRatio)
+
+        key = (songToMatch, artistToMatch, resultID, allowedRatio)
+        matched = self.results.get(key)
+        if matched is not None:
+            self.results.move_to_end(key)
+            return matched
+
+        matched = self._match(songToMatch, artistToMatch, resultSong, resultArtists, allowedRatio)
+        self.results[key] = matched
+        if len(self.results) > self.cacheSize:
+            self.results.popitem(last=False)
+        return matched
+
+    def matchResults(
+            self,
+            songToMatch: str,
+            artistToMatch: str,
+            results: list[SpotifySongInfo],
+            allowedRatio: int = 80
+            ) -> list[bool]:
+        """
+        Scores a whole search result list.
+        """
+        return [
+                self.match(songToMatch, artistToMatch, song['name'], song['artists'], allowedRatio, song['songID'])
+                for song in results
+                ]
+
+    def firstMatch(
+            self,
+            songToMatch: str,
+            artistToMatch: str,
+            results: list[SpotifySongInfo],
+            allowedRatio: int = 80
+            ) -> Optional[SpotifySongInfo]:
+        """
+        The first result that matches, the rest of the results are not scored.
+        """
+        for song in results:
+            if self.match(songToMatch, artistToMatch, song['name'], song['artists'], allowedRatio, song['songID']):
+                return song
+        return None
+
+@lru_cache(maxsize=None)
+def getSongMatcher() -> SongMatcher:
+    return SongMatcher()
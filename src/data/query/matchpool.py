@@ -0,0 +1,190 @@
+from typing import Generator, Iterable, Optional, Sequence, Union
+from concurrent.futures import Future, ProcessPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+from data.types.spotify import SpotifyArtist, SpotifySongInfo
+from .matching import getSongMatcher
+from .planner import Threshold
+from .retry import QueryFailed
+
+# Search result item with only the fields parseSongInfo reads:
+# (id, name, ((artistName, artistID), ...), (albumName, albumID, totalTracks, releaseDate) or None)
+SlimSong = tuple
+# Chart song, chart artist and the search results (or the failure) of its query
+MatchJob = tuple[str, str, Union[list[SlimSong], QueryFailed]]
+# The matched song with the name and ratio of the rule (planner.Threshold) it matched with
+RuleMatch = tuple[SpotifySongInfo, str, int]
+
+def slimSearchItem(songRaw: dict) -> SlimSong:
+    album = songRaw.get('album')
+    return (
+            songRaw['id'],
+            songRaw['name'],
+            tuple((artist['name'], artist['id']) for artist in songRaw['artists']),
+            None if album is None else (album['name'], album['id'], album['total_tracks'], album['release_date'])
+            )
+
+def slimSearchItems(items: list[dict]) -> list[SlimSong]:
+    return [slimSearchItem(item) for item in items]
+
+def parseSlimSong(slim: SlimSong) -> SpotifySongInfo:
+    """
+    Same as parseSongInfo of the full search result item.
+    """
+    songID, songName, artists, album = slim
+    info: SpotifySongInfo = {
+            'name': songName,
+            'songID': songID,
+            'artists': [{'name': name, 'artistID': artistID} for name, artistID in artists],
+            'album': None if album is None else {
+                'name': album[0],
+                'albumID': album[1],
+                'totalTracks': album[2],
+                'releaseDate': album[3]
+                }
+            }
+    return info
+
+def matchChunk(chunk: list[tuple[str, str, list[SlimSong]]], thresholds: Sequence[Threshold]) -> list[Optional[RuleMatch]]:
+    """
+    First matching result of every chart song in the chunk, run in the matching processes.
+    The results are scored at every threshold in order until one of them matches,
+    a result set is fetched once however many ratios it is scored at.
+    Only the matched song is parsed, the rest are matched on the slim fields.
+    """
+    matcher = getSongMatcher()
+    matches: list[Optional[RuleMatch]] = []
+    for songToMatch, artistToMatch, results in chunk:
+        matched = None
+        resultArtists: list[list[SpotifyArtist]] = [
+                [{'name': name, 'artistID': artistID} for name, artistID in slim[2]]
+                for slim in results
+                ]
+        for rule, allowedRatio in thresholds:
+            for slim, artists in zip(results, resultArtists):
+                if matcher.match(songToMatch, artistToMatch, slim[1], artists, allowedRatio, slim[0]):
+                    matched = (parseSlimSong(slim), rule, allowedRatio)
+                    break
+            if matched is not None:
+                break
+        matches.append(matched)
+    return matches
+
+def warmUp() -> None:
+    # Loads the title filter and builds the matcher in the process before the first chunk
+    getSongMatcher()
+
+class MatchingPool:
+    """
+    Matches search results to chart songs in a pool of processes.
+    The jobs are sent to the processes in chunks of chunkSize from a feeder thread
+    and at most maxPendingChunks chunks wait for the consumer, so a slow consumer stops the feeding
+    and through that the searches feeding the jobs.
+    With 0 processes the jobs are matched in the calling thread.
+    """
+
+    def __init__(
+            self,
+            processes: int = 0,
+            chunkSize: int = 64,
+            maxPendingChunks: Optional[int] = None
+            ) -> None:
+        self.processes = processes
+        self.chunkSize = chunkSize
+        self.maxPendingChunks = maxPendingChunks if maxPendingChunks is not None else max(2, processes * 4)
+        self.pool: Optional[ProcessPoolExecutor] = None
+        if processes > 0:
+            # Start the processes now, forking later would copy the threads doing the searches
+            self.pool = ProcessPoolExecutor(max_workers=processes, initializer=warmUp)
+            self.pool.submit(warmUp).result()
+
+    def __enter__(self) -> 'MatchingPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def matchAll(
+            self,
+            jobs: Iterable[MatchJob],
+            thresholds: Sequence[Threshold]
+            ) -> Generator[Union[Optional[RuleMatch], QueryFailed], None, None]:
+        """
+        Yields the first matching song (or None) of every job in the order of the jobs,
+        with the rule it matched with (see matchChunk).
+        Failed queries are yielded as their QueryFailed error without matching.
+        """
+        if self.pool is None:
+            for songToMatch, artistToMatch, results in jobs:
+                if isinstance(results, QueryFailed):
+                    yield results
+                else:
+                    yield matchChunk([(songToMatch, artistToMatch, results)], thresholds)[0]
+            return
+
+        pool = self.pool
+        pending: Queue = Queue(maxsize=self.maxPendingChunks)
+        stop = Event()
+        done = object()
+
+        def put(item) -> bool:
+            # Gives up when the consumer has stopped so the thread doesn't hang on a full queue
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def submit(chunk: list[MatchJob]) -> bool:
+            # Failed queries stay in the chunk in their place but are not sent to the processes
+            toMatch = [(song, artist, results) for song, artist, results in chunk if not isinstance(results, QueryFailed)]
+            future: Future = pool.submit(matchChunk, toMatch, thresholds)
+            return put((chunk, future))
+
+        def feed() -> None:
+            try:
+                chunk: list[MatchJob] = []
+                for job in jobs:
+                    chunk.append(job)
+                    if len(chunk) >= self.chunkSize:
+                        if not submit(chunk):
+                            return
+                        chunk = []
+                if len(chunk) > 0 and not submit(chunk):
+                    return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        feeder = Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                chunk, future = item
+                matches = iter(future.result())
+                for job in chunk:
+                    yield job[2] if isinstance(job[2], QueryFailed) else next(matches)
+        finally:
+            stop.set()
+            # Unblock a feeder waiting on the queue and drop the chunks that are not needed
+            while feeder.is_alive():
+                try:
+                    item = pending.get(timeout=0.1)
+                    if isinstance(item, tuple):
+                        item[1].cancel()
+                except Empty:
+                    pass
+            feeder.join()
@@ -0,0 +1,303 @@
+from typing import Any, Callable, Optional
+from bisect import bisect_left
+from functools import lru_cache
+from json import dumps as jsondumps
+from os import replace
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter, time
+
+from .util import createPath
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket is everything over
+latencyBuckets: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Metric names are prefixed with this in the Prometheus text
+prometheusPrefix = 'billboard_spotify_'
+
+# Labels of a counter or a histogram as ((name, value), ...)
+Labels = tuple[tuple[str, str], ...]
+
+class Histogram:
+    """
+    Counts of the observed values in fixed buckets, their sum and count.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = latencyBuckets) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Upper bound of the bucket the q quantile is in, None without observations.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def toDict(self) -> dict:
+        return {
+                'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count > 0 else None,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99),
+                'buckets': {str(bound): count for bound, count in zip((*self.buckets, '+Inf'), self.counts)}
+                }
+
+class Progress:
+    """
+    Items done of a task with the rate and an ETA.
+    The loop only sets done (or calls advance), the rate is worked out when the progress is read:
+    rate is over the time since the previous read and averageRate over the whole task.
+    """
+    __slots__ = ('name', 'total', 'done', 'started', 'readTime', 'readDone', 'rate')
+
+    def __init__(self, name: str, total: Optional[int] = None) -> None:
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.started = monotonic()
+        self.readTime = self.started
+        self.readDone = 0
+        self.rate = 0.0
+
+    def advance(self, items: int = 1) -> None:
+        self.done += items
+
+    def snapshot(self) -> dict:
+        now = monotonic()
+        done = self.done
+        if now - self.readTime >= 1.0:
+            self.rate = (done - self.readDone) / (now - self.readTime)
+            self.readTime = now
+            self.readDone = done
+        elapsed = now - self.started
+        averageRate = done / elapsed if elapsed > 0 else 0.0
+        rate = self.rate if self.rate > 0 else averageRate
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(0, self.total - done) / rate
+        return {
+                'done': done,
+                'total': self.total,
+                'elapsedSeconds': elapsed,
+                'rate': rate,
+                'averageRate': averageRate,
+                'etaSeconds': eta
+                }
+
+    def log(self, message: str = '') -> None:
+        # One progress line to the console in place of the old prints of the counts
+        snapshot = self.snapshot()
+        total = f" / {snapshot['total']}" if snapshot['total'] is not None else ''
+        eta = f", ETA {formatSeconds(snapshot['etaSeconds'])}" if snapshot['etaSeconds'] is not None else ''
+        print(f"{self.name}: {snapshot['done']}{total} {snapshot['rate']:.1f}/s{eta}{' ' + message if message else ''}")
+
+def formatSeconds(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours > 0 else f"{minutes}m {seconds:02d}s"
+
+def labelText(labels: Labels) -> str:
+    return ','.join(f"{name}={value}" for name, value in labels)
+
+def prometheusLabels(labels: Labels, extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Metrics:
+    """
+    Counters, latency histograms and task progress of the data queries.
+    Counters and histograms are keyed by a name and labels given as keywords, for example
+    increment('matches', ratio='90'). Everything is kept in dicts behind one lock,
+    an update costs a few microseconds which is nothing next to an api call or a fuzzy match.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.started = time()
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.progresses: dict[str, Progress] = {}
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def progress(self, name: str, total: Optional[int] = None) -> Progress:
+        """
+        A new progress for the task, replaces an earlier one of the same name.
+        """
+        progress = Progress(name, total)
+        with self.lock:
+            self.progresses[name] = progress
+        return progress
+
+    def counter(self, name: str, **labels: str) -> float:
+        return self.counters.get((name, tuple(labels.items())), 0)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started = time()
+            self.counters.clear()
+            self.histograms.clear()
+            self.progresses.clear()
+
+    def toDict(self) -> dict:
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, histogram.toDict()) for key, histogram in self.histograms.items()]
+            progresses = list(self.progresses.values())
+        exported: dict[str, Any] = {
+                'time': time(),
+                'uptimeSeconds': time() - self.started,
+                'counters': {},
+                'histograms': {},
+                'progress': {progress.name: progress.snapshot() for progress in progresses}
+                }
+        for (name, labels), value in sorted(counters):
+            exported['counters'].setdefault(name, {})[labelText(labels)] = value
+        for (name, labels), histogram in sorted(histograms, key=lambda item: item[0]):
+            exported['histograms'].setdefault(name, {})[labelText(labels)] = histogram
+        return exported
+
+    def toPrometheus(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                    ((key, list(histogram.counts), histogram.sum, histogram.count, histogram.buckets)
+                     for key, histogram in self.histograms.items()),
+                    key=lambda item: item[0]
+                    )
+            progresses = list(self.progresses.values())
+
+        lines: list[str] = []
+        typed: set[str] = set()
+        for (name, labels), value in counters:
+            metric = prometheusPrefix + name + '_total'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{prometheusLabels(labels)} {value:g}")
+        for (name, labels), counts, total, count, buckets in histograms:
+            metric = prometheusPrefix + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucketCount in zip((*buckets, '+Inf'), counts):
+                cumulative += bucketCount
+                bucketLabels = prometheusLabels(labels, 'le="' + str(bound) + '"')
+                lines.append(f"{metric}_bucket{bucketLabels} {cumulative}")
+            lines.append(f"{metric}_sum{prometheusLabels(labels)} {total:g}")
+            lines.append(f"{metric}_count{prometheusLabels(labels)} {count}")
+        gauges = ('done', 'total', 'rate', 'etaSeconds')
+        for gauge in gauges:
+            lines.append(f"# TYPE {prometheusPrefix}progress_{gauge} gauge")
+            for progress in progresses:
+                value = progress.snapshot()[gauge]
+                if value is not None:
+                    lines.append(f'{prometheusPrefix}progress_{gauge}{{task="{progress.name}"}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path: str) -> None:
+        """
+        Writes the metrics to path, Prometheus text when the path ends with .prom and json otherwise.
+        """
+        text = self.toPrometheus() if path.endswith('.prom') else jsondumps(self.toDict())
+        filePath = createPath(path)
+        tmpPath = filePath.with_name(filePath.name + '.tmp')
+        tmpPath.write_text(text, encoding='utf8')
+        replace(tmpPath, filePath)
+
+@lru_cache(maxsize=None)
+def getMetrics() -> Metrics:
+    # Metrics of the process, every query function records to these
+    return Metrics()
+
+def measureCall(call: Callable, *args, **kwargs) -> Any:
+    """
+    Makes the api call and records its latency and count by endpoint (the name of the called method).
+    The methods of wrappers that make the api calls themselves (measuresCalls, like cache.CachedSpotify
+    and clients.SpotifyClientPool) are called as is, the wrapper records only the calls that reach the api.
+    """
+    if getattr(getattr(call, '__self__', None), 'measuresCalls', False):
+        return call(*args, **kwargs)
+    metrics = getMetrics()
+    endpoint = getattr(call, '__name__', 'call')
+    start = perf_counter()
+    try:
+        return call(*args, **kwargs)
+    except Exception:
+        metrics.increment('api_errors', endpoint=endpoint)
+        raise
+    finally:
+        metrics.increment('api_calls', endpoint=endpoint)
+        metrics.observe('api_latency_seconds', perf_counter() - start, endpoint=endpoint)
+
+class MetricsExporter:
+    """
+    Saves the metrics to path every interval seconds from a background thread, and once more on stop.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            interval: float = 10.0,
+            metrics: Optional[Metrics] = None
+            ) -> None:
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics if metrics is not None else getMetrics()
+        self.stopped = Event()
+        self.thread: Optional[Thread] = None
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.metrics.save(self.path)
+            except OSError as e:
+                print(f"Could not save the metrics to {self.path}: {e}")
+
+    def start(self) -> 'MetricsExporter':
+        if self.thread is None:
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.metrics.save(self.path)
+
+    def __enter__(self) -> 'MetricsExporter':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,37 @@
+from typing import Iterable
+
+# A rule of the song query plan: (name, useArtistInQuery, matchingRatio)
+MatchRule = tuple[str, bool, int]
+# A threshold the results of one search are scored at: (rule name, matchingRatio)
+Threshold = tuple[str, int]
+# Rule name of the songs found in the local catalog (catalog.LocalCatalog) instead of a search
+catalogRule = 'catalog'
+
+# Exact name with the song name search, the same results again with the relaxed ratio,
+# and the search with the artist only for the songs neither matched
+defaultMatchRules: tuple[MatchRule, ...] = (
+        ('exact', False, 100),
+        ('title', False, 90),
+        ('artist', True, 90)
+        )
+
+def planQueries(rules: Iterable[MatchRule]) -> list[tuple[bool, list[Threshold]]]:
+    """
+    The searches the rules need in the order of the rules, each with the thresholds its results are scored at.
+    The rules of the same search next to each other share the search, ('exact', False, 100) and ('title', False, 90)
+    make one song name search that is scored first at 100 and then at 90.
+    """
+    plan: list[tuple[bool, list[Threshold]]] = []
+    for name, useArtistInQuery, matchingRatio in rules:
+        if len(plan) == 0 or plan[-1][0] != useArtistInQuery:
+            plan.append((useArtistInQuery, []))
+        plan[-1][1].append((name, matchingRatio))
+    return plan
+
+def planRatios(rules: Iterable[MatchRule]) -> list[int]:
+    # The distinct ratios of the rules in the order they are first used
+    ratios: list[int] = []
+    for _, _, matchingRatio in rules:
+        if matchingRatio not in ratios:
+            ratios.append(matchingRatio)
+    return ratios
@@ -0,0 +1,142 @@
+from typing import Any, Callable, Optional
+from threading import Condition
+from time import monotonic
+
+from .metrics import getMetrics, measureCall
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread that calls the api.
+    rate is the number of calls per second the bucket refills, burst the bucket size
+    and maxInFlight the number of calls that can wait for a response at the same time.
+    A 429 response pauses all the callers for the Retry-After time.
+    """
+
+    def __init__(
+            self,
+            rate: float = 10.0,
+            burst: int = 10,
+            maxInFlight: int = 8
+            ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.maxInFlight = maxInFlight
+        self.tokens = float(burst)
+        self.inFlight = 0
+        self.updated = monotonic()
+        self.pausedUntil = 0.0
+        self.condition = Condition()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        with self.condition:
+            while True:
+                now = monotonic()
+                self._refill(now)
+                wait: Optional[float]
+                if now < self.pausedUntil:
+                    wait = self.pausedUntil - now
+                elif self.inFlight >= self.maxInFlight:
+                    # Woken up by release
+                    wait = None
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.inFlight += 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+                self.condition.wait(wait)
+
+    def tryAcquire(self) -> bool:
+        """
+        acquire without waiting, False when the call can't be made right now.
+        """
+        with self.condition:
+            now = monotonic()
+            self._refill(now)
+            if now < self.pausedUntil or self.inFlight >= self.maxInFlight or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.inFlight += 1
+            return True
+
+    def release(self) -> None:
+        with self.condition:
+            self.inFlight -= 1
+            self.condition.notify_all()
+
+    def __enter__(self) -> 'RateLimiter':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    def throttle(self, retryAfter: float) -> None:
+        """
+        Pause every caller for retryAfter seconds and empty the bucket
+        so the calls don't come in as a burst when the pause ends.
+        """
+        with self.condition:
+            now = monotonic()
+            self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+            self.tokens = 0.0
+            self.updated = now
+            self.condition.notify_all()
+
+    def available(self) -> float:
+        """
+        Calls that could be made right now, 0 when paused.
+        """
+        with self.condition:
+            now = monotonic()
+            if now < self.pausedUntil:
+                return 0.0
+            self._refill(now)
+            return min(self.tokens, float(self.maxInFlight - self.inFlight))
+
+def getRetryAfter(exception: Exception, default: float = 1.0) -> Optional[float]:
+    """
+    Seconds to wait from a 429 response, None if the exception is not a rate limit response.
+    """
+    from spotipy import SpotifyException
+
+    if not isinstance(exception, SpotifyException) or exception.http_status != 429:
+        return None
+
+    headers = exception.headers or {}
+    try:
+        return float(headers.get('Retry-After', default))
+    except (TypeError, ValueError):
+        return default
+
+def callWithLimiter(
+        limiter: Optional[RateLimiter],
+        call: Callable,
+        *args,
+        maxRateLimitRetries: int = 10,
+        **kwargs
+        ) -> Any:
+    """
+    Makes the call through the limiter, 429 responses throttle the limiter and the call is made again.
+    Without a limiter the call is made as is. Every api call is counted and timed in the metrics (see measureCall).
+    """
+    if limiter is None:
+        return measureCall(call, *args, **kwargs)
+
+    rateLimited = 0
+    while True:
+        with limiter:
+            try:
+                return measureCall(call, *args, **kwargs)
+            except Exception as e:
+                retryAfter = getRetryAfter(e)
+                if retryAfter is None or rateLimited >= maxRateLimitRetries:
+                    raise
+                rateLimited += 1
+                getMetrics().increment('rate_limited', endpoint=getattr(call, '__name__', 'call'))
+                print(f"Rate limited, waiting {retryAfter} seconds")
+                limiter.throttle(retryAfter)
@@ -0,0 +1,278 @@
+from typing import Any, Iterator, Optional, Union
+from collections.abc import MutableMapping
+from array import array
+
+from data.types.spotify import SpotifyFeatures, SpotifySongData, SpotifySongQueryResult
+
+# Key order of the stored dicts, a record is only made compact when its dicts have exactly these keys
+queryResultKeys = ('spotifyData', 'searchQuery', 'minMatchingRatioUsed', 'matchRule', 'originalData')
+# The query results stored before the match rule was recorded
+legacyQueryResultKeys = ('spotifyData', 'searchQuery', 'minMatchingRatioUsed', 'originalData')
+songInfoKeys = ('name', 'songID', 'artists', 'album')
+artistKeys = ('name', 'artistID')
+albumKeys = ('name', 'albumID', 'totalTracks', 'releaseDate')
+featureNames = tuple(SpotifyFeatures.__annotations__.keys())
+
+# Kinds of records
+queryResultKind = 0
+songDataKind = 1
+songDataWithLabelsKind = 2
+
+class SongRecord:
+    """
+    One stored song without the dicts: artists, album and chart row are indexes to the tables of the store
+    and the audio features are an array of doubles with a bit per feature that was an int.
+    resultKeys is the key layout of the query result, queryResultKeys or legacyQueryResultKeys.
+    """
+    __slots__ = (
+            'kind', 'name', 'songID', 'artists', 'album', 'searchQuery', 'ratio',
+            'matchRule', 'resultKeys', 'chartRow', 'features', 'integerMask', 'labels'
+            )
+
+    def __init__(
+            self,
+            kind: int,
+            name: str,
+            songID: str,
+            artists: tuple[int, ...],
+            album: int,
+            searchQuery: Optional[str],
+            ratio: Optional[int],
+            matchRule: Optional[str],
+            resultKeys: tuple[str, ...],
+            chartRow: int,
+            features: Optional[array] = None,
+            integerMask: int = 0,
+            labels: Optional[dict] = None
+            ) -> None:
+        self.kind = kind
+        self.name = name
+        self.songID = songID
+        self.artists = artists
+        self.album = album
+        self.searchQuery = searchQuery
+        self.ratio = ratio
+        self.matchRule = matchRule
+        self.resultKeys = resultKeys
+        self.chartRow = chartRow
+        self.features = features
+        self.integerMask = integerMask
+        self.labels = labels
+
+class InternTable:
+    """
+    Distinct tuples with an index each, a tuple added again gets the index it got the first time.
+    """
+
+    def __init__(self) -> None:
+        self.rows: list[tuple] = []
+        self.index: dict[tuple, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, row: tuple) -> int:
+        i = self.index.get(row)
+        if i is None:
+            i = len(self.rows)
+            self.rows.append(row)
+            self.index[row] = i
+        return i
+
+def hasKeys(value: Any, keys: tuple) -> bool:
+    return type(value) is dict and tuple(value.keys()) == keys
+
+class CompactSongStore(MutableMapping):
+    """
+    Stored query results (SpotifySongQueryResult) and features (SpotifySongData) kept as SongRecords
+    instead of nested dicts. Artists and albums are interned in tables shared by every record,
+    the chart row (originalData) is a reference to a row of the chart row table instead of a copy
+    and the repeated strings (dates, ranks) are kept once.
+    Reading a key builds the stored dict again in the same shape and key order, so callers and the saved json
+    see no difference. Changes to the built dicts are not stored, store the dict again for that.
+    Records that don't have the usual shape are kept as they are.
+    """
+
+    def __init__(self, data: Optional[dict] = None) -> None:
+        self.records: dict[str, Union[SongRecord, SpotifySongQueryResult, SpotifySongData]] = {}
+        self.artists = InternTable()
+        self.albums = InternTable()
+        self.chartRows = InternTable()
+        self.chartLayouts: dict[tuple, tuple] = {}
+        self.strings: dict[str, str] = {}
+        if data is not None:
+            for key, value in data.items():
+                self[key] = value
+
+    def _string(self, value: Any) -> Any:
+        if type(value) is not str:
+            return value
+        return self.strings.setdefault(value, value)
+
+    def _chartRow(self, row: Optional[dict]) -> Optional[int]:
+        if row is None:
+            return -1
+        if type(row) is not dict:
+            return None
+        keys = tuple(row.keys())
+        layout = self.chartLayouts.setdefault(keys, keys)
+        return self.chartRows.add((layout, *(self._string(value) for value in row.values())))
+
+    def _songRecord(self, key: str, result: Any, kind: int) -> Optional[SongRecord]:
+        # None when the query result is not in the usual shape
+        resultKeys: tuple[str, ...]
+        if hasKeys(result, queryResultKeys):
+            resultKeys = queryResultKeys
+        elif hasKeys(result, legacyQueryResultKeys):
+            resultKeys = legacyQueryResultKeys
+        else:
+            return None
+        info = result['spotifyData']
+        if not hasKeys(info, songInfoKeys) or type(info['artists']) is not list:
+            return None
+        if not all(hasKeys(artist, artistKeys) for artist in info['artists']):
+            return None
+        album = info['album']
+        if album is not None and not hasKeys(album, albumKeys):
+            return None
+        chartRow = self._chartRow(result['originalData'])
+        if chartRow is None:
+            return None
+
+        artists = tuple(self.artists.add((artist['name'], artist['artistID'])) for artist in info['artists'])
+        albumIndex = -1
+        if album is not None:
+            albumIndex = self.albums.add((
+                    album['name'],
+                    album['albumID'],
+                    album['totalTracks'],
+                    self._string(album['releaseDate'])
+                    ))
+        songID = info['songID']
+        # The id is the key of the feature stores, no need for two copies of the string
+        if songID == key:
+            songID = key
+        return SongRecord(
+                kind,
+                info['name'],
+                songID,
+                artists,
+                albumIndex,
+                result['searchQuery'],
+                result['minMatchingRatioUsed'],
+                self._string(result.get('matchRule')),
+                resultKeys,
+                chartRow
+                )
+
+    def _featureRecord(self, key: str, songData: Any) -> Optional[SongRecord]:
+        if hasKeys(songData, ('info', 'features')):
+            kind = songDataKind
+        elif hasKeys(songData, ('info', 'features', 'labels')):
+            kind = songDataWithLabelsKind
+        else:
+            return None
+        features = songData['features']
+        if type(features) is not dict or (len(features) > 0 and tuple(features.keys()) != featureNames):
+            return None
+        values = array('d')
+        integerMask = 0
+        for i, value in enumerate(features.values()):
+            if type(value) is int and abs(value) < 2 ** 53:
+                integerMask |= 1 << i
+            elif type(value) is not float:
+                return None
+            values.append(value)
+
+        record = self._songRecord(key, songData['info'], kind)
+        if record is None:
+            return None
+        record.features = values
+        record.integerMask = integerMask
+        record.labels = songData.get('labels')
+        return record
+
+    def __setitem__(self, key: str, value: Union[SpotifySongQueryResult, SpotifySongData]) -> None:
+        if type(value) is dict and 'info' in value:
+            record = self._featureRecord(key, value)
+        else:
+            record = self._songRecord(key, value, queryResultKind)
+        self.records[key] = record if record is not None else value
+
+    def _queryResult(self, record: SongRecord) -> SpotifySongQueryResult:
+        albumIndex = record.album
+        # Rebuilt from the table rows, the keys are the ones of the stored dicts
+        album: Any = None
+        if albumIndex >= 0:
+            album = dict(zip(albumKeys, self.albums.rows[albumIndex]))
+        chartRow: Any = None
+        if record.chartRow >= 0:
+            row = self.chartRows.rows[record.chartRow]
+            chartRow = dict(zip(row[0], row[1:]))
+        artistRows = self.artists.rows
+        result: SpotifySongQueryResult = {
+                'spotifyData': {
+                    'name': record.name,
+                    'songID': record.songID,
+                    'artists': [{'name': name, 'artistID': artistID} for name, artistID in (artistRows[i] for i in record.artists)],
+                    'album': album
+                    },
+                'searchQuery': record.searchQuery,
+                'minMatchingRatioUsed': record.ratio,
+                'matchRule': record.matchRule,
+                'originalData': chartRow
+                }
+        if record.resultKeys is legacyQueryResultKeys:
+            del result['matchRule']
+        return result
+
+    def __getitem__(self, key: str) -> Union[SpotifySongQueryResult, SpotifySongData]:
+        record = self.records[key]
+        if not isinstance(record, SongRecord):
+            return record
+        if record.kind == queryResultKind:
+            return self._queryResult(record)
+
+        integerMask = record.integerMask
+        songData: SpotifySongData = {
+                'info': self._queryResult(record),
+                'features': {
+                    name: int(value) if integerMask >> i & 1 else value
+                    for i, (name, value) in enumerate(zip(featureNames, record.features))
+                    }
+                }
+        if record.kind == songDataWithLabelsKind:
+            songData['labels'] = record.labels
+        return songData
+
+    def __delitem__(self, key: str) -> None:
+        # The table rows of the record stay, they are few compared to the records
+        del self.records[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.records
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+def createRecordStore(
+        data: dict,
+        records: Optional[str] = None
+        ) -> MutableMapping:
+    """
+    Record representations by name, 'dict' (the default) keeps the loaded dicts as they are,
+    'compact' moves them to a CompactSongStore.
+    """
+    if records is None or records == 'dict':
+        return data
+    elif records == 'compact':
+        store = CompactSongStore()
+        # Move the records over one at a time and drop the dicts as they go
+        for key in list(data.keys()):
+            store[key] = data.pop(key)
+        return store
+
+    raise ValueError(f"Unknown record representation {records}")
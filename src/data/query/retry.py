@@ -0,0 +1,166 @@
+from typing import Any, Callable, Optional
+from pathlib import Path
+from random import uniform
+from time import sleep
+
+from .util import loadJson, saveJsonAtomic
+from .ratelimit import RateLimiter, getRetryAfter
+from .metrics import getMetrics
+from data.types.billboard import BillboardSong
+from data.types.spotify import DeadLetter
+
+class QueryFailed(Exception):
+    """
+    Raised when a call has failed and the retry policy gave up on it.
+    """
+
+    def __init__(self, errorType: str, error: Exception, attempts: int) -> None:
+        super().__init__(f"{errorType} after {attempts} attempts: {error}")
+        self.errorType = errorType
+        self.error = error
+        self.attempts = attempts
+
+def classifyError(error: Exception) -> str:
+    """
+    Sorts the errors from the api calls to the ones worth retrying
+    ('rateLimit', 'server', 'timeout', 'connection') and the ones that are not ('client', 'unknown').
+    """
+    # Only needed when a call has failed
+    from spotipy import SpotifyException
+    from requests.exceptions import ConnectionError, Timeout
+
+    if isinstance(error, SpotifyException):
+        if error.http_status == 429:
+            return 'rateLimit'
+        if error.http_status is not None and error.http_status >= 500:
+            return 'server'
+        return 'client'
+    # ConnectTimeout is both, it is a connection error
+    if isinstance(error, ConnectionError):
+        return 'connection'
+    if isinstance(error, Timeout):
+        return 'timeout'
+    return 'unknown'
+
+class RetryPolicy:
+    """
+    Retries the failed calls with jittered exponential backoff.
+    The wait before retry n is a random time between 0 and min(maxDelay, baseDelay * 2**n),
+    rate limit responses wait the Retry-After time instead.
+    """
+
+    def __init__(
+            self,
+            maxAttempts: int = 10,
+            baseDelay: float = 0.5,
+            maxDelay: float = 60.0,
+            retryOn: tuple[str, ...] = ('rateLimit', 'server', 'timeout', 'connection')
+            ) -> None:
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.retryOn = retryOn
+
+    def delay(self, attempt: int) -> float:
+        return uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+
+    def call(
+            self,
+            call: Callable,
+            *args,
+            limiter: Optional[RateLimiter] = None,
+            **kwargs
+            ) -> Any:
+        attempt = 0
+        while True:
+            try:
+                return call(*args, **kwargs)
+            except Exception as e:
+                errorType = classifyError(e)
+                attempt += 1
+                if errorType not in self.retryOn or attempt >= self.maxAttempts:
+                    getMetrics().increment('failed_calls', errorType=errorType)
+                    raise QueryFailed(errorType, e, attempt) from e
+                getMetrics().increment('retries', errorType=errorType)
+
+                retryAfter = getRetryAfter(e)
+                if retryAfter is not None:
+                    # A rate limit response
+                    wait = retryAfter
+                    if limiter is not None:
+                        # Everyone sharing the limiter waits
+                        limiter.throttle(wait)
+                        print(f"Rate limited, retrying after {wait} seconds...")
+                        continue
+                else:
+                    wait = self.delay(attempt)
+                print(f"{errorType} error, retrying in {wait:.2f} seconds...")
+                sleep(wait)
+
+class DeadLetters:
+    """
+    Queries that failed even after the retries.
+    They are kept in a json file next to the store so a later run can query only them.
+    A query has one letter, the one of its latest failure.
+    """
+
+    def __init__(self, storeFilePath: str) -> None:
+        self.path = storeFilePath + '.deadletters.json'
+        self.letters: list[DeadLetter] = []
+        # Position of the letter of every (query, useArtistInQuery) in letters
+        self.positions: dict[tuple[str, bool], int] = {}
+        if Path(self.path).exists():
+            # The files written before the letters were de-duplicated can have the same query many times
+            for letter in loadJson(self.path):
+                self._put(letter)
+
+    def _put(self, letter: DeadLetter) -> None:
+        key = (letter['query'], letter['useArtistInQuery'])
+        position = self.positions.get(key)
+        if position is None:
+            self.positions[key] = len(self.letters)
+            self.letters.append(letter)
+        else:
+            self.letters[position] = letter
+
+    def add(
+            self,
+            query: str,
+            failure: QueryFailed,
+            track: Optional[BillboardSong],
+            searchLimit: int,
+            matchingRatio: int,
+            useArtistInQuery: bool
+            ) -> None:
+        self._put({
+            'query': query,
+            'errorType': failure.errorType,
+            'error': str(failure.error),
+            'track': track,
+            'searchLimit': searchLimit,
+            'matchingRatio': matchingRatio,
+            'useArtistInQuery': useArtistInQuery
+            })
+
+    def discard(self, isRetried: Callable[[DeadLetter], bool]) -> None:
+        """
+        Removes the letters of the queries that are made again, the ones that fail again are added back by the caller.
+        """
+        self.letters = [letter for letter in self.letters if not isRetried(letter)]
+        self.positions = {(letter['query'], letter['useArtistInQuery']): i for i, letter in enumerate(self.letters)}
+
+    def take(self) -> list[DeadLetter]:
+        """
+        Removes and returns the letters, the ones that fail again are added back by the caller.
+        """
+        letters = self.letters
+        self.letters = []
+        self.positions = {}
+        return letters
+
+    def __len__(self) -> int:
+        return len(self.letters)
+
+    def save(self) -> None:
+        if self.letters or Path(self.path).exists():
+            saveJsonAtomic(self.letters, self.path)
@@ -1,13 +1,11 @@
-from typing import Union, Generator, Optional
+from typing import TYPE_CHECKING, Any, Union, Generator, Iterable, Optional, Sequence
+from collections.abc import Mapping, MutableMapping
 from pathlib import Path
-from random import sample as rndSample
-from sys import exit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from random import Random, sample as rndSample
 import base64
 
-from spotipy import Spotify
-from fuzzywuzzy import fuzz
-from requests.exceptions import ReadTimeout
-
 from .util import (
         batch,
         getCredentials, 
@@ -15,6 +13,13 @@ from .util import (
         loadJson, 
         saveJson
         )
+from .store import createStoreBackend
+from .records import createRecordStore
+from .ratelimit import RateLimiter, callWithLimiter
+from .retry import RetryPolicy, QueryFailed, DeadLetters
+from .keys import BillboardKeyIndex, createCanonicalKey, normalizeText
+from .metrics import getMetrics
+from .planner import MatchRule, Threshold, catalogRule, defaultMatchRules, planQueries, planRatios
 from data.types.util import Credentials
 from data.types.billboard import BillboardSong
 from data.types.spotify import (
@@ -27,35 +32,36 @@ from data.types.spotify import (
         SpotifySongQueryResult
         )
 
-# List of blacklisted string in the results
-# a query can result in a different version of the song that's actually been fetched
-# so this is a blocking measure to not include them
-blackList = [
-        'Version', 
-        'Instrumental',
-        'Emulation',
-        'Remix'
-        ]
-
-whiteList = [
-        "Taylor's Version", 
-        'No New Friends', 
-        'Karate Chop',
-        'Get Sleazier',
-        "Don't cry me Argentina",
-        'Outta Control',
-        'A Country Boy Can Survive',
-        'Turn It Up /',
-        "Love Theme From St.Elmo's Fire"
-        ]
+if TYPE_CHECKING:
+    # spotipy, fuzzywuzzy and numpy are imported by the functions that use them
+    # so loading stored data doesn't pay for them
+    from spotipy import Spotify
+    from .matchpool import SlimSong
 
 class SpotifyDataHandler:
 
-    def __init__(self, storeFilePath: str) -> None:
-        self.data: dict[str, SpotifySongQueryResult | SpotifySongData] = {}
+    def __init__(
+            self, 
+            storeFilePath: str, 
+            backend: Optional[str] = None,
+            records: Optional[str] = None,
+            **backendOptions
+        ) -> None:
+        """
+        backend selects how the store is written, see store.createStoreBackend.
+        The default 'json' rewrites the whole file on overwrite,
+        'log' appends every stored record to a log and compacts it periodically.
+        Both load an existing json store from storeFilePath.
+        records selects how the records are kept in memory, see records.createRecordStore.
+        With 'compact' data is a records.CompactSongStore that gives the same dicts on read.
+        """
         self.storePath = storeFilePath
-        if Path(storeFilePath).exists():
-            self.data = loadJson(self.storePath)
+        self.backend = createStoreBackend(storeFilePath, backend, **backendOptions)
+        # Query results in the hit and not hit stores, song data in the feature stores
+        self.data: MutableMapping[str, Any] = createRecordStore(
+                self.backend.load(),
+                records
+                )
     
     @staticmethod
     def createKey(songName: str, artist: str) -> str:
@@ -63,12 +69,17 @@ class SpotifyDataHandler:
 
     def storeSong(
             self, 
-            query: str, 
+            query: Optional[str], 
             song: SpotifySongInfo, 
-            matchingRatio: int, 
+            matchingRatio: Optional[int], 
             track: Optional[BillboardSong],
-            save: bool = False
+            save: bool = False,
+            matchRule: Optional[str] = None
         ) -> None:
+        """
+        matchRule is the name of the rule of the query plan the song matched with (planner.MatchRule),
+        None for the songs that were not matched to a chart song.
+        """
         if track is not None:
             key = self.createKey(track['song'], track['artist'])
         else:
@@ -76,12 +87,15 @@ class SpotifyDataHandler:
 
         if key not in self.data.keys():
             # Add song to the dataset
-            self.data[key] = {
+            record: SpotifySongQueryResult = {
                 'spotifyData': song, 
                 'searchQuery': query, 
                 'minMatchingRatioUsed': matchingRatio,
+                'matchRule': matchRule,
                 'originalData': track
                 }
+            self.data[key] = record
+            self.backend.append(key, record)
 
             # Update the stored json file
             if save:
@@ -91,20 +105,24 @@ class SpotifyDataHandler:
 
     def storeFeatures(self, sid: str, songData: SpotifySongData, save: bool = False) -> None:
         self.data[sid] = songData
+        self.backend.append(sid, songData)
         if save:
             self.overwrite()
 
     def overwrite(self) -> None:
-        saveJson(self.data, self.storePath)
+        """
+        Checkpoint the store, with the log backend this compacts only when the log has grown enough.
+        """
+        self.backend.checkpoint(self.data)
+
+    def compact(self) -> None:
+        """
+        Write everything into the store file, after this the file at storePath has all the data.
+        """
+        self.backend.compact(self.data)
 
-def checkIfBlackListed(name: str) -> bool:
-    for blackListed in blackList:
-        if blackListed.lower() in name.lower():
-            for whiteListed in whiteList:
-                if whiteListed.lower() in name.lower():
-                    return False
-            return True
-    return False
+    def close(self) -> None:
+        self.backend.close()
 
 def parseSongInfo(
         songRaw: dict, 
@@ -138,35 +156,81 @@ def parseSongInfo(
 
 
 def songQuery(
-        api: Spotify, 
+        api: 'Spotify', 
         query: str, 
-        limit: int = 10
+        limit: int = 10,
+        limiter: Optional[RateLimiter] = None,
+        retryPolicy: Optional[RetryPolicy] = None
         ) -> list[SpotifySongInfo]:
     """
-    Implements the querying, if network issues a retry limit can be defined
+    Implements the querying, network errors, 429 and 5xx responses are retried with the retryPolicy.
+    With a limiter the search is paced by it and 429 responses are waited out
+    Raises QueryFailed when the policy gives up
     """
     infos: list[SpotifySongInfo] = []
-    queried: bool = False
-    queryNum: int = 1
-    queryLimit: int = 10
-    try:
-        while not queried:
-            if queryNum >= queryLimit:
-                raise Exception
-            try:
-                queryNum +=1
-                for result in api.search(query, limit)['tracks']['items']: 
-                    infos.append(parseSongInfo(result))
-                queried = True
-            except ReadTimeout:
-                print("Timed out trying again...")
-    except Exception:
-        print("Max query num over...")
-        print("exiting...")
-        exit()
+    for song in songSearch(api, query, limit, limiter, retryPolicy): 
+        infos.append(parseSongInfo(song))
 
     return infos
 
+def songSearch(
+        api: 'Spotify', 
+        query: str, 
+        limit: int = 10,
+        limiter: Optional[RateLimiter] = None,
+        retryPolicy: Optional[RetryPolicy] = None
+        ) -> list[dict]:
+    """
+    The search result items as they come from the api, see songQuery
+    """
+    if retryPolicy is None:
+        retryPolicy = RetryPolicy()
+
+    result = retryPolicy.call(callWithLimiter, limiter, api.search, query, limit, limiter=limiter)
+    return result['tracks']['items']
+
+def songQueries(
+        api: 'Spotify',
+        queries: Iterable[str],
+        limit: int = 10,
+        limiter: Optional[RateLimiter] = None,
+        workers: int = 1,
+        retryPolicy: Optional[RetryPolicy] = None,
+        slim: bool = False
+        ) -> Generator[Union[list[SpotifySongInfo], list['SlimSong'], QueryFailed], None, None]:
+    """
+    Runs songQuery for every query keeping up to workers searches in flight.
+    The results are yielded in the same order as the queries
+    so whatever is done with them happens in the same order on every run.
+    A query that failed yields its QueryFailed error instead of the songs.
+    With slim the songs are yielded as matchpool.SlimSong tuples,
+    the full response is dropped in the searching thread
+    """
+    from .matchpool import slimSearchItems
+
+    def query(q: str) -> Union[list[SpotifySongInfo], list['SlimSong'], QueryFailed]:
+        try:
+            if slim:
+                return slimSearchItems(songSearch(api, q, limit, limiter, retryPolicy))
+            return songQuery(api, q, limit, limiter, retryPolicy)
+        except QueryFailed as e:
+            return e
+
+    if workers <= 1:
+        for q in queries:
+            yield query(q)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: deque = deque()
+        for q in queries:
+            pending.append(pool.submit(query, q))
+            # Keep a few queries queued per worker so the workers don't wait for the consumer
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
 def songMatching(
         songToMatch: str, 
         artistToMatch: str,
@@ -178,30 +242,14 @@ def songMatching(
     The song query from spotify is basically a string matching process.
     The api returns results even if the song doesn't exist in the spotify collection.
     To filter out songs some string matching have to be intoduced.
+    See matching.SongMatcher for the rules.
     """
-    if checkIfBlackListed(resultSong):
-        return False
-    
-    # Exact match search
-    if allowedRatio == 100:
-        if songToMatch.lower() == resultSong.lower():
-            # If song name matches check if the artist is found in artists
-            # and if it is, this will be enough to add the song
-            if 95 <= fuzz.token_set_ratio(artistToMatch, ' '.join((artist['name'] for artist in resultArtists))):
-                return True
-        return False
-    
-    # Some tracks do not match exactly for example feature feat. etc
-    # so they can be fetched by matching based on tokens after tokenization of the strings
-    if allowedRatio <= fuzz.token_set_ratio(songToMatch, resultSong):
-        if allowedRatio <= fuzz.token_set_ratio(artistToMatch ,' '.join((artist['name'] for artist in resultArtists))):
-            return True
-        return False
-    
-    return False
+    from .matching import getSongMatcher
+
+    return getSongMatcher().match(songToMatch, artistToMatch, resultSong, resultArtists, allowedRatio)
 
 def getSpotifyDataFromBillboardSongs(
-        api: Spotify,
+        api: 'Spotify',
         billboardTracks: list[BillboardSong],
         savePath: str = "../datasets/spotify/spotifyData.json"
         ) -> list[SpotifySongInfo]:
@@ -223,12 +271,13 @@ def getSpotifyDataFromBillboardSongs(
         # This is used to remove duplicates
         madeQueries: set[str] = set()
         duplicates: list[int] = []
+        progress = getMetrics().progress(f"songs ratio {matchingRatio}", len(tracks) if isinstance(tracks, list) else None)
         for i, track in enumerate(tracks):
             
-            # Log status to console every 100k songs or when finished
-            if i % 100000 == 0 or i+1 == len(tracks):
-                print("Queried songs: ", i)
-                print("Matched songs: ", len(madeQueries))
+            # Log status to console every 100k songs
+            progress.done = i
+            if i % 100000 == 0:
+                progress.log(f"matched {len(matches)}")
                 
             billboardSongName: str = track['song']
             billboardArtistName: str = track['artist']
@@ -237,10 +286,17 @@ def getSpotifyDataFromBillboardSongs(
             if useArtistInQuery:
                 query = query + ' ' + billboardArtistName
                 
-            if query not in madeQueries:
-                madeQueries.add(query)
+            # Case, punctuation and whitespace differences don't make a new query
+            queryKey = normalizeText(query)
+            if queryKey not in madeQueries:
+                madeQueries.add(queryKey)
                 unMatchedIndexes.append(i)
-                for song in songQuery(api, query, searchLimit):
+                try:
+                    songs = songQuery(api, query, searchLimit)
+                except QueryFailed as e:
+                    print(f"Query {query} failed: {e}")
+                    songs = []
+                for song in songs:
                     if songMatching(
                             billboardSongName, 
                             billboardArtistName, 
@@ -295,154 +351,285 @@ def getUniqueBillboardSongs(songs: list[BillboardSong]) -> list[BillboardSong]:
     return uniques
 
 def getSpotifyDataFromBillboardSongsV2(
-        api: Spotify,
+        api: 'Spotify',
         billboardTracks: list[BillboardSong],
-        savePath: str = "../datasets/spotify/spotifyData.json"
-        ) -> dict[str, SpotifySongQueryResult]:
+        savePath: str = "../datasets/spotify/spotifyData.json",
+        storeBackend: Optional[str] = None,
+        workers: int = 1,
+        limiter: Optional[RateLimiter] = None,
+        retryPolicy: Optional[RetryPolicy] = None,
+        redrive: bool = False,
+        keyIndexPath: Optional[str] = None,
+        matchProcesses: int = 0,
+        records: Optional[str] = None,
+        useCatalog: bool = False,
+        catalogPath: Optional[str] = None,
+        matchRules: Iterable[MatchRule] = defaultMatchRules
+        ) -> Mapping[str, SpotifySongQueryResult]:
     """
     If data is found in defined path, retrieve it
     else query the data from spotify api
+    storeBackend is passed to SpotifyDataHandler, 'log' makes the checkpoints append only
+    workers is the number of searches kept in flight, all of them are paced by the limiter
+    (a clients.SpotifyClientPool paces the calls itself and gets no default limiter)
+    Queries that fail after the retries of retryPolicy are saved as dead letters next to the store,
+    with redrive only those are queried again and billboardTracks is not used.
+    The chart rows are deduplicated with a canonical song/artist key index (keys.BillboardKeyIndex)
+    that is saved to keyIndexPath, by default next to the store, and only keys missing from the store are queried.
+    An empty keyIndexPath builds the index without saving it.
+    With matchProcesses the search results are matched in that many processes (matchpool.MatchingPool)
+    while the searches go on, the results are still stored in order from this thread.
+    records is passed to SpotifyDataHandler, 'compact' keeps the store in memory as records.CompactSongStore.
+    With useCatalog every chart song is first looked up from the songs already in the store
+    and the album listings saved to catalogPath (see catalog.LocalCatalog and fetchAlbumTracksV2),
+    by default next to the store, only the songs not found there are searched.
+    The songs found in the catalog are stored without a searchQuery and the new matches are saved to the catalog,
+    pass the same catalogPath to getSongsWithAlbumsV2 to add the album listings to it.
+    matchRules is the query plan (planner.planQueries): the rules of one search score its results at every ratio
+    in order and the next search is made only for the songs none of them matched.
+    The default searches the song name once and matches it exactly and then with ratio 90,
+    only the songs neither matched are searched with the artist.
+    Every stored song has the name of the rule it matched with in matchRule ('catalog' for the local matches).
     """
+    if workers > 1 and limiter is None and not getattr(api, 'pacesCalls', False):
+        limiter = RateLimiter(maxInFlight=workers)
+    deadLetters = DeadLetters(savePath)
+    catalog = None
+    if useCatalog:
+        from .catalog import LocalCatalog
+
+        if catalogPath is None:
+            catalogPath = savePath + '.catalog.json'
+        catalog = LocalCatalog.loadOrCreate(catalogPath)
+    matchRules = list(matchRules)
+    plan = planQueries(matchRules)
+    # The catalog is matched at every ratio of the plan before any search
+    catalogRatios = planRatios(matchRules)
+
     def fetchSongsByNameFromSpotify(
         tracks: Union[list, Generator],
         searchLimit: int = 1,
-        matchingRatio: int = 80,
+        thresholds: Sequence[Threshold] = (('title', 80),),
         useArtistInQuery: bool = True,
         songHandler: SpotifyDataHandler = None
         ) -> tuple[SpotifyDataHandler, list[int], list[int]]:
         """
-        Does the actual querying of the data
+        Does the actual querying of the data, every result set is scored at the thresholds in order
         """
         if songHandler is None:
-            songHandler = SpotifyDataHandler(savePath)
+            songHandler = SpotifyDataHandler(savePath, storeBackend, records)
         unMatchedIndexes: list[int] = []
         # This is used to remove duplicates
         matchedSongs = 0
         duplicates: list[int] = []
-        for i, track in enumerate(tracks):
+
+        def createQuery(track: BillboardSong) -> str:
+            query = track['song']
+            if useArtistInQuery:
+                query = query + ' ' + track['artist']
+            return query
+
+        # The songs found in the local catalog are not searched
+        tracks = list(tracks)
+        localMatches: list[Optional[tuple[SpotifySongInfo, int]]] = [
+                catalog.lookupRatios(track['song'], track['artist'], catalogRatios) if catalog is not None else None
+                for track in tracks
+                ]
+        searchTracks = [track for track, local in zip(tracks, localMatches) if local is None]
+        if catalog is not None:
+            print(f"Found {len(tracks) - len(searchTracks)} of {len(tracks)} songs in the local catalog")
+
+        # The searches and the matching can run concurrently but the results are stored in the order of the tracks
+        results = songQueries(
+                api, 
+                (createQuery(track) for track in searchTracks), 
+                searchLimit, 
+                limiter, 
+                workers, 
+                retryPolicy,
+                slim=True
+                )
+        searchMatches = matchingPool.matchAll(
+                ((track['song'], track['artist'], songs) for track, songs in zip(searchTracks, results)),
+                thresholds
+                )
+        matches = (
+                (local[0], catalogRule, local[1]) if local is not None else next(searchMatches)
+                for local in localMatches
+                )
+        metrics = getMetrics()
+        # The most relaxed ratio of the search for the dead letters
+        matchingRatio = min(ratio for _, ratio in thresholds)
+        rules = '/'.join(rule for rule, _ in thresholds)
+        progress = metrics.progress(f"songs {rules}", len(tracks))
+        for i, (track, match) in enumerate(zip(tracks, matches)):
             
-            # Log status to console every 5k songs or when finished
+            # Log status to console every 5k songs
+            progress.done = i
             if i % 5000 == 0 and i != 0:
-                print("Queried songs: ", i)
-                print("Matched songs: ", matchedSongs)
+                progress.log(f"matched {matchedSongs}")
                 # Save the collected songs every 5k queries
                 songHandler.overwrite()
+                deadLetters.save()
                 
-            billboardSongName: str = track['song']
-            billboardArtistName: str = track['artist']
-            
-            query = billboardSongName
-            if useArtistInQuery:
-                query = query + ' ' + billboardArtistName
+            query = createQuery(track)
+
+            if isinstance(match, QueryFailed):
+                # Not a miss, the query is made again when the dead letters are redriven
+                print(f"Query {query} failed: {match}")
+                deadLetters.add(query, match, track, searchLimit, matchingRatio, useArtistInQuery)
+                continue
                 
-            unMatchedIndexes.append(i)
-            for song in songQuery(api, query, searchLimit):
-                if songMatching(
-                        billboardSongName, 
-                        billboardArtistName, 
-                        song['name'], 
-                        song['artists'], 
-                        matchingRatio
-                        ):
-
-                    songHandler.storeSong(query, song, matchingRatio, track)
-                    matchedSongs +=1
-                    unMatchedIndexes.pop()
-                    break
+            if match is not None:
+                song, rule, ratio = match
+                searched = localMatches[i] is None
+                songHandler.storeSong(query if searched else None, song, ratio, track, matchRule=rule)
+                if searched and catalog is not None:
+                    catalog.addInfo(song)
+                metrics.increment('matches', ratio=str(ratio), rule=rule, source='search' if searched else 'catalog')
+                matchedSongs +=1
             else:
+                metrics.increment('not_matched', rules=rules)
+                unMatchedIndexes.append(i)
                 duplicates.append(i)
         
-        print("All songs queried ", i+1)
+        progress.done = len(tracks)
+        print("All songs queried ", len(tracks))
         print("Matched songs: ", matchedSongs)
     
         songHandler.overwrite()
+        deadLetters.save()
         return (songHandler, unMatchedIndexes, duplicates)
     
+    def runPlan(
+            queryTracks: list[BillboardSong],
+            handler: SpotifyDataHandler,
+            searches: list[tuple[bool, list[Threshold]]],
+            searchLimit: int = 3
+            ) -> None:
+        # Every search is made only for the songs the searches before it did not match
+        for i, (useArtistInQuery, thresholds) in enumerate(searches):
+            if len(queryTracks) == 0:
+                break
+            rules = ', '.join(f"{rule} ({ratio})" for rule, ratio in thresholds)
+            if i > 0:
+                print(f"Next search with the {'artist' if useArtistInQuery else 'song name'}... {len(queryTracks)} tracks")
+            before = len(handler.data.keys())
+            handler, notMatched, _ = fetchSongsByNameFromSpotify(queryTracks, searchLimit, thresholds, useArtistInQuery, handler)
+            print(f"From {len(queryTracks)} tracks matched {len(handler.data.keys()) - before} with {rules}")
+            queryTracks = [queryTracks[j] for j in notMatched]
+
     def querySongs(queryTracks: list[BillboardSong], handler: SpotifyDataHandler) -> None:
         print("Total number of songs to query: ", len(queryTracks))
-        # Call API to get the spotify info for tracks with a strict matching
-        # Number of query results = 3 and only song name is used in query
+        # The first search of the default plan uses only the song name and gets 3 results,
+        # they are matched exactly and then with a ratio of 90 as the data does have some information with
+        # differing letters for example American vs European + others that can be matched when the matching isn't so strict.
+        # Only the songs neither matched are searched again with the artist
         stored = len(handler.data.keys())
         print(f"Stored songs before queries {stored}")
-        handler, notMatched, duplicates = fetchSongsByNameFromSpotify(queryTracks, 3, 100, False, handler)
-        newSongs = len(handler.data.keys()) - stored
-        print(f"From {len(queryTracks)} exact matches: {newSongs} Duplicates: {len(duplicates)}")
-
-        # Try to get some matches where the matching isn't so strict
-        # this is because the data does have some information with differing letters for example American vs European
-        # + others that can be matched when the matching isn't so strict
-        print(f"Second search... {len(notMatched)} tracks")
-        handler, _, _ = fetchSongsByNameFromSpotify(
-            (queryTracks[i] for i in notMatched),
-            3,
-            90,
-            True,
-            handler
-        )
-        newSecondQuery = len(handler.data.keys()) - newSongs
-        print(f"Second query from {len(notMatched)} exact matches: {newSecondQuery}")
-        print(f"Total new in {newSongs + newSecondQuery} / {len(queryTracks)} ")
-
-    handler = SpotifyDataHandler(savePath)
-    uniqueBillboardSongs = getUniqueBillboardSongs(billboardTracks)
-    if not Path(savePath).exists():
-        querySongs(uniqueBillboardSongs, handler)
-    else:
-        data = loadJson(savePath)
-        newTracks = []
-        newTracker = set()
-        for track in billboardTracks:
-            searchKey = handler.createKey(track['song'], track['artist'])
-            if searchKey not in handler.data.keys() and searchKey not in newTracker:
-                newTracks.append(track)
-                newTracker.add(searchKey)
+        runPlan(queryTracks, handler, plan)
+        print(f"Total new in {len(handler.data.keys()) - stored} / {len(queryTracks)} ")
+
+    from .matchpool import MatchingPool
+
+    # Shared by both passes so the chart songs are processed once, closed also when a pass raises
+    with MatchingPool(matchProcesses) as matchingPool:
+        handler = SpotifyDataHandler(savePath, storeBackend, records)
+        if catalog is not None:
+            catalog.addStore(handler.data)
+            print(f"Local catalog of {len(catalog)} songs")
+        if redrive:
+            letters = deadLetters.take()
+            print(f"Redriving {len(letters)} failed queries")
+            # Failed song name searches go through the whole plan like new songs,
+            # failed searches with the artist only through the searches with the artist
+            strictTracks: list[BillboardSong] = []
+            relaxedTracks: dict[int, list[BillboardSong]] = {}
+            for letter in letters:
+                track = letter['track']
+                if track is None or handler.createKey(track['song'], track['artist']) in handler.data.keys():
+                    continue
+                if letter['useArtistInQuery']:
+                    relaxedTracks.setdefault(letter['searchLimit'], []).append(track)
+                else:
+                    strictTracks.append(track)
+
+            if len(strictTracks) > 0:
+                querySongs(strictTracks, handler)
+            artistSearches = [search for search in plan if search[0]]
+            for searchLimit, limitTracks in relaxedTracks.items():
+                runPlan(limitTracks, handler, artistSearches, searchLimit)
+        else:
+            if keyIndexPath is None:
+                keyIndexPath = savePath + '.keys.json'
+            keyIndex = BillboardKeyIndex.loadOrBuild(billboardTracks, keyIndexPath or None)
+            storedKeys = {
+                    createCanonicalKey(stored['originalData']['song'], stored['originalData']['artist'])
+                    for stored in handler.data.values() 
+                    if stored.get('originalData') is not None
+                    }
+            newTracks = keyIndex.missingTracks(storedKeys)
+            print(f"{len(billboardTracks)} chart rows, {len(keyIndex)} unique songs, {len(newTracks)} not stored")
+            # The songs that failed on an earlier run are searched again with the new ones
+            retriedKeys = {createCanonicalKey(track['song'], track['artist']) for track in newTracks}
+            deadLetters.discard(
+                    lambda letter: letter['track'] is not None
+                    and createCanonicalKey(letter['track']['song'], letter['track']['artist']) in retriedKeys
+                    )
         
-        if len(newTracks) > 0:
-            querySongs(newTracks, handler)
-    
-    return loadJson(savePath)
+            if len(newTracks) > 0:
+                querySongs(newTracks, handler)
+
+    if catalog is not None and catalogPath is not None:
+        print(f"Local catalog matches {catalog.found} / {catalog.lookups} lookups")
+        catalog.save(catalogPath)
+    # Leave a complete store file behind for the readers of savePath
+    handler.compact()
+    handler.close()
+    deadLetters.save()
+    if len(deadLetters) > 0:
+        print(f"{len(deadLetters)} queries failed, run again with redrive=True to retry them")
+    return handler.data
 
 def getSpotifyAudioFeatures(
-        api: Spotify, 
-        tracks: list[SpotifySongInfo]
+        api: 'Spotify', 
+        tracks: list[SpotifySongQueryResult],
+        workers: int = 4
         ) -> list[SpotifySongData]:
-    
+    from .features import fetchAudioFeatureMatrix
+
+    matrix = fetchAudioFeatureMatrix(api, [track['spotifyData']['songID'] for track in tracks], workers=workers)
     allSpotifySongData: list[SpotifySongData] = []
-    for trackBatch in batch(tracks, 50):
-        trackIDGenerator: Generator = (track['spotifyData']['songID'] for track in trackBatch)
-        for i, featuresResult in enumerate(api.audio_features(trackIDGenerator)):
-            features: SpotifyFeatures = {}
-            if featuresResult is not None:
-                features = {
-                    'timeSignature': featuresResult['time_signature'],
-                    'durationMS': featuresResult['duration_ms'],
-                    'key': featuresResult['key'],
-                    'mode': featuresResult['mode'],
-                    'acousticness': featuresResult['acousticness'],
-                    'danceability': featuresResult['danceability'],
-                    'energy': featuresResult['energy'],
-                    'instrumentalness': featuresResult['instrumentalness'],
-                    'liveness': featuresResult['liveness'],
-                    'loudness': featuresResult['loudness'],
-                    'speechiness': featuresResult['speechiness'],
-                    'valence': featuresResult['valence'],
-                    'tempo': featuresResult['tempo']
+    for track in tracks:
+        songData: SpotifySongData = {
+                'info': track,
+                'features': matrix.features(track['spotifyData']['songID'])
                 }
-
-            songData: SpotifySongData = {
-                    'info': trackBatch[i],
-                    'features': features
-                    }
-
-            allSpotifySongData.append(songData)
+        allSpotifySongData.append(songData)
 
     return allSpotifySongData
 
 def getSpotifyAudioFeaturesV2(
-        api: Spotify, 
-        tracks: list[SpotifySongInfo],
-        storePath: str
-        ) -> dict[str, SpotifySongData]:
+        api: 'Spotify', 
+        tracks: Union[list[SpotifySongQueryResult], Mapping[str, SpotifySongQueryResult]],
+        storePath: str,
+        storeBackend: Optional[str] = None,
+        workers: int = 4,
+        limiter: Optional[RateLimiter] = None,
+        featureMatrixPath: Optional[str] = None,
+        records: Optional[str] = None
+        ) -> Mapping[str, SpotifySongData]:
+    """
+    Fetches the features of the tracks that are not in the store yet.
+    With featureMatrixPath the features are also kept as a float32 matrix (features.AudioFeatureMatrix)
+    that is merged with the one saved on earlier runs.
+    Songs in a feature batch that failed after the retries are not stored, they are saved as dead letters
+    next to the store and fetched again on the next run.
+    """
+    from .features import AudioFeatureMatrix, fetchAudioFeatureMatrix
+
+    if isinstance(tracks, Mapping):
+        tracks = list(tracks.values())
     
     def getNewSongs() -> list:
         newTracks = []
@@ -451,81 +638,144 @@ def getSpotifyAudioFeaturesV2(
                 newTracks.append(track)
         return newTracks
 
-    handler = SpotifyDataHandler(savePath)
+    handler = SpotifyDataHandler(storePath, storeBackend, records)
+    deadLetters = DeadLetters(storePath)
+    # The songs that failed on an earlier run are not stored, they are fetched again with the other new songs
+    deadLetters.take()
     notStoredTracks = getNewSongs()
     print(f"Number of new tracks to be queried {len(notStoredTracks)}")
-    for trackBatch in batch(notStoredTracks, 50):
-        trackIDGenerator: Generator = (track['spotifyData']['songID'] for track in trackBatch)
-        for i, featuresResult in enumerate(api.audio_features(trackIDGenerator)):
-            features: SpotifyFeatures = {}
-            if featuresResult is not None:
-                features = {
-                    'timeSignature': featuresResult['time_signature'],
-                    'durationMS': featuresResult['duration_ms'],
-                    'key': featuresResult['key'],
-                    'mode': featuresResult['mode'],
-                    'acousticness': featuresResult['acousticness'],
-                    'danceability': featuresResult['danceability'],
-                    'energy': featuresResult['energy'],
-                    'instrumentalness': featuresResult['instrumentalness'],
-                    'liveness': featuresResult['liveness'],
-                    'loudness': featuresResult['loudness'],
-                    'speechiness': featuresResult['speechiness'],
-                    'valence': featuresResult['valence'],
-                    'tempo': featuresResult['tempo']
+    matrix = fetchAudioFeatureMatrix(
+            api, 
+            [track['spotifyData']['songID'] for track in notStoredTracks],
+            workers=workers,
+            limiter=limiter,
+            deadLetters=deadLetters
+            )
+    failedIDs = {letter['query'] for letter in deadLetters.letters}
+    for track in notStoredTracks:
+        sid = track['spotifyData']['songID']
+        if sid in handler.data or sid in failedIDs:
+            # Same song twice in the tracks, or its features failed and are fetched on the next run
+            continue
+        songData: SpotifySongData = {
+                'info': track,
+                'features': matrix.features(sid)
                 }
-                
-                # Sanity check that features api retains order of tracks
-                info = trackBatch[i]
-                if featuresResult['id'] != info['spotifyData']['songID']:
-                    print("Features not retaining order! ")
-                    for track in trackBatch:
-                        if featuresResult['id'] == track['spotifyData']['songID']:
-                            info = track
-                            break
-
-            songData: SpotifySongData = {
-                    'info': info,
-                    'features': features
-                    }
-            
-            handler.storeFeatures(songData)
+        handler.storeFeatures(sid, songData)
+
+    if featureMatrixPath is not None:
+        if Path(featureMatrixPath).exists():
+            matrix = AudioFeatureMatrix.load(featureMatrixPath).merge(matrix)
+        matrix.save(featureMatrixPath)
+
+    handler.compact()
+    handler.close()
+    deadLetters.save()
+    if len(deadLetters) > 0:
+        print(f"Features of {len(deadLetters)} songs failed, they are fetched again on the next run")
+    return handler.data
 
-    return loadJson(savePath)
+def groupTracksByAlbum(
+        trackInfo: Union[list[SpotifySongQueryResult], Mapping[str, SpotifySongQueryResult]]
+        ) -> dict[str, list[SpotifySongQueryResult]]:
+    """
+    Hit tracks grouped by their album id, in the order the albums are first seen.
+    """
+    if isinstance(trackInfo, Mapping):
+        trackInfo = list(trackInfo.values())
+
+    albums: dict[str, list[SpotifySongQueryResult]] = {}
+    for track in trackInfo:
+        album: Optional[SpotifyAlbum] = track['spotifyData']['album']
+        if album is not None:
+            albums.setdefault(album['albumID'], []).append(track)
+    return albums
+
+def fetchAlbumsTrackListings(
+        api: 'Spotify',
+        albumIDs: list[str],
+        limiter: Optional[RateLimiter] = None,
+        retryPolicy: Optional[RetryPolicy] = None
+        ) -> Generator[tuple[str, list], None, None]:
+    """
+    Yields (album id, raw tracks of the album) for every album.
+    The albums are fetched 20 at a time from the albums endpoint that embeds the first page of the tracks,
+    album_tracks is called only for the albums that have more tracks than the embedded page.
+    """
+    if retryPolicy is None:
+        retryPolicy = RetryPolicy()
+
+    def call(*args, **kwargs):
+        return retryPolicy.call(callWithLimiter, limiter, *args, limiter=limiter, **kwargs)
+
+    for albumBatch in batch(albumIDs, 20):
+        for albumID, album in zip(albumBatch, call(api.albums, albumBatch)['albums']):
+            if album is None:
+                yield albumID, []
+                continue
+
+            albumTracks: list = list(album['tracks']['items'])
+            while len(albumTracks) < album['tracks']['total']:
+                page = call(api.album_tracks, albumID, limit=50, offset=len(albumTracks))['items']
+                if len(page) == 0:
+                    break
+                albumTracks.extend(page)
+            yield albumID, albumTracks
+
+def sampleAlbumTracks(
+        albumTracks: list,
+        hitIDs: set[str],
+        sampleSize: int,
+        random: Optional[Random] = None
+        ) -> list:
+    """
+    Random sample of the album tracks without the hits and blacklisted names,
+    taken with random when it is given.
+    """
+    from .matching import checkIfBlackListed
+
+    if len(albumTracks) <= 1:
+        return []
+    # Take a random sample of tracks
+    sample = random.sample if random is not None else rndSample
+    trackSample: list = sample(albumTracks, sampleSize) if sampleSize <= len(albumTracks) else albumTracks
+    # Ignore the hits of the album (song based to fetch songs from album)
+    # and blacklisted words in songs
+    return [
+            albumTrack for albumTrack in trackSample 
+            if not checkIfBlackListed(albumTrack['name']) and albumTrack['id'] not in hitIDs
+            ]
 
 def fetchAlbumTracks(
-        api: Spotify, 
+        api: 'Spotify', 
         trackInfo: list[SpotifySongInfo], 
         sampleSize: int = 5
         ) -> list[SpotifySongQueryResult]:
-    # Loop album ids and fetch the track ids of tracks in every album
+    # Every album is fetched once even when it has many hits
     queriedAlbumTracks: list[SpotifySongQueryResult] = []
-    print("Query number:")
-    for i, track in enumerate(trackInfo):
+    hitsByAlbum = groupTracksByAlbum(trackInfo)
+    print(f"Querying {len(hitsByAlbum)} albums of {len(trackInfo)} tracks")
+    progress = getMetrics().progress('albums', len(hitsByAlbum))
+    for i, (albumID, albumTracks) in enumerate(fetchAlbumsTrackListings(api, list(hitsByAlbum.keys()))):
         if i % 10000 == 0:
-            print(i)
-
-        album: SpotifyAlbum = track['spotifyData']['album']
-        albumTracks: list = api.album_tracks(album['albumID'])['items']
-        if len(albumTracks) > 1:
-            # Take a random sample of tracks
-            trackSample: list = rndSample(albumTracks, sampleSize) if sampleSize <= len(albumTracks) else albumTracks
-            # Add ids of the random sample tracks to a list
-            for albumTrack in trackSample:
-                # Ignore duplicates (song based to fetch songs from album)
-                # and blacklisted words in songs
-                if  not checkIfBlackListed(albumTrack['name']) and albumTrack['id'] != track['spotifyData']['songID']:
-                    data: SpotifySongQueryResult = {
-                            'spotifyData': parseSongInfo(albumTrack, False)
-                            }
-                    data['spotifyData']['album'] = album
-                    data['searchQuery'] = "Shares album with " + track['spotifyData']['name']
-                    queriedAlbumTracks.append(data)
+            progress.log()
+        progress.done = i + 1
+
+        hits = hitsByAlbum[albumID]
+        album: SpotifyAlbum = hits[0]['spotifyData']['album']
+        hitIDs = {hit['spotifyData']['songID'] for hit in hits}
+        for albumTrack in sampleAlbumTracks(albumTracks, hitIDs, sampleSize):
+            data: SpotifySongQueryResult = {
+                    'spotifyData': parseSongInfo(albumTrack, False)
+                    }
+            data['spotifyData']['album'] = album
+            data['searchQuery'] = "Shares album with " + hits[0]['spotifyData']['name']
+            queriedAlbumTracks.append(data)
 
     return queriedAlbumTracks
 
 def getSongsWithAlbums(
-        api: Spotify,
+        api: 'Spotify',
         tracks: list[SpotifySongInfo], 
         randomSampleSize: int = 5
         ) -> list[SpotifySongData]:
@@ -536,48 +786,88 @@ def getSongsWithAlbums(
     return getSpotifyAudioFeatures(api, songInfos)
 
 def fetchAlbumTracksV2(
-        api: Spotify, 
+        api: 'Spotify', 
         handler: SpotifyDataHandler,
-        trackInfo: list[SpotifySongInfo], 
-        sampleSize: int = 5
-        ) -> dict[str, SpotifySongQueryResult]:
-    
-    # Loop album ids and fetch the track ids of tracks in every album
-    print("Starting the query::")
-    for i, track in enumerate(trackInfo):
+        trackInfo: Union[list[SpotifySongQueryResult], Mapping[str, SpotifySongQueryResult]], 
+        sampleSize: int = 5,
+        limiter: Optional[RateLimiter] = None,
+        catalogPath: Optional[str] = None,
+        seed: Optional[int] = None
+        ) -> Mapping[str, SpotifySongQueryResult]:
+    """
+    Stores a sample of the tracks of the albums of the hits.
+    With catalogPath every track of the fetched albums is added to the local catalog saved there
+    (catalog.LocalCatalog), so the songs of the albums are found without a search when they chart later.
+    With seed the sample of every album comes from a generator seeded with the seed and the album id,
+    so the same albums give the same songs on every run whatever albums are fetched with them.
+    """
+    catalog = None
+    if catalogPath is not None:
+        from .catalog import LocalCatalog
+
+        catalog = LocalCatalog.loadOrCreate(catalogPath)
+
+    # Every album is fetched once even when it has many hits
+    hitsByAlbum = groupTracksByAlbum(trackInfo)
+    print(f"Starting the query:: {len(hitsByAlbum)} albums")
+    albumListings = fetchAlbumsTrackListings(api, list(hitsByAlbum.keys()), limiter)
+    progress = getMetrics().progress('albums', len(hitsByAlbum))
+    for i, (albumID, albumTracks) in enumerate(albumListings):
         if i % 10000 == 0:
-            print(i)
-
-        album: SpotifyAlbum = track['spotifyData']['album']
-        albumTracks: list = api.album_tracks(album['albumID'])['items']
-        if len(albumTracks) > 1:
-            # Take a random sample of tracks
-            trackSample: list = rndSample(albumTracks, sampleSize) if sampleSize <= len(albumTracks) else albumTracks
-            # Add ids of the random sample tracks to a list
-            for albumTrack in trackSample:
-                # Ignore duplicates (song based to fetch songs from album)
-                # and blacklisted words in songs
-                if  not checkIfBlackListed(albumTrack['name']) and albumTrack['id'] != track['spotifyData']['songID']:
-                    handler.storeSong(
-                            query="Shares album with " + track['spotifyData']['name'],
-                            song=parseSongInfo(albumTrack, False),
-                            matchingRation=None,
-                            track=None
-                            )
-
+            progress.log()
+        progress.done = i + 1
+
+        hits = hitsByAlbum[albumID]
+        album: SpotifyAlbum = hits[0]['spotifyData']['album']
+        hitIDs = {hit['spotifyData']['songID'] for hit in hits}
+        if catalog is not None:
+            catalog.addAlbumTracks(albumTracks, (album['name'], album['albumID'], album['totalTracks'], album['releaseDate']))
+        random = Random(f"{seed}:{albumID}") if seed is not None else None
+        for albumTrack in sampleAlbumTracks(albumTracks, hitIDs, sampleSize, random):
+            if albumTrack['id'] in handler.data:
+                # Sampled already on an earlier run
+                continue
+            song = parseSongInfo(albumTrack, False)
+            song['album'] = album
+            handler.storeSong(
+                    query="Shares album with " + hits[0]['spotifyData']['name'],
+                    song=song,
+                    matchingRatio=None,
+                    track=None
+                    )
+
+    if catalog is not None and catalogPath is not None:
+        catalog.save(catalogPath)
     return handler.data
 
 def getSongsWithAlbumsV2(
-        api: Spotify,
-        tracks: list[SpotifySongInfo], 
+        api: 'Spotify',
+        tracks: Union[list[SpotifySongQueryResult], Mapping[str, SpotifySongQueryResult]], 
         infoStorePath: str,
         featureStorePath: str,
-        randomSampleSize: int = 5
-        ) -> dict[str, SpotifySongData]:
-
+        randomSampleSize: int = 5,
+        storeBackend: Optional[str] = None,
+        records: Optional[str] = None,
+        catalogPath: Optional[str] = None,
+        seed: Optional[int] = None
+        ) -> Mapping[str, SpotifySongData]:
+    """
+    Samples the albums of the hits and fetches the features of the sampled songs.
+    catalogPath is the local catalog of getSpotifyDataFromBillboardSongsV2(useCatalog=True),
+    the album listings are added to it (see fetchAlbumTracksV2), seed makes the samples reproducible.
+    """
     # Set up the storing handlers
-    infoHandler = SpotifyDataHandler(infoStorePath)
+    infoHandler = SpotifyDataHandler(infoStorePath, storeBackend, records)
     # Fetch the data for songs in a album
-    songInfos: list[SpotifySongData] = fetchAlbumTracksV2(api, handler, tracks, randomSampleSize)
+    songInfos: Mapping[str, SpotifySongQueryResult] = fetchAlbumTracksV2(
+            api,
+            infoHandler,
+            tracks,
+            randomSampleSize,
+            catalogPath=catalogPath,
+            seed=seed
+            )
+    infoHandler.compact()
+    infoHandler.close()
     # Fetch feature data for tracks
-    return getSpotifyAudioFeaturesv2(api, songInfos, featuresStorePath)
+    return getSpotifyAudioFeaturesV2(api, list(songInfos.values()), featureStorePath, storeBackend, records=records)
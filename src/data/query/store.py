@@ -0,0 +1,149 @@
+from typing import Any, Optional
+from pathlib import Path
+from os import fsync, replace
+from json import dumps as jsondumps, loads as jsonloads
+
+from .util import createPath, loadJson, saveJsonAtomic
+
+class JsonStoreBackend:
+    """
+    Keeps the whole store in a single json file.
+    Records are only written when the store is checkpointed,
+    the file is replaced atomically so a crash can't corrupt the previous copy.
+    """
+
+    def __init__(self, storeFilePath: str) -> None:
+        self.storePath = storeFilePath
+
+    def load(self) -> dict:
+        if Path(self.storePath).exists():
+            return loadJson(self.storePath)
+        return {}
+
+    def append(self, key: str, record: Any) -> None:
+        # Nothing is written per record, the whole store is written on checkpoint
+        pass
+
+    def checkpoint(self, data: dict) -> None:
+        saveJsonAtomic(data, self.storePath)
+
+    def compact(self, data: dict) -> None:
+        saveJsonAtomic(data, self.storePath)
+
+    def close(self) -> None:
+        pass
+
+class AppendLogStoreBackend:
+    """
+    Json snapshot + append only NDJSON log of the records stored after the snapshot.
+    Every stored record is one appended line so the cost per record is O(1).
+    The log is folded into the snapshot (compaction) when it has grown over compactEvery records,
+    the new snapshot is written to a temporary file and renamed over the old one before the log is cleared.
+    The snapshot has the same format as the JsonStoreBackend file so existing stores load as they are.
+    """
+
+    def __init__(
+            self,
+            storeFilePath: str,
+            compactEvery: int = 50000,
+            syncEvery: int = 1
+            ) -> None:
+        self.storePath = storeFilePath
+        self.logPath = storeFilePath + '.log'
+        self.compactEvery = compactEvery
+        self.syncEvery = syncEvery
+        self.logRecords = 0
+        self.unsynced = 0
+        self.logFile = None
+
+    def load(self) -> dict:
+        data: dict = {}
+        if Path(self.storePath).exists():
+            data = loadJson(self.storePath)
+
+        # Replay the records written after the last compaction
+        if Path(self.logPath).exists():
+            with open(self.logPath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = jsonloads(line)
+                    except ValueError:
+                        # A crash in the middle of a write leaves a partial last line
+                        print(f"Skipping a broken record in {self.logPath}")
+                        continue
+                    data[record['k']] = record['v']
+                    self.logRecords += 1
+
+        return data
+
+    def _openLog(self):
+        if self.logFile is None:
+            createPath(self.logPath)
+            # Terminate a partial last line so the next record starts on its own line
+            brokenTail = False
+            if Path(self.logPath).exists() and Path(self.logPath).stat().st_size > 0:
+                with open(self.logPath, 'rb') as f:
+                    f.seek(-1, 2)
+                    brokenTail = f.read(1) != b'\n'
+            self.logFile = open(self.logPath, 'a', encoding='utf-8')
+            if brokenTail:
+                self.logFile.write('\n')
+        return self.logFile
+
+    def _sync(self) -> None:
+        if self.logFile is not None:
+            self.logFile.flush()
+            fsync(self.logFile.fileno())
+        self.unsynced = 0
+
+    def append(self, key: str, record: Any) -> None:
+        f = self._openLog()
+        f.write(jsondumps({'k': key, 'v': record}, ensure_ascii=False) + '\n')
+        self.logRecords += 1
+        self.unsynced += 1
+        if self.unsynced >= self.syncEvery:
+            self._sync()
+
+    def checkpoint(self, data: dict) -> None:
+        # The records are already in the log, only fold it when it has grown enough
+        if self.logRecords >= self.compactEvery:
+            self.compact(data)
+        else:
+            self._sync()
+
+    def compact(self, data: dict) -> None:
+        self._sync()
+        saveJsonAtomic(data, self.storePath)
+
+        # Snapshot has every record now so the log can be cleared.
+        # The empty log replaces the old one with a rename too, if the process dies before it
+        # the old log is replayed on top of the new snapshot which gives the same data
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+        if Path(self.logPath).exists():
+            emptyLog = self.logPath + '.tmp'
+            open(emptyLog, 'w').close()
+            replace(emptyLog, self.logPath)
+        self.logRecords = 0
+
+    def close(self) -> None:
+        if self.logFile is not None:
+            self._sync()
+            self.logFile.close()
+            self.logFile = None
+
+def createStoreBackend(
+        storeFilePath: str,
+        backend: Optional[str] = None,
+        **backendOptions
+        ):
+    """
+    Backends by name, 'json' is the default.
+    """
+    if backend is None or backend == 'json':
+        return JsonStoreBackend(storeFilePath)
+    elif backend == 'log':
+        return AppendLogStoreBackend(storeFilePath, **backendOptions)
+
+    raise ValueError(f"Unknown store backend {backend}")
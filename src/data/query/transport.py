@@ -0,0 +1,119 @@
+from typing import TYPE_CHECKING, Any, Optional
+from threading import Lock
+
+if TYPE_CHECKING:
+    from requests import Session
+    from spotipy import Spotify
+    from spotipy.oauth2 import SpotifyClientCredentials
+
+# Status codes spotipy retries by default, initializeSpotifyAPI(rateLimited=True) leaves 429 out
+defaultStatusForcelist = (429, 500, 502, 503, 504)
+
+class HttpTransport:
+    """
+    The HTTP settings of the Spotify clients and one requests session made with them.
+    The session keeps up to poolSize keep-alive connections per host (a urllib3 pool), so concurrent
+    workers reuse the open connections instead of connecting (and doing a TLS handshake) for every call.
+    spotipy's own session keeps 10, with more workers than that the extra connections are closed after every call.
+    The session is shared by every client and token manager given the transport, the urllib3 pools are thread safe
+    and the session itself is only read after it is made.
+    A Spotify client closes its session when it is garbage collected, that only drops the open connections
+    (the next call opens them again) so keep the clients around while the transport is used.
+    Responses are asked gzip compressed and every request has a connect and a read timeout.
+    429 responses are retried by urllib3 only when 429 is in statusForcelist, without it they are raised at once
+    (Retry-After is not waited out on the calling thread) so a RateLimiter or a client pool can handle them.
+    """
+
+    def __init__(
+            self,
+            poolSize: int = 16,
+            connectTimeout: float = 3.05,
+            readTimeout: float = 10.0,
+            compress: bool = True,
+            retries: int = 3,
+            backoffFactor: float = 0.3,
+            statusForcelist: tuple[int, ...] = defaultStatusForcelist,
+            blockWhenFull: bool = False
+            ) -> None:
+        self.poolSize = poolSize
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.compress = compress
+        self.retries = retries
+        self.backoffFactor = backoffFactor
+        self.statusForcelist = statusForcelist
+        # With blockWhenFull a call waits for a free connection instead of opening one that is not kept
+        self.blockWhenFull = blockWhenFull
+        self.lock = Lock()
+        self._session: Optional['Session'] = None
+
+    @property
+    def retriesRateLimits(self) -> bool:
+        return 429 in self.statusForcelist
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        # requests takes (connect, read) in place of one timeout
+        return (self.connectTimeout, self.readTimeout)
+
+    @property
+    def session(self) -> 'Session':
+        if self._session is None:
+            with self.lock:
+                if self._session is None:
+                    self._session = self._createSession()
+        return self._session
+
+    def _createSession(self) -> 'Session':
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # The same retries spotipy mounts on the sessions it makes itself (Spotify._build_session)
+        retry = Retry(
+                total=self.retries,
+                connect=None,
+                read=False,
+                allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                status=self.retries,
+                backoff_factor=self.backoffFactor,
+                status_forcelist=self.statusForcelist,
+                # urllib3 retries any 429 with a Retry-After header even when 429 is not in the status list
+                respect_retry_after_header=self.retriesRateLimits
+                )
+        # pool_connections is the number of hosts with a pool (api and accounts), pool_maxsize the connections per host
+        adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=self.poolSize,
+                max_retries=retry,
+                pool_block=self.blockWhenFull
+                )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate' if self.compress else 'identity'
+        session.headers['Connection'] = 'keep-alive'
+        return session
+
+    def credentials(self, clientID: str, clientSecret: str, **kwargs: Any) -> 'SpotifyClientCredentials':
+        from spotipy.oauth2 import SpotifyClientCredentials
+        return SpotifyClientCredentials(
+                client_id=clientID,
+                client_secret=clientSecret,
+                requests_session=self.session,
+                requests_timeout=self.timeout,
+                **kwargs
+                )
+
+    def client(self, **kwargs: Any) -> 'Spotify':
+        """
+        A Spotify client on the shared session, kwargs go to Spotify (client_credentials_manager, auth, ...).
+        """
+        from spotipy import Spotify
+        return Spotify(requests_session=self.session, requests_timeout=self.timeout, **kwargs)
+
+    def close(self) -> None:
+        with self.lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
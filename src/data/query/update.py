@@ -0,0 +1,217 @@
+from typing import TYPE_CHECKING, Optional
+from pathlib import Path
+
+from data.types.billboard import ChartWatermark
+from data.types.spotify import SpotifySongData, SpotifySongQueryResult
+from .util import loadJson, saveJsonAtomic
+from .billboard import getBillboardData
+from .ratelimit import RateLimiter
+from .retry import DeadLetters
+from .keys import createCanonicalKey
+from .spotify_api import (
+        SpotifyDataHandler,
+        getSpotifyDataFromBillboardSongsV2,
+        getSpotifyAudioFeaturesV2,
+        fetchAlbumTracksV2
+        )
+
+if TYPE_CHECKING:
+    from spotipy import Spotify
+
+def loadWatermark(watermarkPath: str) -> Optional[ChartWatermark]:
+    if not Path(watermarkPath).exists():
+        return None
+    return loadJson(watermarkPath)
+
+def saveWatermark(watermark: ChartWatermark, watermarkPath: str) -> None:
+    saveJsonAtomic(watermark, watermarkPath)
+
+def storedKeys(storePath: str, storeBackend: Optional[str] = None) -> set[str]:
+    handler = SpotifyDataHandler(storePath, storeBackend)
+    keys = set(handler.data.keys())
+    handler.close()
+    return keys
+
+def updateFromCharts(
+        api: 'Spotify',
+        chartsPath: str,
+        hitInfoPath: str,
+        hitFeaturesPath: str,
+        notHitInfoPath: str,
+        notHitFeaturesPath: str,
+        watermarkPath: Optional[str] = None,
+        datasetPath: Optional[str] = None,
+        albumSampleSize: int = 5,
+        storeBackend: Optional[str] = None,
+        workers: int = 1,
+        limiter: Optional[RateLimiter] = None,
+        records: Optional[str] = None,
+        useCatalog: bool = True
+        ) -> dict[str, int]:
+    """
+    Processes only the chart weeks after the watermark saved on the last update:
+    the songs of the new weeks missing from the hit store are searched, features are fetched for the hits
+    of the new weeks that don't have them yet, not hits are sampled from the albums of the new hits
+    that have not been sampled before and the songs that got features are appended to the dataset
+    at datasetPath (see process.dataset.ShardedDataset) so only the shards of their release years get new parts.
+    Without a watermark every week is processed. The watermark is saved next to the hit store by default.
+    It is not moved past the first week that has a failed search or feature fetch (a dead letter),
+    the next update processes that week again and queries only what is still missing.
+    records is passed to SpotifyDataHandler, see records.createRecordStore.
+    With useCatalog every track of the fetched albums is kept in a local catalog next to the hit store
+    and the new chart songs are looked up from it before searching (catalog.LocalCatalog).
+    Returns the number of new rows, hits and not hits.
+    """
+    if watermarkPath is None:
+        watermarkPath = hitInfoPath + '.watermark.json'
+    catalogPath = hitInfoPath + '.catalog.json' if useCatalog else None
+    watermark = loadWatermark(watermarkPath)
+    since = watermark['lastDate'] if watermark is not None else None
+
+    # The Kaggle charts.csv has the newest weeks first, the older weeks are not read
+    newRows = getBillboardData(chartsPath, since=since, newestFirst=True)
+    print(f"{len(newRows)} chart rows after {since}")
+    summary = {'rows': len(newRows), 'hits': 0, 'notHits': 0}
+    if len(newRows) == 0:
+        return summary
+
+    # Songs of the new weeks that are already stored are not searched
+    hitKeysBefore = storedKeys(hitInfoPath, storeBackend)
+    hits = getSpotifyDataFromBillboardSongsV2(
+            api,
+            newRows,
+            hitInfoPath,
+            storeBackend,
+            workers=workers,
+            limiter=limiter,
+            keyIndexPath='',
+            records=records,
+            useCatalog=useCatalog,
+            catalogPath=catalogPath
+            )
+    newHits: list[SpotifySongQueryResult] = [hit for key, hit in hits.items() if key not in hitKeysBefore]
+    summary['hits'] = len(newHits)
+    print(f"New hits {len(newHits)}")
+    # Every hit of the new weeks gets features, the ones stored already are not fetched again
+    # and the ones that failed on an earlier update of the same weeks are
+    rowKeys = {createCanonicalKey(row['song'], row['artist']) for row in newRows}
+    weekHits: list[SpotifySongQueryResult] = [hit for hit in hits.values() if chartKey(hit) in rowKeys]
+    hitFeatureKeysBefore = storedKeys(hitFeaturesPath, storeBackend)
+    hitFeatures = getSpotifyAudioFeaturesV2(api, weekHits, hitFeaturesPath, storeBackend, workers, limiter, records=records)
+
+    # Albums that already gave not hits for an earlier hit are not fetched again
+    notHitHandler = SpotifyDataHandler(notHitInfoPath, storeBackend, records)
+    notHitKeysBefore = set(notHitHandler.data.keys())
+    sampledAlbums = {
+            stored['spotifyData']['album']['albumID']
+            for stored in notHitHandler.data.values()
+            if stored['spotifyData'].get('album') is not None
+            }
+    hitsOfNewAlbums = [
+            hit for hit in newHits
+            if hit['spotifyData']['album'] is not None and hit['spotifyData']['album']['albumID'] not in sampledAlbums
+            ]
+    notHits = fetchAlbumTracksV2(api, notHitHandler, hitsOfNewAlbums, albumSampleSize, limiter, catalogPath)
+    notHitHandler.compact()
+    notHitHandler.close()
+    newNotHits = [notHit for key, notHit in notHits.items() if key not in notHitKeysBefore]
+    summary['notHits'] = len(newNotHits)
+    print(f"New not hits {len(newNotHits)} from {len(hitsOfNewAlbums)} new albums")
+    # Like the hits, the not hits of the albums of the new weeks that are still missing features are fetched
+    hitsByAlbum: dict[str, list[SpotifySongQueryResult]] = {}
+    for hit in weekHits:
+        if hit['spotifyData']['album'] is not None:
+            hitsByAlbum.setdefault(hit['spotifyData']['album']['albumID'], []).append(hit)
+    weekNotHits = [
+            notHit for notHit in notHits.values()
+            if notHit['spotifyData'].get('album') is not None and notHit['spotifyData']['album']['albumID'] in hitsByAlbum
+            ]
+    notHitFeatureKeysBefore = storedKeys(notHitFeaturesPath, storeBackend)
+    notHitFeatures = getSpotifyAudioFeaturesV2(
+            api,
+            weekNotHits,
+            notHitFeaturesPath,
+            storeBackend,
+            workers,
+            limiter,
+            records=records
+            )
+
+    if datasetPath is not None:
+        # Only the songs whose features were stored on this update, the failed ones are appended when they get them.
+        # Not hits that are hits are left out also when the features of the hit are still missing
+        hitIDs = {hit['spotifyData']['songID'] for hit in hits.values()}
+        appendToDataset(
+                datasetPath,
+                [hitFeatures[sid] for sid in hitFeatures.keys() if sid not in hitFeatureKeysBefore],
+                [
+                    notHitFeatures[sid] for sid in notHitFeatures.keys()
+                    if sid not in notHitFeatureKeysBefore and sid not in hitIDs
+                    ]
+                )
+
+    # The chart songs that still have a failed search or a failed feature fetch of theirs or of their album's not hits
+    failedKeys: set[Optional[str]] = {
+            createCanonicalKey(letter['track']['song'], letter['track']['artist'])
+            for letter in DeadLetters(hitInfoPath).letters
+            if letter['track'] is not None
+            }
+    failedKeys -= {chartKey(hit) for hit in weekHits}
+    failedFeatures = {letter['query'] for letter in DeadLetters(hitFeaturesPath).letters}
+    failedKeys.update(chartKey(hit) for hit in weekHits if hit['spotifyData']['songID'] in failedFeatures)
+    for letter in DeadLetters(notHitFeaturesPath).letters:
+        notHit = notHits.get(letter['query'])
+        if notHit is not None and notHit['spotifyData'].get('album') is not None:
+            failedKeys.update(chartKey(hit) for hit in hitsByAlbum.get(notHit['spotifyData']['album']['albumID'], []))
+    failedWeeks = [row['date'] for row in newRows if createCanonicalKey(row['song'], row['artist']) in failedKeys]
+    doneRows = newRows
+    if len(failedWeeks) > 0:
+        firstFailed = min(failedWeeks)
+        print(f"Weeks from {firstFailed} have failed queries, the next update processes them again")
+        doneRows = [row for row in newRows if row['date'] < firstFailed]
+    if len(doneRows) == 0:
+        return summary
+
+    saveWatermark({
+        'lastDate': max(row['date'] for row in doneRows),
+        'rows': (watermark['rows'] if watermark is not None else 0) + len(doneRows)
+        }, watermarkPath)
+    return summary
+
+def chartKey(hit: SpotifySongQueryResult) -> Optional[str]:
+    # Canonical key of the chart row the song was matched to
+    row = hit.get('originalData')
+    if row is None:
+        return None
+    return createCanonicalKey(row['song'], row['artist'])
+
+def appendToDataset(
+        datasetPath: str,
+        hits: list[SpotifySongData],
+        notHits: list[SpotifySongData]
+        ) -> None:
+    """
+    Appends the songs to the sharded dataset, or creates it when there is none.
+    Not hits that are also hits are left out.
+    """
+    import numpy
+    from data.process.features import buildFeatureMatrix
+    from data.process.dataset import ShardedDataset, manifestName
+
+    hitIDs = {hit['info']['spotifyData']['songID'] for hit in hits}
+    hitX, hitY, hitRowIDs = buildFeatureMatrix(hits, 1)
+    notHitX, notHitY, notHitRowIDs = buildFeatureMatrix(
+            [notHit for notHit in notHits if notHit['info']['spotifyData']['songID'] not in hitIDs],
+            0
+            )
+    x = numpy.concatenate([hitX, notHitX])
+    y = numpy.concatenate([hitY, notHitY])
+    ids = hitRowIDs + notHitRowIDs
+    if len(ids) == 0:
+        return
+
+    if (Path(datasetPath) / manifestName).exists():
+        ShardedDataset.open(datasetPath).append(x, y, ids)
+    else:
+        ShardedDataset.create(datasetPath, x, y, ids)
+    print(f"Appended {len(ids)} songs to the dataset")
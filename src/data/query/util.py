@@ -1,14 +1,19 @@
 from configparser import ConfigParser
 from pathlib import Path
-from os import environ
-from typing import Union, Generator
-from json import dump as jsondump, load as jsonload
-
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyClientCredentials
+from os import environ, fsync, replace
+from typing import TYPE_CHECKING, Any, Union, Generator, Optional
+from json import dump as jsondump, dumps as jsondumps, load as jsonload
+from collections.abc import Mapping
 
 from data.types.util import Credentials
 
+if TYPE_CHECKING:
+    # spotipy is imported when the api is initialized, the json helpers don't need it
+    from spotipy import Spotify
+    from .cache import CachedSpotify
+    from .clients import SpotifyClientPool
+    from .transport import HttpTransport
+
 def createPath(pathStr: str, p: int = 3) -> Path:
     path = Path(pathStr)
     for i, parent in enumerate(path.parents):
@@ -24,7 +29,31 @@ def saveJson(saveObject: Union[list, dict], savePath: str) -> None:
     with path.open('w', encoding='utf8') as f:
         jsondump(saveObject, f, ensure_ascii=False)
 
-def loadJson(savePath: str) -> Union[list, dict]:
+def dumpMapping(saveObject: Mapping, f) -> None:
+    # Same output as json.dump of the mapping as a dict, one item at a time
+    # so mappings that build their values on read (records.CompactSongStore) are never built whole
+    f.write('{')
+    for i, (key, value) in enumerate(saveObject.items()):
+        if i > 0:
+            f.write(', ')
+        f.write(jsondumps(key, ensure_ascii=False) + ': ' + jsondumps(value, ensure_ascii=False))
+    f.write('}')
+
+def saveJsonAtomic(saveObject: Union[list, dict, Mapping], savePath: str) -> None:
+    # Write to a temporary file first and rename it over the old one
+    # so the old file stays intact if writing fails halfway
+    path = createPath(savePath)
+    tmpPath = path.with_name(path.name + '.tmp')
+    with tmpPath.open('w', encoding='utf8') as f:
+        if isinstance(saveObject, (list, dict)):
+            jsondump(saveObject, f, ensure_ascii=False)
+        else:
+            dumpMapping(saveObject, f)
+        f.flush()
+        fsync(f.fileno())
+    replace(tmpPath, path)
+
+def loadJson(savePath: str) -> Any:
     return jsonload(Path(savePath).open("r", encoding="utf-8"))
 
 def getCredentials(
@@ -44,6 +73,22 @@ def getCredentials(
     print("Could not find the kaggle configurations from ", credentialsPath)
     return None
 
+def getCredentialSections(
+        sectionPrefix: str,
+        credentialsPath: str
+        ) -> dict[str, Credentials]:
+    # Every section that starts with the prefix, for example SPOTIFY, SPOTIFY2 and SPOTIFY_BACKFILL
+    parser = ConfigParser()
+    if Path(credentialsPath).exists():
+        parser.read(credentialsPath)
+    sections: dict[str, Credentials] = {
+            name: {'userId': parser[name]['userId'], 'userKey': parser[name]['userKey']}
+            for name in parser.sections() if name.startswith(sectionPrefix)
+            }
+    if len(sections) == 0:
+        print(f"Could not find {sectionPrefix} credentials from ", credentialsPath)
+    return sections
+
 def setKaggleCredentialsToEnv(kaggleCredentials: Credentials) -> None:
     # Set the env variables
     environ['KAGGLE_USERNAME'] = kaggleCredentials['userId']
@@ -70,8 +115,40 @@ def downloadKaggleDataset(
 def initializeSpotifyAPI(
         credentialsPath: str = "../config/env.ini",
         spotifyUsername: str = "", 
-        spotifyKey: str = ""
-        ) -> Spotify:
+        spotifyKey: str = "",
+        rateLimited: bool = False,
+        cachePath: Optional[str] = None,
+        cacheTTL: Optional[float] = 30 * 24 * 60 * 60,
+        cacheMaxBytes: int = 512 * 1024 * 1024,
+        pooled: bool = False,
+        transport: Optional['HttpTransport'] = None
+        ) -> Union['Spotify', 'SpotifyClientPool', 'CachedSpotify']:
+    """
+    With rateLimited a 429 response is not retried by the session, neither by the status list
+    nor by waiting out its Retry-After (see transport.HttpTransport), it is raised at once with the Retry-After header
+    so a shared RateLimiter can handle it.
+    With cachePath the search, audio features and album responses are cached on disk,
+    see cache.CachedSpotify.
+    With pooled every [SPOTIFY...] section of the credentials file gets a client
+    and the calls are spread over them, see clients.SpotifyClientPool.
+    The clients and their token managers share the session of transport (connection pool size, timeouts,
+    compression), without one a transport.HttpTransport with the retries of rateLimited is made.
+    """
+    from .transport import HttpTransport, defaultStatusForcelist
+
+    # The transport decides if 429 is retried, it has to be the way rateLimited asks for
+    if transport is not None and transport.retriesRateLimits == (rateLimited or pooled):
+        raise ValueError(
+                f"The transport {'retries' if transport.retriesRateLimits else 'does not retry'} 429 responses, "
+                f"rateLimited={rateLimited} pooled={pooled} needs the opposite"
+                )
+    if pooled:
+        from .clients import createClientPool
+        api = createClientPool(credentialsPath, transport=transport)
+        if cachePath is not None:
+            from .cache import CachedSpotify, ResponseCache
+            return CachedSpotify(api, ResponseCache(cachePath, cacheTTL, cacheMaxBytes))
+        return api
     
     # Initialize the spotify web API python module
     spotifyCredentials: Credentials
@@ -82,11 +159,15 @@ def initializeSpotifyAPI(
 
     # Details about the spotify web api usage via spotipy in:
     # https://spotipy.readthedocs.io/en/2.19.0/#
-    cc = SpotifyClientCredentials(**{
-        'client_id': spotifyCredentials['userId'],
-        'client_secret': spotifyCredentials['userKey']
-        })
-    return Spotify(client_credentials_manager=cc)
+    if transport is None:
+        transport = HttpTransport(statusForcelist=(500, 502, 503, 504) if rateLimited else defaultStatusForcelist)
+    cc = transport.credentials(spotifyCredentials['userId'], spotifyCredentials['userKey'])
+    api = transport.client(client_credentials_manager=cc, status_forcelist=transport.statusForcelist)
+
+    if cachePath is not None:
+        from .cache import CachedSpotify, ResponseCache
+        return CachedSpotify(api, ResponseCache(cachePath, cacheTTL, cacheMaxBytes))
+    return api
 
 def batch(listToBatch: list, batchSize: int) -> Generator:
     for i in range(0, len(listToBatch), batchSize):
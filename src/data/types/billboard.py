@@ -8,3 +8,7 @@ class BillboardSong(TypedDict):
     peakRank: int
     weeksOnBoard: int
     date: str
+
+class ChartWatermark(TypedDict):
+    lastDate: str
+    rows: int
@@ -20,3 +20,29 @@ class SongFeaturesAndLabels(TypedDict):
     spotifyID: str
     features: ModelFeatures
     label: Literal[0, 1]
+
+class DatasetPartHash(TypedDict, total=False):
+    # sha256 of the arrays of the part, not in the manifests written before it was recorded
+    sha256: str
+
+class DatasetPartSplits(TypedDict, total=False):
+    # Row range of every split in the part, not in the manifests written before it was recorded
+    splits: dict[str, list[int]]
+
+class DatasetPart(DatasetPartHash, DatasetPartSplits):
+    name: str
+    rows: int
+
+class DatasetShard(TypedDict):
+    rows: int
+    parts: list[DatasetPart]
+
+class DatasetManifest(TypedDict):
+    version: int
+    columns: list[str]
+    dtype: str
+    shardBy: Literal['decade', 'year']
+    splits: dict[str, float]
+    seed: int
+    rows: int
+    shards: dict[str, DatasetShard]
@@ -37,13 +37,29 @@ class SpotifySongStored(TypedDict):
     songArtistKey: str
     spotifySongInfo: SpotifySongInfo
 
-class SpotifySongQueryResult(TypedDict):
+class SpotifySongQueryRule(TypedDict, total=False):
+    # Name of the query plan rule the song matched with (planner.MatchRule), not in the older stores
+    matchRule: Optional[str]
+
+class SpotifySongQueryResult(SpotifySongQueryRule):
     spotifyData: SpotifySongInfo 
     searchQuery: Optional[str] 
     minMatchingRatioUsed: Optional[int]
     originalData: Optional[BillboardSong]
 
-class SpotifySongData(TypedDict):
-    info: SpotifySongInfo
-    features: SpotifyFeatures
+class SpotifySongLabels(TypedDict, total=False):
+    # Only in the songs of a labeled dataset
     labels: Optional[dict]
+
+class SpotifySongData(SpotifySongLabels):
+    info: SpotifySongQueryResult
+    features: SpotifyFeatures
+
+class DeadLetter(TypedDict):
+    query: str
+    errorType: str
+    error: str
+    track: Optional[BillboardSong]
+    searchLimit: int
+    matchingRatio: int
+    useArtistInQuery: bool
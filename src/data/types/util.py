@@ -1,5 +1,5 @@
 from typing import TypedDict
 
 class Credentials(TypedDict):
-    user: str
-    key: str
+    userId: str
+    userKey: str
@@ -0,0 +1,28 @@
+from spotipy import Spotify
+
+from benchmarks.fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+from data.query.spotify_api import SpotifyDataHandler, getSpotifyDataFromBillboardSongsV2, fetchAlbumTracksV2
+
+def sampledSongs(api: Spotify, hits: list, storePath: str, seed: int) -> dict[str, set[str]]:
+    handler = SpotifyDataHandler(storePath)
+    notHits = fetchAlbumTracksV2(api, handler, hits, 3, seed=seed)
+    handler.close()
+    songsByAlbum: dict[str, set[str]] = {}
+    for notHit in notHits.values():
+        songsByAlbum.setdefault(notHit['spotifyData']['album']['albumID'], set()).add(notHit['spotifyData']['songID'])
+    return songsByAlbum
+
+def testSeededAlbumSamples(tmp_path):
+    rows = syntheticChartRows(60)
+    with FakeSpotifyServer(FakeCatalog(rows)) as server:
+        api = Spotify(auth='fake', retries=0)
+        api.prefix = server.prefix
+        hits = list(getSpotifyDataFromBillboardSongsV2(api, rows, str(tmp_path / 'hits.json')).values())
+        first = sampledSongs(api, hits, str(tmp_path / 'first.json'), 0)
+        # The albums fetched in a different order give the same songs
+        second = sampledSongs(api, hits[::-1], str(tmp_path / 'second.json'), 0)
+        other = sampledSongs(api, hits, str(tmp_path / 'other.json'), 1)
+
+    assert len(first) > 0
+    assert second == first
+    assert other != first
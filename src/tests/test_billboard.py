@@ -0,0 +1,18 @@
+from zipfile import ZipFile
+
+from data.query.billboard import getBillboardData
+
+def chartsZip(path, csv: str) -> str:
+    with ZipFile(path, 'w') as z:
+        z.writestr('charts.csv', csv)
+    return str(path)
+
+def testWeeksAfterSince(tmp_path):
+    charts = chartsZip(tmp_path / 'charts.zip', 'date,rank,song,artist\n2021-11-06,1,a,b\n2021-10-30,1,c,d\n2021-10-23,1,e,f\n')
+    assert [row['song'] for row in getBillboardData(charts, since='2021-10-23')] == ['a', 'c']
+    assert [row['song'] for row in getBillboardData(charts, since='2021-10-30', newestFirst=True)] == ['a']
+    assert len(getBillboardData(charts)) == 3
+
+def testFileWithoutDates(tmp_path):
+    charts = chartsZip(tmp_path / 'charts.zip', 'rank,song,artist\n1,a,b\n')
+    assert getBillboardData(charts) == [{'rank': '1', 'song': 'a', 'artist': 'b'}]
@@ -0,0 +1,46 @@
+from spotipy import Spotify
+
+from benchmarks.fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+from data.query.catalog import LocalCatalog
+from data.query.spotify_api import getSpotifyDataFromBillboardSongsV2
+
+def testLookup(tmp_path):
+    catalog = LocalCatalog()
+    catalog.addAlbumTracks(
+            [
+                {'id': 't1', 'name': 'Old Town Road!', 'artists': [{'name': 'Lil Nas X', 'id': 'a1'}]},
+                {'id': 't2', 'name': 'Panini - Remix', 'artists': [{'name': 'Lil Nas X', 'id': 'a1'}]}
+                ],
+            ('7', 'b1', 8, '2019-06-21')
+            )
+    catalog.save(str(tmp_path / 'catalog.json'))
+    catalog = LocalCatalog.load(str(tmp_path / 'catalog.json'))
+
+    found = catalog.lookup('old town road', 'Lil Nas X Featuring Billy Ray Cyrus', 80)
+    assert found is not None and found['songID'] == 't1' and found['album']['albumID'] == 'b1'
+    assert catalog.lookup('Old Town Road', 'Someone Else', 80) is None
+    # Matched with the search rules, the blacklisted names are not matched
+    assert catalog.lookup('Panini', 'Lil Nas X', 80) is None
+    assert (catalog.found, catalog.lookups) == (1, 3)
+
+def testCatalogSongsAreNotSearchedAgain(tmp_path):
+    rows = syntheticChartRows(40)
+    with FakeSpotifyServer(FakeCatalog(rows)) as server:
+        api = Spotify(auth='fake', retries=0)
+        api.prefix = server.prefix
+        catalogPath = str(tmp_path / 'catalog.json')
+        first = getSpotifyDataFromBillboardSongsV2(
+                api, rows, str(tmp_path / 'first.json'), useCatalog=True, catalogPath=catalogPath
+                )
+        server.resetCounters()
+        second = getSpotifyDataFromBillboardSongsV2(
+                api, rows, str(tmp_path / 'second.json'), useCatalog=True, catalogPath=catalogPath
+                )
+
+    assert len(first) > 0
+    # Only the songs the first run didn't match are searched
+    assert server.calls.get('search', 0) == sum(server.calls.values())
+    assert server.calls.get('search', 0) < len(rows)
+    catalogMatches = [song for song in second.values() if song['matchRule'] == 'catalog']
+    assert {song['spotifyData']['songID'] for song in catalogMatches} == {song['spotifyData']['songID'] for song in first.values()}
+    assert all(song['searchQuery'] is None for song in catalogMatches)
@@ -0,0 +1,35 @@
+import pytest
+from spotipy import Spotify, SpotifyException
+
+from benchmarks.fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+from data.query.clients import PooledClient, SpotifyClientPool
+from data.query.ratelimit import RateLimiter
+
+def pooledClient(name: str, server: FakeSpotifyServer) -> PooledClient:
+    # 429 is not retried by urllib3, it goes to the pool
+    api = Spotify(auth='fake', retries=0, status_forcelist=(500, 502, 503, 504))
+    api.prefix = server.prefix
+    return PooledClient(name, api, RateLimiter(1e9, 1000, 8))
+
+def testRateLimitedClientIsSkipped():
+    catalog = FakeCatalog(syntheticChartRows(20))
+    with FakeSpotifyServer(catalog, rateLimitShare=1.0, retryAfter=30) as limitedServer, \
+            FakeSpotifyServer(catalog) as server:
+        pool = SpotifyClientPool([pooledClient('limited', limitedServer), pooledClient('free', server)])
+        for i in range(20):
+            assert len(pool.search(f'Song {i}', 1)['tracks']['items']) <= 1
+
+    # The clients have the same budget so the first call goes to the limited one,
+    # its 429 pauses it for 30 seconds and every call lands on the other one
+    assert sum(limitedServer.calls.values()) == 1
+    assert pool.stats()['limited'] == {'calls': 1, 'rateLimited': 1}
+    assert sum(server.calls.values()) == 20
+    assert pool.stats()['free'] == {'calls': 20, 'rateLimited': 0}
+
+def testEveryClientRateLimited():
+    with FakeSpotifyServer(FakeCatalog(syntheticChartRows(20)), rateLimitShare=1.0, retryAfter=0) as server:
+        pool = SpotifyClientPool([pooledClient('first', server), pooledClient('second', server)], maxRateLimitRetries=3)
+        with pytest.raises(SpotifyException) as raised:
+            pool.search('Song 1', 1)
+    assert raised.value.http_status == 429
+    assert sum(server.calls.values()) == 4
@@ -0,0 +1,30 @@
+import numpy
+
+from data.process.dataset import ShardedDataset
+from data.process.features import modelFeatureNames
+
+def datasetRows(start: int, count: int, year: float = 1995) -> tuple[numpy.ndarray, numpy.ndarray, list[str]]:
+    x = numpy.zeros((count, len(modelFeatureNames)))
+    x[:, modelFeatureNames.index('releaseYear')] = year
+    return x, numpy.ones(count), [f"song{i}" for i in range(start, start + count)]
+
+def testSmallAppendsKeepTheSplitFractions(tmp_path):
+    dataset = ShardedDataset.create(str(tmp_path / 'dataset'), *datasetRows(0, 5))
+    # Parts of 5 rows would all go to train if the split was rounded per part
+    for start in range(5, 1000, 5):
+        dataset.append(*datasetRows(start, 5))
+    dataset = ShardedDataset.open(str(tmp_path / 'dataset'))
+
+    sizes = {name: len(dataset.load(name)[2]) for name in ('train', 'validation', 'test')}
+    assert sum(sizes.values()) == len(dataset) == 1000
+    assert abs(sizes['train'] / 1000 - 0.8) < 0.04
+    assert abs(sizes['validation'] / 1000 - 0.1) < 0.03
+    assert abs(sizes['test'] / 1000 - 0.1) < 0.03
+
+def testSongsKeepTheirSplit(tmp_path):
+    first = ShardedDataset.create(str(tmp_path / 'first'), *datasetRows(0, 100))
+    # Appended in another order and shard, a song gets the same split
+    second = ShardedDataset.create(str(tmp_path / 'second'), *datasetRows(50, 50, 2005))
+    second.append(*datasetRows(0, 50))
+    for name in ('train', 'validation', 'test'):
+        assert set(first.load(name)[2].tolist()) == set(second.load(name)[2].tolist())
@@ -0,0 +1,37 @@
+from spotipy import SpotifyException
+
+from data.query.features import fetchAudioFeatureMatrix
+from data.query.retry import DeadLetters, RetryPolicy
+
+class FailingFeaturesAPI:
+    """
+    Answers the audio features calls, the batches with failingID get a 404.
+    """
+
+    def __init__(self, failingID: str) -> None:
+        self.failingID = failingID
+
+    def audio_features(self, ids: list[str]) -> list[dict]:
+        if self.failingID in ids:
+            raise SpotifyException(404, -1, 'not found')
+        return [{'id': sid, 'time_signature': 4, 'duration_ms': 1000, 'key': 1, 'mode': 1, 'acousticness': 0.5,
+                'danceability': 0.5, 'energy': 0.5, 'instrumentalness': 0.0, 'liveness': 0.1, 'loudness': -5.0,
+                'speechiness': 0.1, 'valence': 0.5, 'tempo': 120.0} for sid in ids]
+
+def testFailedBatchLeavesItsRowsNotFound(tmp_path):
+    songIDs = [f'song{i}' for i in range(10)]
+    deadLetters = DeadLetters(str(tmp_path / 'features.json'))
+    matrix = fetchAudioFeatureMatrix(
+            FailingFeaturesAPI('song7'),
+            songIDs,
+            batchSize=4,
+            workers=2,
+            retryPolicy=RetryPolicy(maxAttempts=1),
+            deadLetters=deadLetters
+            )
+
+    assert matrix.found.tolist() == [True] * 4 + [False] * 4 + [True] * 2
+    assert matrix.features('song0')['tempo'] == 120.0
+    assert matrix.features('song5') == {}
+    assert [letter['query'] for letter in deadLetters.letters] == ['song4', 'song5', 'song6', 'song7']
+    assert {letter['errorType'] for letter in deadLetters.letters} == {'client'}
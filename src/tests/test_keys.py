@@ -0,0 +1,11 @@
+from data.query.keys import createCanonicalKey
+
+def testArtistWithXInTheName():
+    featuring = createCanonicalKey('Old Town Road', 'Lil Nas X Featuring Billy Ray Cyrus')
+    assert featuring == 'old town road::billy ray cyrus|lil nas x'
+    assert createCanonicalKey('Old Town Road', 'Lil Nas X') == 'old town road::lil nas x'
+
+def testArtistSeparators():
+    expected = createCanonicalKey('Work', 'Rihanna Featuring Drake')
+    for artist in ('Drake & Rihanna', 'Rihanna, Drake', 'Drake Feat. Rihanna', 'Rihanna With Drake'):
+        assert createCanonicalKey('Work', artist) == expected
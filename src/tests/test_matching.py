@@ -0,0 +1,37 @@
+from random import Random
+
+import pytest
+from fuzzywuzzy import fuzz
+
+from data.query.matching import ProcessedText, loadTitleFilter, tokenSetRatioBound
+
+words = ['love', 'you', 'me', 'the', 'night', 'old', 'town', 'road', 'remix', 'feat', 'a', 'baby', "don't", 'stop']
+
+def randomTitle(random: Random) -> str:
+    # Mostly shared words so the pairs have intersections, with some random ones and punctuation
+    tokens = []
+    for _ in range(random.randint(1, 6)):
+        if random.random() < 0.7:
+            tokens.append(random.choice(words))
+        else:
+            tokens.append(''.join(random.choices('abcdefghij', k=random.randint(1, 8))))
+    return ' '.join(tokens) + random.choice(['', '!', ' (Remix)', ' - Live'])
+
+def testBoundNeverRejectsAMatch():
+    random = Random(0)
+    for _ in range(3000):
+        first, second = randomTitle(random), randomTitle(random)
+        ratio = fuzz.token_set_ratio(first, second)
+        bound = tokenSetRatioBound(ProcessedText(first), ProcessedText(second))
+        # SongMatcher rejects a pair without scoring it when 100 * bound < allowedRatio - 0.5,
+        # so the pairs accepted at allowedRatio = ratio must pass that
+        assert 100 * bound >= ratio - 0.5, (first, second, ratio, bound)
+
+def testBoundOfEqualTitles():
+    assert tokenSetRatioBound(ProcessedText('Old Town Road'), ProcessedText('old town road!')) == 1.0
+    assert tokenSetRatioBound(ProcessedText(''), ProcessedText('Old Town Road')) == 0.0
+
+def testMissingTitleFilterConfig(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        loadTitleFilter(str(tmp_path / 'matching.ini'))
+    assert loadTitleFilter().isBlackListed('Panini - Remix')
@@ -0,0 +1,49 @@
+from data.query.matchpool import MatchingPool
+from data.query.retry import QueryFailed
+
+thresholds = [('exact', 100), ('title', 80)]
+
+def matchJobs(count: int) -> list:
+    jobs: list = []
+    for i in range(count):
+        if i % 7 == 0:
+            jobs.append((f'Song {i}', 'Artist', QueryFailed('server', Exception('boom'), 3)))
+            continue
+        results = [
+                (f'other{i}', f'Something Else {i}', (('Someone', 'b'),), None),
+                # Every third song only has a result with a typo in its name
+                (f'id{i}', f'Song {i}' if i % 3 else f'Sogn {i}', (('Artist', 'a'),), ('Album', 'c', 10, '2020-01-01'))
+                ]
+        jobs.append((f'Song {i}', 'Artist', results if i % 5 else results[:1]))
+    return jobs
+
+def summary(matches: list) -> list:
+    return [
+            match if match is None or isinstance(match, QueryFailed) else (match[0]['songID'], match[1], match[2])
+            for match in matches
+            ]
+
+def testProcessesMatchLikeTheCallingThread():
+    jobs = matchJobs(300)
+    with MatchingPool(0) as pool:
+        inThread = summary(list(pool.matchAll(iter(jobs), thresholds)))
+    with MatchingPool(2, chunkSize=16) as pool:
+        inProcesses = summary(list(pool.matchAll(iter(jobs), thresholds)))
+    assert pool.pool is None
+
+    assert inProcesses == inThread
+    assert inThread[0] is jobs[0][2]
+    assert inThread[1] == ('id1', 'exact', 100)
+    assert inThread[5] is None
+    assert any(match is not None and not isinstance(match, QueryFailed) and match[1] == 'title' for match in inThread)
+
+def testPoolIsClosedWhenTheConsumerRaises():
+    pool = MatchingPool(1, chunkSize=4)
+    try:
+        with pool:
+            for i, _ in enumerate(pool.matchAll(iter(matchJobs(100)), thresholds)):
+                if i == 10:
+                    raise RuntimeError('stop')
+    except RuntimeError:
+        pass
+    assert pool.pool is None
@@ -0,0 +1,48 @@
+import pytest
+from spotipy import Spotify
+
+from benchmarks.fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+from data.query.cache import CachedSpotify, ResponseCache
+from data.query.clients import PooledClient, SpotifyClientPool
+from data.query.metrics import getMetrics
+from data.query.ratelimit import RateLimiter, callWithLimiter
+
+@pytest.fixture(scope='module')
+def server():
+    with FakeSpotifyServer(FakeCatalog(syntheticChartRows(20))) as server:
+        yield server
+
+def fakeClient(server: FakeSpotifyServer) -> Spotify:
+    api = Spotify(auth='fake', retries=0)
+    api.prefix = server.prefix
+    return api
+
+def testCacheHitsAreNotApiCalls(server, tmp_path):
+    api = CachedSpotify(fakeClient(server), ResponseCache(str(tmp_path / 'cache.sqlite')))
+    metrics = getMetrics()
+    metrics.reset()
+    server.resetCounters()
+
+    for _ in range(3):
+        callWithLimiter(RateLimiter(1e9, 1000, 8), api.search, 'Old Town Road', 3)
+    api.close()
+
+    assert sum(server.calls.values()) == 1
+    assert metrics.counter('api_calls', endpoint='search') == 1
+    assert metrics.counter('cache_hits', endpoint='search') == 2
+    assert metrics.histograms[('api_latency_seconds', (('endpoint', 'search'),))].count == 1
+
+def testCachedPoolCallsAreCountedOnce(server, tmp_path):
+    pool = SpotifyClientPool([PooledClient('app', fakeClient(server), RateLimiter(1e9, 1000, 8))])
+    api = CachedSpotify(pool, ResponseCache(str(tmp_path / 'cache.sqlite')))
+    trackIDs = list(server.catalog.tracks.keys())[:5]
+    metrics = getMetrics()
+    metrics.reset()
+    server.resetCounters()
+
+    callWithLimiter(None, api.audio_features, trackIDs)
+    callWithLimiter(None, api.audio_features, trackIDs)
+    api.close()
+
+    assert sum(server.calls.values()) == 1
+    assert metrics.counter('api_calls', endpoint='audio_features') == 1
@@ -0,0 +1,19 @@
+from data.query.planner import defaultMatchRules, planQueries, planRatios
+
+def testDefaultPlan():
+    assert planQueries(defaultMatchRules) == [
+            (False, [('exact', 100), ('title', 90)]),
+            (True, [('artist', 90)])
+            ]
+    assert planRatios(defaultMatchRules) == [100, 90]
+
+def testRulesOfTheSameSearchAreGroupedOnlyWhenNextToEachOther():
+    rules = [('exact', False, 100), ('artist', True, 95), ('title', False, 80), ('relaxed', True, 80)]
+    assert planQueries(rules) == [
+            (False, [('exact', 100)]),
+            (True, [('artist', 95)]),
+            (False, [('title', 80)]),
+            (True, [('relaxed', 80)])
+            ]
+    assert planRatios(rules) == [100, 95, 80]
+    assert planQueries([]) == []
@@ -0,0 +1,25 @@
+import pytest
+from spotipy import SpotifyException
+
+from benchmarks.fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+from data.query.ratelimit import getRetryAfter
+from data.query.util import initializeSpotifyAPI
+
+@pytest.fixture(scope='module')
+def limitedServer():
+    # Every request gets a 429
+    with FakeSpotifyServer(FakeCatalog(syntheticChartRows(20)), rateLimitShare=1.0, retryAfter=3) as server:
+        yield server
+
+def testRateLimitedClientRaises429AfterOneRequest(limitedServer):
+    api = initializeSpotifyAPI(spotifyUsername='fake', spotifyKey='fake', rateLimited=True)
+    api.prefix = limitedServer.prefix
+    # A token of our own so the client credentials are not fetched from Spotify
+    api.set_auth('fake')
+    limitedServer.resetCounters()
+
+    with pytest.raises(SpotifyException) as raised:
+        api.search('Old Town Road', 3)
+    assert raised.value.http_status == 429
+    assert getRetryAfter(raised.value) == 3
+    assert sum(limitedServer.calls.values()) == 1
@@ -0,0 +1,49 @@
+from copy import deepcopy
+from json import dumps
+
+from data.query.records import CompactSongStore, SongRecord, featureNames
+
+def queryResult(songID: str, matchRule: bool = True) -> dict:
+    result = {
+            'spotifyData': {
+                'name': 'Old Town Road',
+                'songID': songID,
+                'artists': [{'name': 'Lil Nas X', 'artistID': 'a1'}, {'name': 'Billy Ray Cyrus', 'artistID': 'a2'}],
+                'album': {'name': '7', 'albumID': 'b1', 'totalTracks': 8, 'releaseDate': '2019-06-21'}
+                },
+            'searchQuery': 'Old Town Road',
+            'minMatchingRatioUsed': 90,
+            'matchRule': 'title',
+            'originalData': {'date': '2019-04-13', 'rank': '1', 'song': 'Old Town Road', 'artist': 'Lil Nas X'}
+            }
+    if not matchRule:
+        del result['matchRule']
+    return result
+
+def songData(songID: str) -> dict:
+    # Integer features stay integers and the floats keep every bit
+    return {
+            'info': queryResult(songID),
+            'features': {name: i if i < 4 else i / 3 for i, name in enumerate(featureNames)}
+            }
+
+def testRoundTrip():
+    data = {
+            's1': queryResult('s1'),
+            's2': queryResult('s2', matchRule=False),
+            's3': {**queryResult('s3'), 'searchQuery': None, 'matchRule': 'catalog', 'originalData': None},
+            's4': songData('s4'),
+            's5': {**songData('s5'), 'labels': {'hit': 1}},
+            's6': {**songData('s6'), 'features': {}},
+            # Not in the usual shape, kept as it is
+            's7': {'spotifyData': None}
+            }
+    data['s3']['spotifyData']['album'] = None
+    store = CompactSongStore(deepcopy(data))
+
+    assert [type(record) is SongRecord for record in store.records.values()] == [True] * 6 + [False]
+    assert list(store.keys()) == list(data.keys())
+    # Same dicts in the same key order, so the saved json doesn't change either
+    assert dumps(dict(store.items())) == dumps(data)
+    # The artists and albums of the records are kept once
+    assert len(store.artists) == 2 and len(store.albums) == 1
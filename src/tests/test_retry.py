@@ -0,0 +1,20 @@
+from data.query.retry import DeadLetters, QueryFailed
+
+track = {'song': 'Old Town Road', 'artist': 'Lil Nas X', 'date': '2019-04-13'}
+
+def testDeadLettersKeepTheLatestFailureOfAQuery(tmp_path):
+    deadLetters = DeadLetters(str(tmp_path / 'hits.json'))
+    for errorType in ('server', 'timeout', 'rateLimit'):
+        deadLetters.add('Old Town Road', QueryFailed(errorType, Exception(errorType), 3), track, 10, 80, False)
+    # The search with the artist is another query
+    deadLetters.add('Old Town Road', QueryFailed('server', Exception('server'), 3), track, 10, 80, True)
+    deadLetters.save()
+
+    deadLetters = DeadLetters(str(tmp_path / 'hits.json'))
+    assert [(letter['errorType'], letter['useArtistInQuery']) for letter in deadLetters.letters] == [
+            ('rateLimit', False),
+            ('server', True)
+            ]
+    deadLetters.discard(lambda letter: letter['useArtistInQuery'])
+    deadLetters.add('Old Town Road', QueryFailed('client', Exception('client'), 1), track, 10, 80, False)
+    assert [letter['errorType'] for letter in deadLetters.letters] == ['client']
@@ -0,0 +1,66 @@
+import numpy
+
+from data.process.dataset import ShardedDataset
+from data.process.features import modelFeatureNames
+from data.process.statistics import RunningStatistics, datasetStatistics
+
+columns = ['energy', 'tempo']
+ranges = {'energy': (0, 1), 'tempo': (0, 250)}
+
+def randomRows(generator: numpy.random.Generator, count: int) -> numpy.ndarray:
+    rows = numpy.column_stack([generator.beta(2, 5, count), generator.normal(120, 40, count)])
+    # Some missing values, and tempos outside the histogram range
+    rows[generator.random(count) < 0.1, 0] = numpy.nan
+    return rows
+
+def assertSameStatistics(first: RunningStatistics, second: RunningStatistics) -> None:
+    assert first.count.tolist() == second.count.tolist()
+    for name in ('min', 'max', 'mean', 'm2', 'm3', 'm4'):
+        numpy.testing.assert_allclose(getattr(first, name), getattr(second, name), rtol=1e-9)
+    assert first.histograms.tolist() == second.histograms.tolist()
+    assert first.outside.tolist() == second.outside.tolist()
+
+def testMergeEqualsStatisticsOfAllRows():
+    generator = numpy.random.default_rng(0)
+    parts = [randomRows(generator, count) for count in (1, 50, 1000, 7)]
+
+    merged = RunningStatistics(columns, 16, ranges)
+    for part in parts:
+        statistics = RunningStatistics(columns, 16, ranges)
+        # Updated in batches too, the batches are merged the same way
+        for rows in numpy.array_split(part, 3):
+            statistics.update(rows)
+        merged.merge(statistics)
+    together = RunningStatistics(columns, 16, ranges)
+    together.update(numpy.concatenate(parts))
+
+    assertSameStatistics(merged, together)
+    rows = numpy.concatenate(parts)
+    numpy.testing.assert_allclose(merged.mean, numpy.nanmean(rows, axis=0), rtol=1e-9)
+    numpy.testing.assert_allclose(merged.m2 / merged.count, numpy.nanvar(rows, axis=0), rtol=1e-9)
+
+def testMergeWithEmptyStatistics():
+    rows = randomRows(numpy.random.default_rng(1), 100)
+    statistics = RunningStatistics(columns, 16, ranges)
+    statistics.update(rows)
+    merged = RunningStatistics(columns, 16, ranges)
+    merged.merge(statistics)
+    merged.merge(RunningStatistics(columns, 16, ranges))
+
+    assertSameStatistics(merged, statistics)
+
+def constantRows(value: float, count: int) -> numpy.ndarray:
+    x = numpy.full((count, len(modelFeatureNames)), value, dtype='float32')
+    x[:, modelFeatureNames.index('releaseYear')] = 1994
+    return x
+
+def testStatisticsOfARecreatedDataset(tmp_path):
+    ids = [str(i) for i in range(10)]
+    ShardedDataset.create(str(tmp_path), constantRows(1.0, 10), numpy.zeros(10), ids)
+    assert datasetStatistics(str(tmp_path)).mean[0] == 1.0
+    # The new parts have the same names as the old ones
+    ShardedDataset.create(str(tmp_path), constantRows(5.0, 10), numpy.zeros(10), ids)
+    assert datasetStatistics(str(tmp_path)).mean[0] == 5.0
+
+    ShardedDataset.open(str(tmp_path)).append(constantRows(8.0, 10), numpy.zeros(10), ids)
+    assert datasetStatistics(str(tmp_path)).mean[0] == 6.5
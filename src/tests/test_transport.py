@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from spotipy import SpotifyException
+
+from benchmarks.fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+from data.query.transport import HttpTransport
+from data.query.util import initializeSpotifyAPI
+
+statusForcelist = (500, 502, 503, 504)
+
+@pytest.fixture(scope='module')
+def catalog():
+    return FakeCatalog(syntheticChartRows(100))
+
+def albumTracks(transport: HttpTransport, server: FakeSpotifyServer, albumIDs: list[str], workers: int) -> None:
+    api = transport.client(auth='fake', status_forcelist=transport.statusForcelist, retries=transport.retries)
+    api.prefix = server.prefix
+    with ThreadPoolExecutor(workers) as pool:
+        for _ in pool.map(lambda albumID: api.album_tracks(albumID, limit=50), albumIDs):
+            pass
+
+def testConnectionsAreReused(catalog):
+    albumIDs = list(catalog.albums.keys())[:20] * 3
+    with FakeSpotifyServer(catalog) as server:
+        albumTracks(HttpTransport(poolSize=4, retries=0, statusForcelist=statusForcelist), server, albumIDs, 4)
+    assert 1 <= server.connections <= 4
+    assert sum(server.calls.values()) == len(albumIDs)
+
+def testResponsesAreCompressed(catalog):
+    albumIDs = list(catalog.albums.keys())[:20]
+    sent = {}
+    with FakeSpotifyServer(catalog, compress=True) as server:
+        for compress in (True, False):
+            server.resetCounters()
+            transport = HttpTransport(compress=compress, retries=0, statusForcelist=statusForcelist)
+            albumTracks(transport, server, albumIDs, 1)
+            sent[compress] = server.bytesSent
+    assert sent[True] < sent[False]
+
+def testRateLimitsAreRetriedOnlyWithTheStatus(catalog):
+    with FakeSpotifyServer(catalog, rateLimitShare=1.0, retryAfter=0) as server:
+        for transport, requests in (
+                (HttpTransport(retries=2, backoffFactor=0), 3),
+                (HttpTransport(retries=2, backoffFactor=0, statusForcelist=statusForcelist), 1)
+                ):
+            server.resetCounters()
+            with pytest.raises(SpotifyException):
+                albumTracks(transport, server, list(catalog.albums.keys())[:1], 1)
+            assert sum(server.calls.values()) == requests
+
+def testTransportHasToAgreeWithRateLimited():
+    with pytest.raises(ValueError):
+        initializeSpotifyAPI(spotifyUsername='fake', spotifyKey='fake', rateLimited=True, transport=HttpTransport())
+    with pytest.raises(ValueError):
+        initializeSpotifyAPI(
+                spotifyUsername='fake',
+                spotifyKey='fake',
+                transport=HttpTransport(statusForcelist=statusForcelist)
+                )
@@ -0,0 +1,86 @@
+from csv import DictWriter
+from io import StringIO
+from zipfile import ZipFile
+
+from spotipy import Spotify, SpotifyException
+
+from benchmarks.fake_spotify import FakeCatalog, FakeSpotifyServer, syntheticChartRows
+from data.process.dataset import ShardedDataset
+from data.query.update import loadWatermark, updateFromCharts
+from data.query.util import loadJson
+
+weeks = ['2021-01-02', '2021-01-09', '2021-01-16']
+
+class FailingFeaturesAPI:
+    """
+    A Spotify client whose audio features calls fail for the batches with a song in failingIDs.
+    """
+
+    def __init__(self, api: Spotify, failingIDs: set[str]) -> None:
+        self.api = api
+        self.failingIDs = failingIDs
+
+    def __getattr__(self, name: str):
+        return getattr(self.api, name)
+
+    def audio_features(self, tracks: list[str]) -> list:
+        if not self.failingIDs.isdisjoint(tracks):
+            raise SpotifyException(404, -1, 'not found')
+        return self.api.audio_features(tracks)
+
+def chartRows() -> list[dict]:
+    # Four different songs every week
+    songs = list({(row['song'], row['artist']): row for row in syntheticChartRows(40)}.values())[:12]
+    return [{**row, 'date': weeks[i // 4]} for i, row in enumerate(songs)]
+
+def writeCharts(path: str, rows: list[dict]) -> None:
+    csv = StringIO()
+    writer = DictWriter(csv, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    # Newest weeks first like the Kaggle charts.csv
+    writer.writerows(sorted(rows, key=lambda row: row['date'], reverse=True))
+    with ZipFile(path, 'w') as z:
+        z.writestr('charts.csv', csv.getvalue())
+
+def testFailedFeaturesHoldTheWatermark(tmp_path):
+    rows = chartRows()
+    chartsPath = str(tmp_path / 'charts.zip')
+    storePaths = [str(tmp_path / name) for name in ('hits.json', 'hitFeatures.json', 'notHits.json', 'notHitFeatures.json')]
+    datasetPath = str(tmp_path / 'dataset')
+    catalog = FakeCatalog(rows)
+    lastWeekIDs = {trackID for trackID, track in catalog.tracks.items() if track['name'] == rows[-1]['song']}
+
+    with FakeSpotifyServer(catalog) as server:
+        api = Spotify(auth='fake', retries=0)
+        api.prefix = server.prefix
+
+        writeCharts(chartsPath, rows[:4])
+        updateFromCharts(api, chartsPath, *storePaths, datasetPath=datasetPath, useCatalog=False)
+        assert loadWatermark(storePaths[0] + '.watermark.json') == {'lastDate': weeks[0], 'rows': 4}
+        firstHits = len(loadJson(storePaths[1]))
+
+        # The features of the two new weeks are fetched in one batch that fails
+        writeCharts(chartsPath, rows)
+        summary = updateFromCharts(
+                FailingFeaturesAPI(api, lastWeekIDs),
+                chartsPath,
+                *storePaths,
+                datasetPath=datasetPath,
+                useCatalog=False
+                )
+        assert summary['hits'] == len(loadJson(storePaths[0])) - firstHits > 0
+        assert loadWatermark(storePaths[0] + '.watermark.json') == {'lastDate': weeks[0], 'rows': 4}
+        assert len(loadJson(storePaths[1])) == firstHits
+
+        # The same weeks again, the stored songs are not searched again and the missing features are fetched
+        summary = updateFromCharts(api, chartsPath, *storePaths, datasetPath=datasetPath, useCatalog=False)
+        assert summary['hits'] == 0
+
+    assert loadWatermark(storePaths[0] + '.watermark.json') == {'lastDate': weeks[2], 'rows': 12}
+    hitFeatures = loadJson(storePaths[1])
+    assert set(hitFeatures) == {hit['spotifyData']['songID'] for hit in loadJson(storePaths[0]).values()}
+    _, labels, ids = ShardedDataset.open(datasetPath).load()
+    rows = list(zip(ids.tolist(), labels.tolist()))
+    # Every hit is appended once when its features are stored, and no song twice with the same label
+    assert sorted(sid for sid, label in rows if label == 1) == sorted(hitFeatures)
+    assert len(set(rows)) == len(rows)